@@ -1,8 +1,14 @@
-from tkinter import Tk, StringVar, END, RIGHT, X, LEFT, Text, DISABLED, NORMAL, filedialog
-from tkinter.ttk import Button, Radiobutton, Label
+from tkinter import Tk, Toplevel, StringVar, END, RIGHT, X, LEFT, Text, DISABLED, NORMAL, filedialog, messagebox
+from tkinter.ttk import Button, Radiobutton, Label, Progressbar
 from pathlib import Path
 from main import main, generate_output_path, MethodChoice, w_sentry
-from typing import Optional
+from preview import preview, Preview
+import instrumentation
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from queue import Queue, Empty
+from threading import Event
+import time
 import darkdetect
 from environs import Env
 from marshmallow.validate import Regexp
@@ -36,10 +42,27 @@ if VERSION != "0.0.0":
     TITLE = f"Watermark Remover v{VERSION} - by [www.NasK.io]"
 
 # Widgets
+ROOT_WIDGET = None
 LOG_TXT_AREA_WIDGET = None
 METHOD_CHOICE_STRING_VAR = None
+FILE_PROGRESS_WIDGET = None
+TOTAL_PROGRESS_WIDGET = None
+STATUS_STRING_VAR = None
+CHOOSE_BUTTON_WIDGET = None
+CANCEL_BUTTON_WIDGET = None
 # OTHERS
 SENTRY_STATUS = False
+# background processing: files are processed one at a time off the Tk thread, which polls EVENTS_QUEUE
+POLL_INTERVAL_MS = 100
+EVENTS_QUEUE: Queue = Queue()
+CANCEL_EVENT = Event()
+WORKER_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='watermark-worker')
+BATCH = {}  # state of the running batch (see start_batch)
+PREVIEW_DISPLAY_SIZE = 320  # longest side of the before and after images of the preview window
+
+
+class BatchCancelled(Exception):
+    pass
 
 
 def log_clear():
@@ -70,28 +93,188 @@ def open_files():
             output_dir_path = Path(output_dir)
             if not output_dir_path.exists():
                 output_dir_path.mkdir(parents=True)
+            jobs = []
             for input_file in input_files:
                 input_path = Path(input_file)
                 if not input_path.exists():
                     log_write(f"File {input_path} does not exist")
                 elif str(input_path.suffix).lower() not in ('.docx', '.pdf', '.png', '.jpg', '.jpeg'):
                     log_write(f"File {input_path} is not a Word, PDF or Image file")
-                else:  # processing
-                    log_write(f'Input: {input_file}')
-                    try:
-                        output_file = output_dir_path / (input_path.stem + f"_generated{input_path.suffix}")
-                        log_write(f'Output: {output_file}')
-                        log_write("Processing...")
-                        p_method_choice = MethodChoice.from_str(METHOD_CHOICE_STRING_VAR.get())
-                        log_write(f"method: {p_method_choice.value}")
-                        output_file = main(input_file, str(output_file), p_method_choice)
-                        log_write(f'File has been saved successfully to: {output_file}')
-                    except Exception as e:
-                        log_write(str(e))
+                else:
+                    jobs.append((input_path, output_dir_path / (input_path.stem + f"_generated{input_path.suffix}")))
+            if jobs:
+                method_choice = MethodChoice.from_str(METHOD_CHOICE_STRING_VAR.get())
+                if method_choice == MethodChoice.geos:  # no image to preview
+                    start_batch(jobs, method_choice)
+                else:
+                    start_preview(jobs, method_choice)
         else:
             log_write(f'Operation cancelled: you should select a folder')
 
 
+def start_preview(jobs: List[Tuple[Path, Path]], method_choice: MethodChoice):
+    """Preview the method on the first file in the worker thread, the batch starts once the user confirms."""
+    log_write(f"Preview of {jobs[0][0].name}...")
+    CHOOSE_BUTTON_WIDGET.config(state=DISABLED)
+    future = WORKER_POOL.submit(preview, jobs[0][0], method_choice)
+    ROOT_WIDGET.after(POLL_INTERVAL_MS, poll_preview, future, jobs, method_choice)
+
+
+def poll_preview(future: Future, jobs: List[Tuple[Path, Path]], method_choice: MethodChoice):
+    if not future.done():
+        ROOT_WIDGET.after(POLL_INTERVAL_MS, poll_preview, future, jobs, method_choice)
+        return
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.info(f"{jobs[0][0]} => no preview.", exc_info=e)
+        if messagebox.askyesno("Preview", f"No preview: {e}\n\nClean {len(jobs)} file(s) anyway?"):
+            start_batch(jobs, method_choice)
+        else:
+            cancel_preview()
+        return
+    log_write(f"Preview: {result.source} ({result.full_size[0]}x{result.full_size[1]}) in {result.elapsed:.2f}s")
+    show_preview(result, jobs, method_choice)
+
+
+def show_preview(result: Preview, jobs: List[Tuple[Path, Path]], method_choice: MethodChoice):
+    """Before and after images of the first file, the batch starts if the user confirms."""
+    from PIL import ImageTk
+    window = Toplevel(ROOT_WIDGET)
+    window.title(f"Preview - {Path(result.input_file).name}")
+    window.transient(ROOT_WIDGET)
+    photo = ImageTk.PhotoImage(result.side_by_side(PREVIEW_DISPLAY_SIZE), master=window)
+    image_label = Label(window, image=photo)
+    image_label.image = photo  # keep a reference: Tk does not
+    image_label.pack(padx=10, pady=10)
+    Label(window, text=f"Before / after ({method_choice.value}, {result.source} at {result.scale:.0%})").pack(
+        fill=X, padx=10)
+
+    def confirm():
+        window.destroy()
+        start_batch(jobs, method_choice)
+
+    def cancel():
+        window.destroy()
+        cancel_preview()
+
+    Button(window, text="Cancel", command=cancel).pack(side=RIGHT, padx=10, pady=10)
+    Button(window, text=f"Clean {len(jobs)} file(s)", command=confirm).pack(side=RIGHT, pady=10)
+    window.protocol("WM_DELETE_WINDOW", cancel)
+    window.grab_set()
+
+
+def cancel_preview():
+    log_write("Operation cancelled.")
+    CHOOSE_BUTTON_WIDGET.config(state=NORMAL)
+
+
+def process_file(index: int, input_path: Path, output_file: Path, method_choice: MethodChoice):
+    """Runs in the worker thread: every update of the window is sent to EVENTS_QUEUE."""
+    if CANCEL_EVENT.is_set():
+        EVENTS_QUEUE.put(('file_done', index, 0, None))
+        return
+    EVENTS_QUEUE.put(('file_start', index, input_path, output_file))
+
+    def progress(done: int, total: int):
+        if CANCEL_EVENT.is_set():
+            raise BatchCancelled()
+        EVENTS_QUEUE.put(('progress', index, done, total))
+
+    size = input_path.stat().st_size
+    try:
+        output_file = main(str(input_path), str(output_file), method_choice, progress=progress)
+        EVENTS_QUEUE.put(('log', f'File has been saved successfully to: {output_file}'))
+        EVENTS_QUEUE.put(('file_done', index, size, True))
+    except BatchCancelled:
+        if output_file.exists():  # partially written
+            output_file.unlink()
+        EVENTS_QUEUE.put(('file_done', index, 0, None))
+    except Exception as e:
+        logger.warning(f"{input_path} => failed to remove watermark.", exc_info=e)
+        EVENTS_QUEUE.put(('log', str(e)))
+        EVENTS_QUEUE.put(('file_done', index, size, False))
+
+
+def start_batch(jobs: List[Tuple[Path, Path]], method_choice: MethodChoice):
+    """Send the files to the worker thread and poll its events."""
+    CANCEL_EVENT.clear()
+    BATCH.clear()
+    # progress units: pages of pdf, images of docx (1 per image file)
+    pdf_jobs = sum(input_path.suffix.lower() == '.pdf' for input_path, _ in jobs)
+    unit = 'pages' if pdf_jobs == len(jobs) else 'images' if not pdf_jobs else 'pages+images'
+    BATCH.update(total=len(jobs), done=0, units=0, current_units=0, bytes=0, start=time.perf_counter(),
+                 cancelled=False, unit=unit)
+    log_write(f"method: {method_choice.value}")
+    CHOOSE_BUTTON_WIDGET.config(state=DISABLED)
+    CANCEL_BUTTON_WIDGET.config(state=NORMAL)
+    FILE_PROGRESS_WIDGET.config(value=0, maximum=1)
+    TOTAL_PROGRESS_WIDGET.config(value=0, maximum=len(jobs))
+    STATUS_STRING_VAR.set(f"0/{len(jobs)} files")
+    for index, (input_path, output_file) in enumerate(jobs):
+        WORKER_POOL.submit(process_file, index, input_path, output_file, method_choice)
+    ROOT_WIDGET.after(POLL_INTERVAL_MS, poll_events)
+
+
+def cancel_batch():
+    CANCEL_EVENT.set()
+    BATCH['cancelled'] = True
+    CANCEL_BUTTON_WIDGET.config(state=DISABLED)
+    log_write("Cancelling...")
+
+
+def update_status():
+    elapsed = max(time.perf_counter() - BATCH['start'], 1e-6)
+    units = BATCH['units'] + BATCH['current_units']
+    STATUS_STRING_VAR.set(f"{BATCH['done']}/{BATCH['total']} files - {units / elapsed:.1f} {BATCH['unit']}/s - "
+                          f"{BATCH['bytes'] / elapsed / 1024 / 1024:.2f} MB/s")
+
+
+def poll_events():
+    """Runs in the Tk thread: apply the events of the worker thread to the window."""
+    while True:
+        try:
+            event = EVENTS_QUEUE.get_nowait()
+        except Empty:
+            break
+        if event[0] == 'log':
+            log_write(event[1])
+        elif event[0] == 'file_start':
+            _, index, input_path, output_file = event
+            log_write(f'Input: {input_path}')
+            log_write(f'Output: {output_file}')
+            log_write("Processing...")
+            FILE_PROGRESS_WIDGET.config(value=0, maximum=1)
+        elif event[0] == 'progress':
+            _, index, done, total = event
+            BATCH['current_units'] = done
+            FILE_PROGRESS_WIDGET.config(value=done, maximum=max(total, 1))
+            TOTAL_PROGRESS_WIDGET.config(value=BATCH['done'] + (done / total if total else 0))
+        elif event[0] == 'file_done':
+            _, index, size, ok = event
+            BATCH['done'] += 1
+            BATCH['units'] += BATCH['current_units'] if ok else 0
+            BATCH['current_units'] = 0
+            BATCH['bytes'] += size
+            FILE_PROGRESS_WIDGET.config(value=FILE_PROGRESS_WIDGET['maximum'] if ok else 0)
+            TOTAL_PROGRESS_WIDGET.config(value=BATCH['done'])
+        update_status()
+    if BATCH['done'] < BATCH['total']:
+        ROOT_WIDGET.after(POLL_INTERVAL_MS, poll_events)
+    else:
+        log_write("Batch cancelled." if BATCH['cancelled'] else "Done.")
+        CHOOSE_BUTTON_WIDGET.config(state=NORMAL)
+        CANCEL_BUTTON_WIDGET.config(state=DISABLED)
+
+
+def close_window():
+    """Stop the batch before closing: files not started are dropped, the current one stops at its next page."""
+    if BATCH and BATCH['done'] < BATCH['total']:
+        cancel_batch()
+    WORKER_POOL.shutdown(wait=False, cancel_futures=True)
+    ROOT_WIDGET.destroy()
+
+
 def get_output_file(input_path: Path) -> Optional[str]:
     initial_path = generate_output_path(input_path)
     default_extension = str(input_path.suffix).lower()
@@ -164,20 +347,43 @@ def main_ui():
     ws.geometry(f"{window_width}x{window_height}+{x_coordinate}+{y_coordinate}")
     # ws.geometry("694x600")
     # ws['bg'] = 'gray'
+    global ROOT_WIDGET
+    ROOT_WIDGET = ws
+    ws.protocol("WM_DELETE_WINDOW", close_window)
     global LOG_TXT_AREA_WIDGET
     LOG_TXT_AREA_WIDGET = Text(
-        ws, width=60, height=30, state=DISABLED,
+        ws, width=60, height=25, state=DISABLED,
         # bg='white', fg='black'
     )
-    LOG_TXT_AREA_WIDGET.pack(pady=30)
+    LOG_TXT_AREA_WIDGET.pack(pady=(30, 10))
+
+    # progress of the current file, of the batch and throughput
+    global FILE_PROGRESS_WIDGET, TOTAL_PROGRESS_WIDGET, STATUS_STRING_VAR
+    FILE_PROGRESS_WIDGET = Progressbar(ws, mode='determinate')
+    FILE_PROGRESS_WIDGET.pack(fill=X, padx=30, pady=2)
+    TOTAL_PROGRESS_WIDGET = Progressbar(ws, mode='determinate')
+    TOTAL_PROGRESS_WIDGET.pack(fill=X, padx=30, pady=2)
+    STATUS_STRING_VAR = StringVar(value="")
+    Label(ws, textvariable=STATUS_STRING_VAR).pack(fill=X, padx=30, pady=(2, 10))
 
-    Button(
+    global CANCEL_BUTTON_WIDGET
+    CANCEL_BUTTON_WIDGET = Button(
+        ws,
+        text="Cancel",
+        command=cancel_batch,
+        state=DISABLED,
+    )
+    CANCEL_BUTTON_WIDGET.pack(side=RIGHT, padx=(0, 30))
+
+    global CHOOSE_BUTTON_WIDGET
+    CHOOSE_BUTTON_WIDGET = Button(
         ws,
         text="Choose Files",
         command=open_files,
         # bg='gray',
         # fg='black'
-    ).pack(side=RIGHT, expand=True, fill=X, padx=30)
+    )
+    CHOOSE_BUTTON_WIDGET.pack(side=RIGHT, expand=True, fill=X, padx=30)
 
     # display title
     Label(ws, text="Method").pack(side=LEFT, expand=True, fill=X, padx=30)
@@ -200,6 +406,8 @@ try:
     SENTRY_STATUS = w_sentry(sentry_sdk.init,
                              SENTRY_DSN,
                              traces_sample_rate=0.10, )  # capture x% of transactions for performance monitoring
+    if SENTRY_STATUS:
+        instrumentation.enable()  # every processed file is a transaction with a span per stage
     main_ui()
 except Exception as ee:
     logger.error("Unhandled exception", exc_info=ee)
@@ -0,0 +1,98 @@
+"""
+Asyncio API: remove watermarks without blocking the event loop.
+
+The cleaning runs in an executor: threads by default (the event loop default executor), or a ProcessPoolExecutor
+passed as executor for CPU-bound batches. Files are read and written by main in the executor, never in the event
+loop. Files in memory are cleaned without temporary files.
+
+usage:
+async for result in remove_watermarks(paths, output_dir, MethodChoice.openCV2, limit=4):
+    print(result.input_file, result.status)
+"""
+
+import asyncio
+import time
+from concurrent.futures import Executor
+from functools import partial
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Union
+
+from main import main, MethodChoice, remove_watermark_from_bytes as main_remove_watermark_from_bytes
+from batch import FileResult, FileStatus, batch_output_path, _file_size
+
+
+async def remove_watermark(input_file: Union[str, Path], output_file: Union[str, Path] = None,
+                           method_choice: MethodChoice = None, executor: Executor = None, **options) -> str:
+    """
+    Remove watermark from a file (see main.main)
+    :param input_file:
+    :param output_file:
+    :param method_choice:
+    :param executor: executor running main (default: the event loop default executor)
+    :param options: other arguments of main
+    :return: output file
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(main, input_file, output_file, method_choice, **options))
+
+
+async def remove_watermark_from_bytes(data: Union[bytes, memoryview], method_choice: MethodChoice = None,
+                                      executor: Executor = None, **options) -> bytes:
+    """
+    Remove watermark from the content of a file, in memory (see main.remove_watermark_from_bytes)
+    :param data:
+    :param method_choice:
+    :param executor: executor running the cleaning (default: the event loop default executor)
+    :param options: other arguments of main.remove_watermark_from_bytes (file_type is detected from data by default)
+    :return: content of the cleaned file
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(main_remove_watermark_from_bytes, data,
+                                                        method_choice=method_choice, **options))
+
+
+async def _remove_watermark_result(semaphore: asyncio.Semaphore, input_file: Union[str, Path],
+                                   output_file: Path, method_choice: MethodChoice, executor: Executor,
+                                   **options) -> FileResult:
+    async with semaphore:
+        result = FileResult(input_file=str(input_file), bytes_in=_file_size(input_file))
+        start = time.perf_counter()
+        try:
+            result.output_file = await remove_watermark(input_file, output_file, method_choice, executor, **options)
+            result.bytes_out = _file_size(result.output_file)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result.status = FileStatus.failed
+            result.error = e
+        result.elapsed = time.perf_counter() - start
+        return result
+
+
+async def remove_watermarks(input_files: Iterable[Union[str, Path]], output_dir: Union[str, Path] = None,
+                            method_choice: MethodChoice = None, limit: int = 4, executor: Executor = None,
+                            **options) -> AsyncIterator[FileResult]:
+    """
+    Remove watermark from many files, at most limit at the same time, yielding the results as they finish
+    Closing the generator (or cancelling the task iterating over it) cancels the files not started yet, files in
+    progress in the executor run to completion.
+    :param input_files:
+    :param output_dir: defaults to the directory of each input file
+    :param method_choice:
+    :param limit: max number of files processed at the same time
+    :param executor: executor running main (default: the event loop default executor)
+    :param options: other arguments of main (applied to every file)
+    :return: one result per input file (failures are results, not exceptions), in completion order
+    """
+    semaphore = asyncio.Semaphore(limit)
+    tasks = [asyncio.ensure_future(_remove_watermark_result(semaphore, input_file,
+                                                            batch_output_path(input_file, output_dir),
+                                                            method_choice, executor, **options))
+             for input_file in input_files]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
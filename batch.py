@@ -0,0 +1,213 @@
+"""
+Batch processing: remove watermarks from many files using a pool of worker processes.
+"""
+
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from enum import Enum
+from logging import getLogger
+from pathlib import Path
+from typing import List, Optional, Union
+
+import signatures
+from main import main, generate_output_path, MethodChoice
+from instrumentation import Report, current_report, instrument
+from scan import SCAN_MIN_CONFIDENCE, scan_file
+
+logger = getLogger(__name__)
+
+
+class FileStatus(Enum):
+    success = "Success"
+    failed = "Failed"
+    skipped = "Skipped"  # clean file, no output
+    copied = "Copied"  # clean file copied to the output
+
+
+class CleanAction(Enum):
+    process = "Process"
+    skip = "Skip"
+    copy = "Copy"
+
+    @staticmethod
+    def from_str(label):
+        if label in ('process',):
+            return CleanAction.process
+        elif label in ('skip',):
+            return CleanAction.skip
+        elif label in ('copy',):
+            return CleanAction.copy
+        else:
+            raise NotImplementedError
+
+
+@dataclass
+class FileResult:
+    """Result of processing a single file of a batch."""
+    input_file: str
+    output_file: Optional[str] = None
+    status: FileStatus = FileStatus.success
+    elapsed: float = 0.0  # seconds
+    bytes_in: int = 0
+    bytes_out: int = 0
+    error: Optional[BaseException] = None
+    report: Optional[dict] = None  # stages and counters recorded in a worker process (see instrumentation.py)
+    scan: Optional[dict] = None  # verdict of the scan of the file, if clean files were looked for (see scan.py)
+    signature_counts: Optional[dict] = None  # pages and signature hits recorded for the file (see signatures.py)
+
+    @property
+    def ok(self) -> bool:
+        return self.status != FileStatus.failed
+
+
+def _file_size(path: Union[str, Path]) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _process_file(result: FileResult, input_file: Union[str, Path], output_file: Union[str, Path] = None,
+                  method_choice: MethodChoice = None, on_clean: CleanAction = CleanAction.process,
+                  min_confidence: float = SCAN_MIN_CONFIDENCE, **options):
+    if on_clean != CleanAction.process:
+        scan_result = scan_file(input_file, method_choice, options.get('signature_set'))
+        result.scan = scan_result.to_dict()
+        if scan_result.is_clean(min_confidence):
+            if on_clean == CleanAction.skip:
+                logger.info(f"{input_file} => no watermark (confidence {scan_result.confidence:.2f}), skipped.")
+                result.status = FileStatus.skipped
+                return
+            output_path = Path(output_file) if output_file else generate_output_path(Path(input_file))
+            shutil.copyfile(input_file, output_path)
+            logger.info(f"{input_file} => no watermark (confidence {scan_result.confidence:.2f}), copied.")
+            result.status = FileStatus.copied
+            result.output_file = str(output_path)
+            return
+    result.output_file = main(input_file, output_file, method_choice, **options)
+
+
+def process_file(input_file: Union[str, Path], output_file: Union[str, Path] = None,
+                 method_choice: MethodChoice = None, instrumented: bool = False,
+                 on_clean: Union[str, CleanAction] = None, min_confidence: float = SCAN_MIN_CONFIDENCE,
+                 **options) -> FileResult:
+    """
+    Remove watermark from a single file, never raises
+    :param input_file:
+    :param output_file:
+    :param method_choice:
+    :param instrumented: record the stages and counters in result.report (to send them back from a worker process)
+    :param on_clean: what to do with files without watermark (see scan.py): process (default, files are not
+    scanned), skip (no output) or copy (input copied to the output)
+    :param min_confidence: files found clean with a lower confidence are processed
+    :param options: other arguments of main
+    :return: result of the processing
+    """
+    if isinstance(on_clean, str):
+        on_clean = CleanAction.from_str(on_clean)
+    on_clean = on_clean or CleanAction.process
+    result = FileResult(input_file=str(input_file), bytes_in=_file_size(input_file))
+    start = time.perf_counter()
+    signature_counts = signatures.REGISTRY.counts()
+    try:
+        if instrumented:
+            with instrument(str(input_file), export=False) as report:
+                try:
+                    _process_file(result, input_file, output_file, method_choice, on_clean, min_confidence,
+                                  **options)
+                finally:
+                    result.report = report.to_dict()
+        else:
+            _process_file(result, input_file, output_file, method_choice, on_clean, min_confidence, **options)
+        result.bytes_out = _file_size(result.output_file) if result.output_file else 0
+    except Exception as e:
+        logger.warning(f"{input_file} => failed to remove watermark.", exc_info=e)
+        result.status = FileStatus.failed
+        result.error = e
+    result.signature_counts = signatures.REGISTRY.counts_since(signature_counts)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def batch_output_path(input_file: Union[str, Path], output_dir: Union[str, Path] = None) -> Path:
+    """Output path of a file of a batch (in output_dir if given, next to the input file otherwise)."""
+    output_path = generate_output_path(Path(input_file))
+    if output_dir:
+        output_path = Path(output_dir) / output_path.name
+    return output_path
+
+
+def run_batch(input_files: List[Union[str, Path]], output_dir: Union[str, Path] = None,
+              method_choice: MethodChoice = None, workers: Optional[int] = None, **options) -> List[FileResult]:
+    """
+    Remove watermark from many files in parallel, biggest files first.
+    :param input_files:
+    :param output_dir: defaults to the directory of each input file
+    :param method_choice:
+    :param workers: number of worker processes, defaults to the number of CPUs (1 to process in-process)
+    :param options: on_clean and min_confidence (see process_file), other arguments of main (applied to every file)
+    :return: one result per input file, in the same order as input_files
+    """
+    jobs = [(Path(input_file), batch_output_path(input_file, output_dir)) for input_file in input_files]
+    # schedule big files first so that they don't end up running alone at the end of the batch
+    order = sorted(range(len(jobs)), key=lambda i: _file_size(jobs[i][0]), reverse=True)
+    results: List[Optional[FileResult]] = [None] * len(jobs)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(jobs) <= 1:
+        for i in order:
+            results[i] = process_file(jobs[i][0], jobs[i][1], method_choice, **options)
+        return results
+    report = current_report()  # stages and counters of the worker processes are added to it
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        futures = {executor.submit(process_file, jobs[i][0], jobs[i][1], method_choice, report is not None,
+                                   **options): i
+                   for i in order}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:  # worker crashed or result could not be transferred back
+                logger.warning(f"{jobs[i][0]} => worker failed.", exc_info=e)
+                results[i] = FileResult(input_file=str(jobs[i][0]), status=FileStatus.failed, error=e,
+                                        bytes_in=_file_size(jobs[i][0]))
+    for result in results:
+        # recorded in the registry of the worker processes
+        if result.signature_counts:
+            signatures.REGISTRY.merge(result.signature_counts)
+        if report is not None and result.report:
+            report.merge(Report.from_dict(result.report))
+    return results
+
+
+def batch(*input_files: str, output_dir: str = None, method_choice: str = None, workers: int = None,
+          **options) -> List[dict]:
+    """
+    CLI entry point
+    :param input_files:
+    :param output_dir:
+    :param method_choice: geos, colors_replacement or openCV2
+    :param workers:
+    :param options: on_clean: process, skip or copy the files without watermark (see process_file), other arguments
+    of main
+    :return:
+    """
+    p_method_choice = MethodChoice.from_str(method_choice) if method_choice else None
+    results = run_batch(list(input_files), output_dir, p_method_choice, workers, **options)
+    return [{
+        'input_file': r.input_file,
+        'output_file': r.output_file,
+        'status': r.status.value,
+        'elapsed': round(r.elapsed, 3),
+        'bytes_in': r.bytes_in,
+        'bytes_out': r.bytes_out,
+        'error': str(r.error) if r.error else None,
+        'scan': r.scan,
+    } for r in results]
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(batch)
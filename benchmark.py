@@ -0,0 +1,794 @@
+"""
+Benchmarks for the project.
+
+usage:
+python benchmark.py matcher --pages=200
+python benchmark.py colors --sizes=[1,10] --palettes=[3,24]
+python benchmark.py memory --megapixels=100 --tile_height=256
+python benchmark.py zip --images=20
+python benchmark.py startup --module=main
+python benchmark.py prefilter --pages=500 --clean_ratio=0.9
+python benchmark.py parallel --pages=200 --workers=4
+python benchmark.py save --pages=1000 --raster_pages=20
+python benchmark.py template --pages=50 --megapixels=4
+python benchmark.py preview --megapixels=100
+python benchmark.py suite --profile=quick --output=results.json
+python benchmark.py suite --profile=full --cases=[geos,docx] --baseline=results.json --threshold=0.1
+python benchmark.py compare baseline.json results.json --threshold=0.1
+"""
+
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+
+import fire
+import numpy as np
+from PIL import Image
+from pikepdf import Dictionary, Name, Pdf, parse_content_stream
+
+from main import main, MethodChoice, remove_tjs_min, remove_tj_maj, remove_by_reversed_orders, hex_to_rbg, \
+    rgb_to_hex, replace_colors_in_image, remove_watermark_from_cv_image, replace_images_in_zip
+import signatures
+
+logger = getLogger(__name__)
+
+FIXTURE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def timeit(fn: Callable, repeat: int = 5) -> float:
+    """Best wall time of fn() in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def geos_page_content(page_number: int, lines: int = 40, watermark: bool = True) -> bytes:
+    """Content stream of a page looking like the ones exported from GEOS apps."""
+    content = b"".join(b"BT /F1 10 Tf 72 %d Td (Line %d of page %d) Tj ET\n" % (700 - 12 * i, i, page_number)
+                       for i in range(lines))
+    if watermark:
+        content += (b"BT /F1 40 Tf 100 400 Td (VERSION ) Tj (EVALUATION) Tj ET\n"
+                    b"BT /F1 8 Tf 72 20 Td [(Trial - ) -20 (Geos)] TJ ET\n"
+                    b"BT [<0037> <0055> <004C> <0044> <004F> <0003> <0010> <0003>] TJ ET\n"
+                    b"BT [(UnRegistered)] TJ ET\n")
+    return content + b"0 0 10 10 re f\n"
+
+
+# content streams of pages and whether the prefilter skips them
+PREFILTER_CASES = [
+    (b"BT /F1 40 Tf 100 400 Td (VERSION ) Tj [(foo)] TJ (EVALUATION) Tj ET\n", False),  # Tj run across a TJ
+    (b"0 0 10 10 re f\n20 20 10 10 re f\nBT [(Trial - ) (Geos)] TJ ET\n", False),  # vector stamp: fallback_orders
+    (b"0 0 10 10 re f\n20 20 10 10 re f\n", True),  # fills without signature
+    (b"BT /F1 10 Tf 72 700 Td [(Trial)] TJ (EVALUATION VERSION) Tj ET\n", True),  # signature words in other orders
+]
+
+
+def geos_watermarked(page_number: int, clean_ratio: float) -> bool:
+    """Whether a page of geos_pdf has a watermark, the clean pages are spread across the pdf."""
+    return int((page_number + 1) * (1 - clean_ratio)) > int(page_number * (1 - clean_ratio))
+
+
+def geos_chain(instructions: List) -> List:
+    """Signatures removed one scan at a time (before WatermarkMatcher)."""
+    previous_len = len(instructions)
+    instructions = remove_tjs_min(instructions, "VERSION EVALUATION")
+    if len(instructions) == previous_len:
+        instructions = remove_by_reversed_orders(instructions, {'f': [0, ]})
+    instructions = remove_tj_maj(instructions, "Trial - ")
+    instructions = remove_tj_maj(instructions, [b'\x007', b'\x00U', b'\x00L', b'\x00D', b'\x00O', b'\x00\x03',
+                                                b'\x00\x10', b'\x00\x03'])
+    return remove_tj_maj(instructions, "UnRegistered")
+
+
+def matcher(pages: int = 100, lines: int = 40, repeat: int = 5, signature_set: str = None) -> dict:
+    """
+    Per-page cost of the compiled GEOS matcher vs the chain of remove_tjs_min / remove_tj_maj
+    :param pages:
+    :param lines: lines of text per page
+    :param repeat:
+    :param signature_set:
+    :return:
+    """
+    geos_matcher = signatures.REGISTRY.get(signature_set)
+    pdf = Pdf.new()
+    pages_instructions = [parse_content_stream(pdf.make_stream(geos_page_content(i, lines))) for i in range(pages)]
+    chain_time = timeit(lambda: [geos_chain(list(x)) for x in pages_instructions], repeat)
+    matcher_time = timeit(lambda: [geos_matcher.apply(list(x)) for x in pages_instructions], repeat)
+    return {
+        'pages': pages,
+        'instructions_per_page': len(pages_instructions[0]),
+        'chain_us_per_page': round(chain_time / pages * 1e6, 1),
+        'matcher_us_per_page': round(matcher_time / pages * 1e6, 1),
+        'speedup': round(chain_time / matcher_time, 2),
+    }
+
+
+def replace_colors_loop(image: Image, replacements: Dict[str, str]) -> Image:
+    """One full-image pass per color (before replace_colors_in_array)."""
+    image = image.convert('RGBA')
+    data = np.array(image)
+    red, green, blue, alpha = data.T
+    for old_c, new_c in replacements.items():
+        old_color = hex_to_rbg(old_c)
+        new_color = hex_to_rbg(new_c)
+        white_areas = (red == old_color[0]) & (green == old_color[1]) & (blue == old_color[2])
+        data[..., :-1][white_areas.T] = new_color
+    return Image.fromarray(data)
+
+
+def scanned_array(megapixels: float, seed: int = 0) -> np.ndarray:
+    """height x width x 3 array of a page with a few light gray lines like the ones of scanned documents."""
+    width = int((megapixels * 1e6 / 1.414) ** 0.5)
+    height = int(width * 1.414)
+    rng = np.random.default_rng(seed)
+    data = np.full((height, width, 3), 255, dtype=np.uint8)
+    rows = rng.integers(0, height, size=height // 8)
+    data[rows] = rng.choice([0xf0, 0xc0, 0x20], size=(len(rows), 1, 1))
+    return data
+
+
+def scanned_image(megapixels: float, seed: int = 0) -> Image:
+    return Image.fromarray(scanned_array(megapixels, seed))
+
+
+def colors(sizes: List[float] = (1, 10), palettes: List[int] = (3, 24), repeat: int = 3) -> List[dict]:
+    """
+    Color replacement: single pass (replace_colors_in_image) vs one pass per color
+    :param sizes: image sizes in megapixels
+    :param palettes: numbers of colors to replace
+    :param repeat:
+    :return:
+    """
+    results = []
+    for size in sizes:
+        image = scanned_image(size)
+        for palette in palettes:
+            replacements = {rgb_to_hex((0xf0 - i, 0xf0 - i, 0xf0 - i)): '#ffffff' for i in range(palette)}
+            loop_time = timeit(lambda: replace_colors_loop(image, replacements), repeat)
+            lut_time = timeit(lambda: replace_colors_in_image(image, replacements), repeat)
+            tolerance_time = timeit(lambda: replace_colors_in_image(image, replacements, tolerance=4), repeat)
+            results.append({
+                'megapixels': size,
+                'colors': palette,
+                'loop_s': round(loop_time, 4),
+                'single_pass_s': round(lut_time, 4),
+                'single_pass_tolerance_s': round(tolerance_time, 4),
+                'speedup': round(loop_time / lut_time, 2),
+            })
+    return results
+
+
+def max_rss() -> int:
+    """Peak resident set size of the current process in bytes (unix only)."""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _opencv_peak_memory(megapixels: float, tile_height: int = None) -> dict:
+    """Runs in a fresh process: peak memory used by remove_watermark_from_cv_image on top of its input."""
+    img = scanned_array(megapixels)  # gray levels: same as BGR
+    before = max_rss()
+    start = time.perf_counter()
+    remove_watermark_from_cv_image(img, tile_height)
+    elapsed = time.perf_counter() - start
+    return {
+        'input_mb': round(img.nbytes / 2 ** 20, 1),
+        'extra_peak_rss_mb': round((max_rss() - before) / 2 ** 20, 1),
+        'seconds': round(elapsed, 3),
+    }
+
+
+def memory(megapixels: float = 100, tile_height: int = 256) -> dict:
+    """
+    Peak memory (RSS) of remove_watermark_from_cv_image on the whole image vs by strips
+    :param megapixels:
+    :param tile_height:
+    :return:
+    """
+    results = {}
+    for name, height in (('whole_image', None), (f'strips_of_{tile_height}_rows', tile_height)):
+        # a fresh process per mode, otherwise the peak of the first mode hides the second one
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[name] = executor.submit(_opencv_peak_memory, megapixels, height).result()
+    return results
+
+
+def replace_images_in_zip_stored(in_zip: Path, out_zip: Path, replacements: Dict[str, io.BytesIO]) -> Path:
+    """Every entry decompressed and written uncompressed (before copy_zip_entry)."""
+    with zipfile.ZipFile(in_zip, 'r') as zin:
+        with zipfile.ZipFile(out_zip, 'w') as zout:
+            zout.comment = zin.comment
+            for item in zin.infolist():
+                with zout.open(item.filename, 'w') as f:
+                    if item.filename not in replacements.keys():
+                        f.write(zin.read(item.filename))
+                    else:
+                        f.write(replacements[item.filename].getvalue())
+    return out_zip
+
+
+def docx_file(path: Path, images: int = 10, megapixels: float = 1, paragraphs: int = 20000) -> Path:
+    """Minimal docx with some text and images in word/media/."""
+    def entry(name: str) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(name, date_time=FIXTURE_DATE_TIME)  # same bytes on every run
+        info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr(entry('[Content_Types].xml'), '<?xml version="1.0"?><Types/>')
+        z.writestr(entry('word/document.xml'), '<w:document><w:body>' + ''.join(
+            f'<w:p><w:r><w:t>Paragraph {i} of the document.</w:t></w:r></w:p>' for i in range(paragraphs)
+        ) + '</w:body></w:document>')
+        for i in range(images):
+            image_file = io.BytesIO()
+            scanned_image(megapixels, seed=i).save(image_file, format='PNG')
+            z.writestr(entry(f'word/media/image{i}.png'), image_file.getvalue())
+    return path
+
+
+def zip_rewrite(images: int = 20, megapixels: float = 1, repeat: int = 3) -> dict:
+    """
+    Rewriting a docx: replace_images_in_zip vs decompressing everything into stored entries
+    :param images:
+    :param megapixels: size of each image
+    :param repeat:
+    :return:
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        docx_path = docx_file(Path(tmp_dir) / 'input.docx', images, megapixels)
+        with zipfile.ZipFile(docx_path) as z:
+            replacements = {name: io.BytesIO(z.read(name)) for name in z.namelist() if name.startswith('word/media/')}
+        stored_path, copied_path = Path(tmp_dir) / 'stored.docx', Path(tmp_dir) / 'copied.docx'
+        stored_time = timeit(lambda: replace_images_in_zip_stored(docx_path, stored_path, replacements), repeat)
+        copied_time = timeit(lambda: replace_images_in_zip(docx_path, copied_path, replacements), repeat)
+        return {
+            'input_kb': docx_path.stat().st_size // 1024,
+            'stored_kb': stored_path.stat().st_size // 1024,
+            'stored_s': round(stored_time, 4),
+            'replace_images_in_zip_kb': copied_path.stat().st_size // 1024,
+            'replace_images_in_zip_s': round(copied_time, 4),
+        }
+
+
+def prefilter(pages: int = 500, clean_ratio: float = 0.9, lines: int = 40, repeat: int = 3) -> dict:
+    """
+    GEOS pdf with and without the prefilter skipping the pages without signatures, fails if the clean pages are not
+    skipped, if a skipped page is not identical to the input or if a rewritten page differs from the one rewritten
+    without prefilter (PREFILTER_CASES are added at the end of the pdf)
+    :param pages:
+    :param clean_ratio: part of the pages without watermark
+    :param lines: lines of text per page
+    :param repeat:
+    :return:
+    """
+    from instrumentation import instrument
+    from main import remove_watermark_from_geos_pdf, page_content
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = geos_pdf(Path(tmp_dir) / 'input.pdf', pages, lines, clean_ratio)
+        with Pdf.open(input_path, allow_overwriting_input=True) as pdf:
+            for content, _ in PREFILTER_CASES:
+                pdf.add_blank_page(page_size=(612, 792)).Contents = pdf.make_stream(content)
+            pdf.save(input_path, deterministic_id=True)
+        skipped = [not geos_watermarked(i, clean_ratio) for i in range(pages)] + \
+                  [case_skipped for _, case_skipped in PREFILTER_CASES]
+        output_paths = {True: Path(tmp_dir) / 'prefilter.pdf', False: Path(tmp_dir) / 'no_prefilter.pdf'}
+        times = {enabled: timeit(lambda: remove_watermark_from_geos_pdf(input_path, path, prefilter=enabled), repeat)
+                 for enabled, path in output_paths.items()}
+        with instrument('prefilter', export=False) as report:
+            remove_watermark_from_geos_pdf(input_path, output_paths[True])
+        assert report.counters['pages_skipped'] == sum(skipped), \
+            f"{report.counters['pages_skipped']} pages skipped instead of {sum(skipped)}"
+        with Pdf.open(input_path) as pdf_in, Pdf.open(output_paths[True]) as pdf_out, \
+                Pdf.open(output_paths[False]) as pdf_reference:
+            for page_number, (page_in, page_out, page_reference, page_skipped) in enumerate(
+                    zip(pdf_in.pages, pdf_out.pages, pdf_reference.pages, skipped), 1):
+                content_in, content_out = page_in.obj.Contents, page_out.obj.Contents
+                if page_skipped:
+                    assert content_out.objgen == content_in.objgen and \
+                           content_out.read_raw_bytes() == content_in.read_raw_bytes(), \
+                           f"skipped page {page_number} was modified"
+                else:
+                    assert page_content(page_out) == page_content(page_reference), f"page {page_number} differs"
+    return {
+        'pages': len(skipped),
+        'pages_skipped': report.counters['pages_skipped'],
+        'pages_rewritten': report.counters['pages_rewritten'],
+        'prefilter_s': round(times[True], 4),
+        'no_prefilter_s': round(times[False], 4),
+        'speedup': round(times[False] / times[True], 2),
+    }
+
+
+def parallel(pages: int = 200, workers: int = 4, clean_ratio: float = 0.5) -> dict:
+    """
+    GEOS pdf cleaned in-process and by worker processes (from a file and from memory), fails if the content stream of
+    any page differs
+    :param pages:
+    :param workers:
+    :param clean_ratio: part of the pages without watermark
+    :return:
+    """
+    from main import remove_watermark_from_geos_pdf, page_content
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = geos_pdf(Path(tmp_dir) / 'input.pdf', pages, clean_ratio=clean_ratio)
+        serial_path, parallel_path = Path(tmp_dir) / 'serial.pdf', Path(tmp_dir) / 'parallel.pdf'
+        times = {'serial_s': timeit(lambda: remove_watermark_from_geos_pdf(input_path, serial_path), 1),
+                 'parallel_s': timeit(lambda: remove_watermark_from_geos_pdf(input_path, parallel_path, workers), 1)}
+        in_memory = io.BytesIO()
+        remove_watermark_from_geos_pdf(io.BytesIO(input_path.read_bytes()), in_memory, workers)
+        in_memory.seek(0)
+        with Pdf.open(serial_path) as serial, Pdf.open(parallel_path) as parallel_pdf, Pdf.open(in_memory) as memory:
+            assert len(serial.pages) == len(parallel_pdf.pages) == len(memory.pages) == pages
+            for page_number, (serial_page, parallel_page, memory_page) in enumerate(
+                    zip(serial.pages, parallel_pdf.pages, memory.pages), 1):
+                content = page_content(serial_page)
+                assert page_content(parallel_page) == content, f"page {page_number} differs with {workers} workers"
+                assert page_content(memory_page) == content, \
+                    f"page {page_number} differs with {workers} workers from memory"
+    return {'pages': pages, 'workers': workers, 'identical': True, **{k: round(v, 4) for k, v in times.items()}}
+
+
+def save_profiles(pages: int = 1000, raster_pages: int = 20, megapixels: float = 1, repeat: int = 3) -> List[dict]:
+    """
+    Save time (pdf_save stage of main) and output size of every save profile on big GEOS and scanned pdf
+    :param pages: pages of the GEOS pdf (half of them watermarked)
+    :param raster_pages: pages of the scanned pdf
+    :param megapixels: size of the images of the scanned pdf
+    :param repeat: the best save time is reported
+    :return:
+    """
+    from encoding import SaveProfile
+    from instrumentation import instrument
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fixtures = [
+            (geos_pdf(Path(tmp_dir) / 'geos.pdf', pages, clean_ratio=0.5), MethodChoice.geos),
+            (raster_pdf(Path(tmp_dir) / 'raster.pdf', raster_pages, megapixels), MethodChoice.openCV2),
+        ]
+        for input_path, method_choice in fixtures:
+            for save_profile in SaveProfile:
+                output_path = Path(tmp_dir) / f'output_{save_profile.name}.pdf'
+                best = float('inf')
+                for _ in range(repeat):
+                    with instrument(str(input_path), export=False) as report:
+                        main(input_path, output_path, method_choice, save_profile=save_profile)
+                    best = min(best, report.stages['pdf_save'].wall_seconds)
+                with Pdf.open(output_path) as pdf:
+                    linearized = pdf.is_linearized
+                results.append({
+                    'pdf': f'{input_path.name} ({method_choice.name})',
+                    'save_profile': save_profile.name,
+                    'input_kb': input_path.stat().st_size // 1024,
+                    'output_kb': output_path.stat().st_size // 1024,
+                    'save_s': round(best, 4),
+                    'linearized': linearized,
+                })
+    return results
+
+
+def stamped_pdf(path: Path, pages: int = 50, megapixels: float = 1) -> Path:
+    """PDF of scanned pages with a light gray stamp at the same position on every page."""
+    pdf = Pdf.new()
+    for i in range(pages):
+        data = scanned_array(megapixels, seed=i)
+        height, width = data.shape[:2]
+        stamp = data[height // 3:height // 3 + height // 10, width // 4:3 * width // 4]
+        stamp[::3] = 0xd0  # text-like stripes of the stamp
+        stamp[:, ::7] = 0xd0
+        image = pdf.make_stream(zlib.compress(data.tobytes()), Type=Name.XObject, Subtype=Name.Image, Width=width,
+                                Height=height, ColorSpace=Name.DeviceRGB, BitsPerComponent=8, Filter=Name.FlateDecode)
+        page = pdf.add_blank_page(page_size=(612, 792))
+        page.Resources = Dictionary(XObject=Dictionary(Im0=image))
+        page.Contents = pdf.make_stream(b"q 612 0 0 792 0 0 cm /Im0 Do Q")
+    pdf.save(path, deterministic_id=True)
+    return path
+
+
+def template(pages: int = 50, megapixels: float = 4, repeat: int = 3) -> dict:
+    """
+    OpenCV2 time per page of a scanned pdf with a stamp at a fixed position, with a learnt template vs without
+    :param pages:
+    :param megapixels: size of the images
+    :param repeat: the best time is reported
+    :return:
+    """
+    from pikepdf import PdfImage
+    from instrumentation import instrument
+    from template import WatermarkTemplate
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = stamped_pdf(Path(tmp_dir) / 'stamped.pdf', pages, megapixels)
+        for name in ('full', 'template'):
+            best = float('inf')
+            for _ in range(repeat):
+                learnt = WatermarkTemplate() if name == 'template' else None
+                with instrument(name, export=False) as report:
+                    main(input_path, Path(tmp_dir) / f'{name}.pdf', MethodChoice.openCV2, template=learnt)
+                best = min(best, report.stages['opencv'].wall_seconds)
+            times[name] = best
+        # the bounding box of the template is cleaned as without template
+        top, bottom, left, right = learnt.bbox
+        with Pdf.open(Path(tmp_dir) / 'full.pdf') as full, Pdf.open(Path(tmp_dir) / 'template.pdf') as templated:
+            for full_page, template_page in zip(full.pages, templated.pages):
+                full_image, template_image = (np.array(PdfImage(page.images['/Im0']).as_pil_image())
+                                              for page in (full_page, template_page))
+                assert np.array_equal(full_image[top:bottom, left:right], template_image[top:bottom, left:right])
+    return {
+        'pages': pages,
+        'megapixels': megapixels,
+        'bbox_ratio': round(learnt.mask.size / (learnt.shape[0] * learnt.shape[1]), 3),
+        'applied': report.counters['template_applied'],
+        'fallbacks': report.counters['template_fallbacks'],
+        'full_ms_per_page': round(times['full'] / pages * 1000, 3),
+        'template_ms_per_page': round(times['template'] / pages * 1000, 3),
+        'speedup': round(times['full'] / times['template'], 2),
+    }
+
+
+def jpeg_pdf(path: Path, jpeg: Path) -> Path:
+    """PDF with a JPEG image as it is (DCTDecode) on a single page."""
+    with Image.open(jpeg) as image:
+        width, height = image.size
+    pdf = Pdf.new()
+    image = pdf.make_stream(jpeg.read_bytes(), Type=Name.XObject, Subtype=Name.Image, Width=width, Height=height,
+                            ColorSpace=Name.DeviceRGB, BitsPerComponent=8, Filter=Name.DCTDecode)
+    page = pdf.add_blank_page(page_size=(612, 792))
+    page.Resources = Dictionary(XObject=Dictionary(Im0=image))
+    page.Contents = pdf.make_stream(b"q 612 0 0 792 0 0 cm /Im0 Do Q")
+    pdf.save(path, deterministic_id=True)
+    return path
+
+
+def preview_times(megapixels: float = 100, repeat: int = 3) -> List[dict]:
+    """
+    Preview of a big scan (see preview.py) vs decoding it at full resolution
+    :param megapixels:
+    :param repeat: the best time is reported
+    :return:
+    """
+    from preview import preview
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        jpeg = image_file(Path(tmp_dir) / 'scan.jpg', megapixels)
+        fixtures = [jpeg, image_file(Path(tmp_dir) / 'scan.png', megapixels),
+                    jpeg_pdf(Path(tmp_dir) / 'scan.pdf', jpeg)]
+        for input_path in fixtures:
+            def full_decode():
+                with Image.open(jpeg if input_path.suffix == '.pdf' else input_path) as image:
+                    image.load()
+            full_s = timeit(full_decode, repeat)
+            for method_choice in (MethodChoice.openCV2, MethodChoice.colors_replacement):
+                result = preview(input_path, method_choice)
+                results.append({
+                    'file': input_path.name,
+                    'method': method_choice.name,
+                    'full_size': result.full_size,
+                    'preview_size': result.before.size,
+                    'preview_s': round(timeit(lambda: preview(input_path, method_choice), repeat), 3),
+                    'full_decode_s': round(full_s, 3),
+                })
+    return results
+
+
+# modules that must not be imported by "import main": they are imported by the code paths using them
+LAZY_MODULES = ('cv2', 'numpy', 'PIL', 'pikepdf', 'fire', 'sentry_sdk')
+
+
+def parse_importtime(stderr: str, module: str) -> Dict[str, int]:
+    """
+    Cumulative import times in microseconds of a "python -X importtime" report
+    :param stderr: report
+    :param module: imported module
+    :return: {module: time, modules imported directly by module: time}
+    """
+    entries = []  # (name, cumulative, depth) in the order of the report: a module comes after its own imports
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((name.strip(), int(cumulative), (len(name) - len(name.lstrip())) // 2))
+    index = max(i for i, (name, _, _) in enumerate(entries) if name == module)
+    depth = entries[index][2]
+    times = {module: entries[index][1]}
+    for name, cumulative, child_depth in reversed(entries[:index]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 1:
+            times[name] = cumulative
+    return times
+
+
+def startup(module: str = 'main', repeat: int = 5, top: int = 10, budget_ms: float = None) -> dict:
+    """
+    Import time of a module in a fresh interpreter (python -X importtime), fails if it imports OpenCV or other heavy
+    modules (LAZY_MODULES)
+    :param module: main, batch, ...
+    :param repeat: the best run is reported
+    :param top: number of slowest imports of module reported
+    :param budget_ms: fail if the import of module takes longer
+    :return:
+    """
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             f'import sys, {module}; print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'],
+            capture_output=True, text=True, check=True, cwd=Path(__file__).parent)
+        times = parse_importtime(completed.stderr, module)
+        if best is None or times[module] < best[0][module]:
+            best = times, completed.stdout.strip()
+    times, loaded = best
+    slowest = sorted(((name, t) for name, t in times.items() if name != module), key=lambda x: x[1], reverse=True)
+    result = {
+        'module': module,
+        'import_ms': round(times[module] / 1000, 1),
+        'slowest_imports_ms': {name: round(t / 1000, 1) for name, t in slowest[:top]},
+        'heavy_modules_loaded': loaded.split(',') if loaded else [],
+    }
+    if result['heavy_modules_loaded']:
+        raise AssertionError(f"import {module} loads {result['heavy_modules_loaded']}: {result}")
+    if budget_ms is not None and result['import_ms'] > budget_ms:
+        raise AssertionError(f"import {module} takes {result['import_ms']} ms (budget {budget_ms} ms): {result}")
+    return result
+
+
+# sizes of the generated fixtures of each profile of the suite
+SUITE_PROFILES = {
+    'quick': {'geos_pages': [10, 100], 'raster_pages': [5], 'docx_images': [5], 'megapixels': [1, 10]},
+    'full': {'geos_pages': [10, 100, 1000], 'raster_pages': [5, 50], 'docx_images': [5, 50],
+             'megapixels': [1, 10, 50, 200]},
+}
+SUITE_RESULTS_VERSION = 1
+# Pillow refuses to open images above ~179 megapixels (decompression bomb check): the full profile has 200 megapixels
+# images, the limit is raised in the processes of the suite
+SUITE_MAX_IMAGE_PIXELS = 300_000_000
+SUITE_THRESHOLD = 0.15  # relative slowdown (or memory increase) reported as a regression by compare
+
+
+def geos_pdf(path: Path, pages: int = 100, lines: int = 40, clean_ratio: float = 0) -> Path:
+    """
+    PDF looking like the ones exported from GEOS apps: "VERSION EVALUATION" Tj runs and "Trial - " TJ arrays
+    :param path:
+    :param pages:
+    :param lines: lines of text per page
+    :param clean_ratio: part of the pages without watermark (spread across the pdf)
+    :return:
+    """
+    pdf = Pdf.new()
+    font = pdf.make_indirect(Dictionary(Type=Name.Font, Subtype=Name.Type1, BaseFont=Name.Helvetica))
+    for i in range(pages):
+        page = pdf.add_blank_page(page_size=(612, 792))
+        page.Resources = Dictionary(Font=Dictionary(F1=font))
+        page.Contents = pdf.make_stream(geos_page_content(i, lines, geos_watermarked(i, clean_ratio)))
+    pdf.save(path, deterministic_id=True)
+    return path
+
+
+def raster_pdf(path: Path, pages: int = 5, megapixels: float = 1) -> Path:
+    """PDF of scanned pages: one lossless image per page."""
+    pdf = Pdf.new()
+    for i in range(pages):
+        data = scanned_array(megapixels, seed=i)
+        height, width = data.shape[:2]
+        image = pdf.make_stream(zlib.compress(data.tobytes()), Type=Name.XObject, Subtype=Name.Image, Width=width,
+                                Height=height, ColorSpace=Name.DeviceRGB, BitsPerComponent=8, Filter=Name.FlateDecode)
+        page = pdf.add_blank_page(page_size=(612, 792))
+        page.Resources = Dictionary(XObject=Dictionary(Im0=image))
+        page.Contents = pdf.make_stream(b"q 612 0 0 792 0 0 cm /Im0 Do Q")
+    pdf.save(path, deterministic_id=True)
+    return path
+
+
+def image_file(path: Path, megapixels: float = 1) -> Path:
+    """PNG or JPEG (from the suffix of path) of a scanned page."""
+    scanned_image(megapixels).save(path)
+    return path
+
+
+def suite_cases(profile: str = 'quick') -> List[dict]:
+    """
+    Fixtures and methods timed by the suite
+    :param profile: quick or full (see SUITE_PROFILES)
+    :return: [{'case', 'fixture', 'make', 'method_choice', 'unit', 'units'}]: make(path) generates the fixture
+    """
+    sizes = SUITE_PROFILES[profile]
+    fixtures = []  # (fixture file name, make, methods, unit, units)
+    for pages in sizes['geos_pages']:
+        fixtures.append((f'geos_{pages}p.pdf', partial(geos_pdf, pages=pages), [MethodChoice.geos], 'pages', pages))
+    for pages in sizes['raster_pages']:
+        fixtures.append((f'raster_{pages}p.pdf', partial(raster_pdf, pages=pages),
+                         [MethodChoice.openCV2, MethodChoice.colors_replacement], 'pages', pages))
+    for images in sizes['docx_images']:
+        fixtures.append((f'docx_{images}img.docx', partial(docx_file, images=images, paragraphs=2000),
+                         [MethodChoice.openCV2, MethodChoice.colors_replacement], 'images', images))
+    for megapixels in sizes['megapixels']:
+        for suffix in ('png', 'jpg'):
+            fixtures.append((f'{suffix}_{megapixels}mp.{suffix}', partial(image_file, megapixels=megapixels),
+                             [MethodChoice.openCV2, MethodChoice.colors_replacement], 'megapixels', megapixels))
+    return [{'case': f'{fixture}/{method.name}', 'fixture': fixture, 'make': make, 'method_choice': method.name,
+             'unit': unit, 'units': units}
+            for fixture, make, methods, unit, units in fixtures for method in methods]
+
+
+def _time_main(input_file: str, output_file: str, method_choice: str, repeat: int, options: dict) -> dict:
+    """Runs in a fresh process: best time of main on a fixture, peak memory and stages of the last run."""
+    from instrumentation import instrument
+    from server import warm_up
+    warm_up()  # imports are not part of the timings
+    Image.MAX_IMAGE_PIXELS = SUITE_MAX_IMAGE_PIXELS
+    before = max_rss()
+    best = float('inf')
+    for _ in range(repeat):
+        with instrument(input_file, export=False) as report:
+            main(input_file, output_file, MethodChoice.from_str(method_choice), **options)
+        best = min(best, report.wall_seconds)
+    return {
+        'seconds': best,
+        'peak_rss_mb': round((max_rss() - before) / 2 ** 20, 1),
+        'stages_s': {name: round(stats.wall_seconds, 4) for name, stats in report.stages.items() if name != 'main'},
+    }
+
+
+def suite(profile: str = 'quick', cases: List[str] = None, repeat: int = 3, fixtures_dir: str = None,
+          output: str = None, baseline: str = None, threshold: float = SUITE_THRESHOLD, **options) -> dict:
+    """
+    Time every method on generated fixtures of every format (GEOS pdf, scanned pdf, docx, png, jpeg)
+    :param profile: quick or full (up to 1000 pages pdf and 200 megapixels images, see SUITE_PROFILES and
+    SUITE_MAX_IMAGE_PIXELS)
+    :param cases: only run the cases containing one of these strings (e.g. geos, docx, png_10mp.png/openCV2), a list or
+    a comma separated string
+    :param repeat: the best run of each case is reported
+    :param fixtures_dir: keep the fixtures in this directory and reuse them (default: generated in a temp directory)
+    :param output: save the results to this JSON file
+    :param baseline: results of a previous run, compared to these ones (see compare)
+    :param threshold: see compare
+    :param options: other arguments of main (workers, preset, binarize, ...)
+    :return: results: throughput and peak memory (RSS on top of the imported modules) of every case
+    """
+    all_cases = suite_cases(profile)
+    if isinstance(cases, str):
+        cases = [name.strip() for name in cases.split(',') if name.strip()]
+    unknown = [name for name in cases or [] if not any(name in case['case'] for case in all_cases)]
+    if unknown:
+        raise ValueError(f"Unknown cases: {', '.join(unknown)}, cases of the {profile} profile: "
+                         f"{', '.join(case['case'] for case in all_cases)}")
+    selected = [case for case in all_cases if not cases or any(name in case['case'] for name in cases)]
+    Image.MAX_IMAGE_PIXELS = SUITE_MAX_IMAGE_PIXELS  # fixtures generated in this process
+    results = []
+    with tempfile.TemporaryDirectory(prefix='watermark-benchmark-') as tmp_dir:
+        fixtures_path = Path(fixtures_dir or tmp_dir)
+        fixtures_path.mkdir(parents=True, exist_ok=True)
+        for case in selected:
+            input_path = fixtures_path / case['fixture']
+            if not input_path.exists():
+                case['make'](input_path)
+            output_path = Path(tmp_dir) / f"output_{case['fixture']}"
+            # a fresh process per case: the peak memory of a case does not hide the next ones
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                timing = executor.submit(_time_main, str(input_path), str(output_path), case['method_choice'],
+                                         repeat, options).result()
+            input_mb = input_path.stat().st_size / 2 ** 20
+            results.append({
+                'case': case['case'],
+                'method_choice': case['method_choice'],
+                'input_mb': round(input_mb, 3),
+                'output_mb': round(output_path.stat().st_size / 2 ** 20, 3),
+                'seconds': round(timing['seconds'], 4),
+                'throughput': round(case['units'] / timing['seconds'], 2),
+                'unit': f"{case['unit']}/s",
+                'mb_per_s': round(input_mb / timing['seconds'], 2),
+                'peak_rss_mb': timing['peak_rss_mb'],
+                'stages_s': timing['stages_s'],
+            })
+            logger.info(f"{case['case']}: {results[-1]['seconds']} s")
+    data = {
+        'version': SUITE_RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'profile': profile,
+        'repeat': repeat,
+        'options': options,
+        'results': results,
+    }
+    if output:
+        Path(output).write_text(json.dumps(data, indent=2), encoding='utf-8')
+    if baseline:
+        data['comparison'] = compare(baseline, data, threshold)
+    return data
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _load_results(results: Union[str, Path, dict]) -> dict:
+    if isinstance(results, dict):
+        return results
+    data = json.loads(Path(results).read_text(encoding='utf-8'))
+    if data.get('version') != SUITE_RESULTS_VERSION:
+        raise ValueError(f"{results}: results version {data.get('version')}, expected {SUITE_RESULTS_VERSION}")
+    return data
+
+
+def compare(baseline: Union[str, dict], current: Union[str, dict], threshold: float = SUITE_THRESHOLD,
+            memory_threshold: float = None, min_seconds: float = 0.01) -> dict:
+    """
+    Compare the results of two runs of the suite, fails if a case regressed
+    :param baseline: results (JSON file saved by suite --output)
+    :param current: results
+    :param threshold: max relative slowdown of a case (0.15: 15% slower)
+    :param memory_threshold: max relative increase of the peak memory of a case (default: threshold)
+    :param min_seconds: cases faster than this in both runs are not compared (noise)
+    :return: {'regressions', 'improvements', 'missing', 'new', 'cases': {case: {'seconds', 'peak_rss_mb'}}}
+    """
+    baseline, current = _load_results(baseline), _load_results(current)
+    memory_threshold = threshold if memory_threshold is None else memory_threshold
+    baseline_results = {result['case']: result for result in baseline['results']}
+    current_results = {result['case']: result for result in current['results']}
+    comparison = {
+        'regressions': [],
+        'improvements': [],
+        'missing': sorted(set(baseline_results) - set(current_results)),
+        'new': sorted(set(current_results) - set(baseline_results)),
+        'cases': {},
+    }
+    for case, result in current_results.items():
+        before = baseline_results.get(case)
+        if before is None:
+            continue
+        time_ratio = result['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        memory_ratio = (result['peak_rss_mb'] + 1) / (before['peak_rss_mb'] + 1)  # + 1 MB: no ratio of ~0
+        comparison['cases'][case] = {'seconds': f"{before['seconds']} -> {result['seconds']} ({time_ratio:.2f}x)",
+                                     'peak_rss_mb': f"{before['peak_rss_mb']} -> {result['peak_rss_mb']}"}
+        if max(result['seconds'], before['seconds']) >= min_seconds:
+            if time_ratio > 1 + threshold:
+                comparison['regressions'].append(f"{case}: {time_ratio:.2f}x slower")
+            elif time_ratio < 1 / (1 + threshold):
+                comparison['improvements'].append(f"{case}: {1 / time_ratio:.2f}x faster")
+        if memory_ratio > 1 + memory_threshold:
+            comparison['regressions'].append(f"{case}: {memory_ratio:.2f}x more memory")
+    if comparison['regressions']:
+        raise AssertionError(f"{len(comparison['regressions'])} regressions beyond {threshold:.0%}: "
+                             f"{json.dumps(comparison, indent=2)}")
+    return comparison
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'matcher': matcher,
+        'colors': colors,
+        'memory': memory,
+        'zip': zip_rewrite,
+        'startup': startup,
+        'prefilter': prefilter,
+        'parallel': parallel,
+        'save': save_profiles,
+        'template': template,
+        'preview': preview_times,
+        'suite': suite,
+        'compare': compare,
+    })
@@ -102,6 +102,7 @@ def build_app(info: dict, dirmode):
     pprint.pprint(info)
     # add file assets
     theme_dir = BASE_DIR / "resources" / "theme"
+    signatures_file = BASE_DIR / "resources" / "signatures.json"
     env_file = BASE_DIR / 'vars.txt'
     if not theme_dir.exists():
         logger.warning(f'{theme_dir} not found.')
@@ -122,6 +123,8 @@ def build_app(info: dict, dirmode):
     if theme_dir.exists():
         # without this the theme will not be found and the app crashes here: ws.tk.call("source", "main.tcl")
         pi_args.append(f'--add-data={theme_dir}{info.get("add_data_separator")}{os.path.join("resources", "theme")}')
+    if signatures_file.exists():
+        pi_args.append(f'--add-data={signatures_file}{info.get("add_data_separator")}resources')
     if env_file.exists():
         pi_args.append(f'--add-data={env_file}{info.get("add_data_separator")}.')
     # build
@@ -0,0 +1,266 @@
+"""
+On-disk content-addressed cache of cleaned files and images, bounded in size (least recently used entries are evicted).
+
+Entries are keyed by the hash of their input and the parameters changing the output:
+- file: whole output of main (pdf, docx)
+- image: cleaned and encoded image of a docx or an image file
+- pdf_image: cleaned image of a pdf (lossless PNG, encoded again in the pdf)
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import Counter, OrderedDict
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from typing import BinaryIO, Dict, Optional, Union
+
+logger = getLogger(__name__)
+
+CACHE_VERSION = 4  # part of every key: bump it when the output of the cleaning changes
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_CHUNK_SIZE = 1024 * 1024
+CACHE_KINDS = ('file', 'image', 'pdf_image')
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(file: Union[str, Path, BinaryIO]) -> str:
+    """Hash of the content of a file (read by chunks), a file object is read from its start and rewound."""
+    digest = hashlib.sha256()
+    if not isinstance(file, (str, Path)):
+        file.seek(0)
+        for chunk in iter(lambda: file.read(CACHE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        file.seek(0)
+        return digest.hexdigest()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CACHE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(kind: str, input_hash: str, method_choice=None, **params) -> str:
+    """
+    Key of a cache entry
+    :param kind: file, image or pdf_image
+    :param input_hash: hash of the input (see content_hash and file_hash)
+    :param method_choice:
+    :param params: other parameters changing the output (None values are ignored)
+    :return:
+    """
+    method = method_choice.name if method_choice is not None else None
+    options = ';'.join(f"{name}={params[name]!r}" for name in sorted(params) if params[name] is not None)
+    return hashlib.sha256(f"{CACHE_VERSION};{kind};{input_hash};{method};{options}".encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Size-bounded cache of bytes in a directory, shared by the threads of a process.
+    Several processes can use the same directory: each one evicts the entries it knows of, the least recently used
+    first (the modification time of an entry is updated when it is read).
+    """
+
+    def __init__(self, directory: Union[str, Path], max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()  # key => size, least recently used first
+        self._size = 0
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = 0
+        self._lock = Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def __getstate__(self):
+        # sent to worker processes: they load the directory again
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['max_bytes'])
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def _load(self):
+        entries = []
+        for path in self.directory.glob('??/*'):
+            if path.suffix == '.tmp':
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def _hit(self, kind: str, key: str, path: Path):
+        try:
+            os.utime(path)
+            size = path.stat().st_size
+        except OSError:
+            size = 0
+        with self._lock:
+            self.hits[kind] += 1
+            if key not in self._entries:  # written by another process
+                self._entries[key] = size
+                self._size += size
+            self._entries.move_to_end(key)
+
+    def _miss(self, kind: str, key: str):
+        with self._lock:
+            self.misses[kind] += 1
+            self._size -= self._entries.pop(key, 0)  # evicted by another process
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes (call with the lock held)."""
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def _store(self, key: str, write) -> bool:
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+            tmp_path = Path(f.name)
+            write(f)
+        size = tmp_path.stat().st_size
+        if size > self.max_bytes:
+            tmp_path.unlink()
+            return False
+        os.replace(tmp_path, path)  # atomic: readers never see a partial entry
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+        return True
+
+    def get_bytes(self, kind: str, key: str) -> Optional[bytes]:
+        """
+        Content of an entry
+        :param kind: file, image or pdf_image (for the stats)
+        :param key: see cache_key
+        :return: None if the entry is not in the cache
+        """
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            self._miss(kind, key)
+            return None
+        self._hit(kind, key, path)
+        return data
+
+    def put_bytes(self, kind: str, key: str, data: bytes) -> bool:
+        """
+        Add an entry
+        :param kind:
+        :param key:
+        :param data:
+        :return: False if data is bigger than the cache
+        """
+        if len(data) > self.max_bytes:
+            return False
+        return self._store(key, lambda f: f.write(data))
+
+    def copy_to(self, kind: str, key: str, output_file: Union[str, Path]) -> bool:
+        """
+        Copy the content of an entry to output_file
+        :param kind:
+        :param key:
+        :param output_file:
+        :return: False if the entry is not in the cache
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, output_file)
+        except FileNotFoundError:
+            self._miss(kind, key)
+            return False
+        self._hit(kind, key, path)
+        return True
+
+    def put_file(self, kind: str, key: str, input_file: Union[str, Path]) -> bool:
+        """
+        Add an entry with the content of input_file
+        :param kind:
+        :param key:
+        :param input_file:
+        :return: False if the file is bigger than the cache
+        """
+        if os.path.getsize(input_file) > self.max_bytes:
+            return False
+
+        def write(f):
+            with open(input_file, 'rb') as fin:
+                shutil.copyfileobj(fin, f, CACHE_CHUNK_SIZE)
+        return self._store(key, write)
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Statistics of the cache in this process
+        :return: {'hits': {kind: int}, 'misses': {kind: int}, 'evictions': int, 'entries': int, 'bytes': int}
+        """
+        with self._lock:
+            return {
+                'hits': {kind: self.hits[kind] for kind in CACHE_KINDS},
+                'misses': {kind: self.misses[kind] for kind in CACHE_KINDS},
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+            self.evictions = 0
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            for key in self._entries:
+                try:
+                    self._path(key).unlink()
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._size = 0
+
+
+_CACHES: Dict[str, ResultCache] = {}
+_CACHES_LOCK = Lock()
+
+
+def open_cache(cache: Union[str, Path, ResultCache, None], max_bytes: int = None) -> Optional[ResultCache]:
+    """
+    Cache of a directory, the same instance is returned for the same directory (stats are kept across calls)
+    :param cache: directory of the cache, a ResultCache or None (no cache)
+    :param max_bytes: size of the cache (default: 1 GB)
+    :return:
+    """
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    directory = str(Path(cache).resolve())
+    with _CACHES_LOCK:
+        if directory not in _CACHES:
+            _CACHES[directory] = ResultCache(directory, max_bytes or CACHE_MAX_BYTES)
+        elif max_bytes and _CACHES[directory].max_bytes != max_bytes:
+            result_cache = _CACHES[directory]
+            with result_cache._lock:
+                result_cache.max_bytes = max_bytes
+                result_cache._evict()
+        return _CACHES[directory]
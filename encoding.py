@@ -0,0 +1,307 @@
+"""
+Encoding of cleaned images: keeps the source format, with presets trading encode speed for output size.
+Save profiles of pdf: object streams, recompression of the streams and linearization.
+"""
+
+import io
+import time
+import zlib
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from pikepdf import Pdf, PdfImage, Stream, Name, Dictionary, Array, ObjectStreamMode, StreamDecodeLevel
+
+from instrumentation import stage
+
+
+class EncodePreset(Enum):
+    default = "Default"
+    fast = "Fast"
+    small = "Small"
+
+    @staticmethod
+    def from_str(label):
+        if label in ('default',):
+            return EncodePreset.default
+        elif label in ('fast',):
+            return EncodePreset.fast
+        elif label in ('small',):
+            return EncodePreset.small
+        else:
+            raise NotImplementedError
+
+
+# save options of Pillow by preset and format
+PRESET_OPTIONS = {
+    EncodePreset.default: {
+        'JPEG': {'quality': 90},
+        'PNG': {'compress_level': 6},
+    },
+    EncodePreset.fast: {
+        'JPEG': {'quality': 85, 'subsampling': 2, 'optimize': False},
+        'PNG': {'compress_level': 1},
+    },
+    EncodePreset.small: {
+        'JPEG': {'quality': 75, 'subsampling': 2, 'optimize': True},
+        'PNG': {'compress_level': 9, 'optimize': True},
+    },
+}
+# zlib level of pdf images by preset
+PRESET_FLATE_LEVELS = {
+    EncodePreset.default: 6,
+    EncodePreset.fast: 1,
+    EncodePreset.small: 9,
+}
+
+
+class SaveProfile(Enum):
+    default = "Default"
+    fast = "Fast"
+    compact = "Compact"
+    web = "Web"
+
+    @staticmethod
+    def from_str(label):
+        if label in ('default',):
+            return SaveProfile.default
+        elif label in ('fast',):
+            return SaveProfile.fast
+        elif label in ('compact',):
+            return SaveProfile.compact
+        elif label in ('web',):
+            return SaveProfile.web
+        else:
+            raise NotImplementedError
+
+
+# options of Pdf.save by save profile
+# stream_decode_level none: compressed streams are copied as they are (never decoded nor encoded again), streams
+# without compression (new content streams, ASCIIHex, ...) are still compressed with compress_streams
+SAVE_PROFILE_OPTIONS = {
+    SaveProfile.default: {},  # defaults of pikepdf
+    SaveProfile.fast: {
+        'object_stream_mode': ObjectStreamMode.preserve,
+        'compress_streams': True,
+        'stream_decode_level': StreamDecodeLevel.none,
+        'recompress_flate': False,
+    },
+    SaveProfile.compact: {
+        'object_stream_mode': ObjectStreamMode.generate,
+        'compress_streams': True,
+        'stream_decode_level': StreamDecodeLevel.generalized,
+        'recompress_flate': True,
+    },
+    SaveProfile.web: {
+        'object_stream_mode': ObjectStreamMode.generate,
+        'compress_streams': True,
+        'stream_decode_level': StreamDecodeLevel.none,
+        'recompress_flate': False,
+        'linearize': True,
+    },
+}
+# pdf color space and bits per component by mode of the cleaned image
+PDF_IMAGE_MODES = {
+    '1': (Name.DeviceGray, 1),
+    'L': (Name.DeviceGray, 8),
+    'RGB': (Name.DeviceRGB, 8),
+    'CMYK': (Name.DeviceCMYK, 8),
+}
+# formats Pillow can write back, others are saved as PNG
+WRITABLE_FORMATS = ('PNG', 'JPEG', 'GIF', 'BMP', 'TIFF', 'WEBP')
+
+
+@dataclass
+class EncodeStats:
+    format: str
+    bytes_in: int  # size of the source image (0 if unknown)
+    bytes_out: int
+    seconds: float
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_in - self.bytes_out if self.bytes_in else 0
+
+    def __str__(self):
+        return f"{self.format} {self.bytes_in} => {self.bytes_out} bytes ({self.bytes_saved} saved) " \
+               f"in {self.seconds * 1000:.1f} ms"
+
+
+def as_preset(preset: Union[str, EncodePreset, None]) -> EncodePreset:
+    if isinstance(preset, str):
+        preset = EncodePreset.from_str(preset)
+    return preset or EncodePreset.default
+
+
+def as_save_profile(save_profile: Union[str, SaveProfile, None]) -> SaveProfile:
+    if isinstance(save_profile, str):
+        save_profile = SaveProfile.from_str(save_profile)
+    return save_profile or SaveProfile.default
+
+
+def save_pdf(pdf: Pdf, output_file, save_profile: Union[str, SaveProfile] = None):
+    """
+    Save a pdf with the options of a save profile
+    :param pdf:
+    :param output_file: path or file object
+    :param save_profile: default, fast (compressed streams copied as they are), compact (object streams, every
+    stream recompressed) or web (linearized for incremental loading, with object streams)
+    :return:
+    """
+    with stage('pdf_save'):
+        pdf.save(output_file, **SAVE_PROFILE_OPTIONS[as_save_profile(save_profile)])
+
+
+def output_format(source_format: Optional[str], image: Image.Image) -> str:
+    """Format used to save a cleaned image: the source format if it can store the image, PNG otherwise."""
+    image_format = (source_format or 'PNG').upper()
+    if image_format == 'JPG':
+        image_format = 'JPEG'
+    if image_format not in WRITABLE_FORMATS:
+        return 'PNG'
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L', '1', 'CMYK'):
+        return 'PNG' if image.mode in ('RGBA', 'LA', 'PA') else image_format
+    return image_format
+
+
+def encode_image(image: Image.Image, source_format: str = None, preset: Union[str, EncodePreset] = None,
+                 source_size: int = 0, quality: int = None, subsampling: int = None, compress_level: int = None,
+                 quantize: int = None, optimize: bool = None) -> Tuple[bytes, EncodeStats]:
+    """
+    Encode a cleaned image in the format of its source
+    :param image:
+    :param source_format: format of the source image (Pillow name, e.g. JPEG), PNG if unknown
+    :param preset: default, fast (encode speed) or small (output size)
+    :param source_size: size of the source image in bytes, to report the bytes saved
+    :param quality: JPEG quality (1-95)
+    :param subsampling: JPEG chroma subsampling: 0 (4:4:4), 1 (4:2:2) or 2 (4:2:0)
+    :param compress_level: PNG zlib level (0-9)
+    :param quantize: PNG palette size, the image is quantized (lossy) to at most quantize colors
+    :param optimize: JPEG/PNG optimize (slower, smaller)
+    :return: encoded image and stats
+    """
+    start = time.perf_counter()
+    preset = as_preset(preset)
+    image_format = output_format(source_format, image)
+    options = dict(PRESET_OPTIONS[preset].get(image_format, {}))
+    overrides = {'quality': quality, 'subsampling': subsampling, 'compress_level': compress_level,
+                 'optimize': optimize}
+    options.update({key: value for key, value in overrides.items() if value is not None})
+    if image_format == 'JPEG':
+        options.pop('compress_level', None)
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB' if image.mode not in ('1',) else 'L')
+    elif image_format == 'PNG':
+        for key in ('quality', 'subsampling'):
+            options.pop(key, None)
+        if quantize:
+            image = image.quantize(quantize) if image.mode in ('RGB', 'L', 'RGBA') else image
+        elif preset == EncodePreset.small and image.mode == 'RGB' and image.getcolors(256) is not None:
+            # lossless: the image has at most 256 colors
+            image = image.quantize(256, method=Image.MEDIANCUT)
+    else:
+        options = {}
+    image_file = io.BytesIO()
+    image.save(image_file, format=image_format, **options)
+    data = image_file.getvalue()
+    return data, EncodeStats(image_format, source_size, len(data), time.perf_counter() - start)
+
+
+def png_up_predict(data: bytes, row_bytes: int) -> bytes:
+    """
+    Apply the PNG "Up" predictor to every row (pdf /Predictor >= 10): line art compresses much better
+    :param data:
+    :param row_bytes:
+    :return: rows prefixed by their predictor
+    """
+    rows = np.frombuffer(data, dtype=np.uint8).reshape(-1, row_bytes)
+    predicted = np.empty((rows.shape[0], row_bytes + 1), dtype=np.uint8)
+    predicted[:, 0] = 2  # Up
+    predicted[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=predicted[1:, 1:])  # modulo 256
+    return predicted.tobytes()
+
+
+def is_line_art(image: Image.Image) -> bool:
+    """Black and white, or few colors (text, drawings, scanned documents without photos)."""
+    return image.mode == '1' or image.getcolors(16) is not None
+
+
+def encode_pdf_image(pdf: Pdf, raw_image: Stream, image: Image.Image, pdf_image: PdfImage = None,
+                     preset: Union[str, EncodePreset] = None, flate_level: int = None,
+                     quality: int = None) -> EncodeStats:
+    """
+    Write a cleaned image back into its pdf image XObject with a consistent image dictionary
+    - JPEG (DCT) images stay JPEG
+    - other images are compressed with zlib (flate_level), with PNG predictors for line art
+    - alpha is written to a /SMask only if the image has transparent pixels
+    :param pdf:
+    :param raw_image: image XObject
+    :param image: cleaned image
+    :param pdf_image: source image (PdfImage of raw_image before it was cleaned)
+    :param preset: default, fast or small
+    :param flate_level: zlib level (0-9), default from the preset
+    :param quality: JPEG quality, default from the preset
+    :return:
+    """
+    start = time.perf_counter()
+    preset = as_preset(preset)
+    pdf_image = pdf_image or PdfImage(raw_image)
+    bytes_in = len(raw_image.read_raw_bytes())
+    # transparency
+    alpha = None
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA') if image.mode != 'LA' else image
+        alpha = image.getchannel('A')
+        if alpha.getextrema() == (255, 255):  # fully opaque
+            alpha = None
+        image = image.convert('RGB' if image.mode == 'RGBA' else 'L')
+    if image.mode not in PDF_IMAGE_MODES:
+        image = image.convert('RGB')
+    if image.mode == 'RGB' and pdf_image.mode in ('L', '1'):
+        # gray source converted to RGB while cleaning: back to gray if no color was added
+        data = np.asarray(image)
+        if (data[..., 0] == data[..., 1]).all() and (data[..., 1] == data[..., 2]).all():
+            image = Image.fromarray(np.ascontiguousarray(data[..., 0]))
+    color_space, bits_per_component = PDF_IMAGE_MODES[image.mode]
+    if image.mode == pdf_image.mode and image.mode != 'P':
+        color_space = raw_image.get('/ColorSpace', color_space)  # keep ICC profiles, calibrated spaces, ...
+    elif '/Decode' in raw_image:
+        del raw_image['/Decode']
+    if '/DecodeParms' in raw_image:
+        del raw_image['/DecodeParms']
+    if isinstance(raw_image.get('/Mask'), Array):  # color key masking: the colors have changed
+        del raw_image['/Mask']
+    # data
+    if '/DCTDecode' in pdf_image.filters and image.mode in ('RGB', 'L', 'CMYK'):
+        image_file = io.BytesIO()
+        image.save(image_file, format='JPEG', **{'quality': quality or PRESET_OPTIONS[preset]['JPEG']['quality'],
+                                                 'subsampling': PRESET_OPTIONS[preset]['JPEG'].get('subsampling', -1)})
+        raw_image.write(image_file.getvalue(), filter=Name.DCTDecode)
+        image_format = 'JPEG'
+    else:
+        level = PRESET_FLATE_LEVELS[preset] if flate_level is None else flate_level
+        data = image.tobytes()
+        decode_parms = None
+        if is_line_art(image):
+            channels = len(image.getbands())
+            data = png_up_predict(data, (image.width * channels * bits_per_component + 7) // 8)
+            decode_parms = Dictionary(Predictor=15, Colors=channels, BitsPerComponent=bits_per_component,
+                                      Columns=image.width)
+        with stage('zlib'):
+            data = zlib.compress(data, level)
+        raw_image.write(data, filter=Name.FlateDecode, decode_parms=decode_parms)
+        image_format = 'Flate'
+    raw_image.Width = image.width
+    raw_image.Height = image.height
+    raw_image.ColorSpace = color_space
+    raw_image.BitsPerComponent = bits_per_component
+    if alpha is not None:
+        level = PRESET_FLATE_LEVELS[preset] if flate_level is None else flate_level
+        raw_image.SMask = Stream(pdf, zlib.compress(alpha.tobytes(), level), Type=Name.XObject,
+                                 Subtype=Name.Image, Width=alpha.width, Height=alpha.height,
+                                 ColorSpace=Name.DeviceGray, BitsPerComponent=8, Filter=Name.FlateDecode)
+    bytes_out = len(raw_image.read_raw_bytes())
+    return EncodeStats(image_format, bytes_in, bytes_out, time.perf_counter() - start)
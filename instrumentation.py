@@ -0,0 +1,313 @@
+"""
+Per-stage timing and counters of the removal pipeline.
+
+Nothing is recorded unless a report is active: stage() and count() only read a context variable otherwise.
+A report is active inside instrument(), and in every call to main / mmain once enable() was called (or with the
+WATERMARK_INSTRUMENTATION=1 environment variable).
+
+usage:
+with instrument('my batch') as report:
+    main('input.pdf', method_choice=MethodChoice.openCV2)
+print(report.to_dict())
+print(report.to_prometheus())
+
+If Sentry is initialized (see WatermarkRemover.py), every report is a Sentry transaction and every stage a span.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+logger = getLogger(__name__)
+
+METRICS_PREFIX = 'watermark_remover'
+
+_current_report: ContextVar[Optional['Report']] = ContextVar('watermark_report', default=None)
+_exporters: List[Callable[['Report'], None]] = []
+ENABLED = os.environ.get('WATERMARK_INSTRUMENTATION', '') not in ('', '0', 'false')
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0  # of the thread running the stage
+
+
+class Report:
+    """Time spent by stage, counters and signature hits of one or several calls to main."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages: Dict[str, StageStats] = {}
+        self.counters = Counter()  # pages, images, bytes_in, bytes_out, ...
+        self.signature_hits = Counter()
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.transaction = None  # Sentry transaction, if Sentry is initialized
+        self._lock = Lock()
+
+    def add_stage(self, name: str, wall_seconds: float, cpu_seconds: float, calls: int = 1):
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.calls += calls
+            stats.wall_seconds += wall_seconds
+            stats.cpu_seconds += cpu_seconds
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def count_hits(self, hits: Dict[str, int]):
+        with self._lock:
+            self.signature_hits.update(hits)
+
+    def merge(self, other: 'Report'):
+        """Add the stages and counters of another report (of a worker process for example)."""
+        for name, stats in other.stages.items():
+            self.add_stage(name, stats.wall_seconds, stats.cpu_seconds, stats.calls)
+        with self._lock:
+            self.counters.update(other.counters)
+            self.signature_hits.update(other.signature_hits)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'name': self.name,
+                'wall_seconds': round(self.wall_seconds, 6),
+                'cpu_seconds': round(self.cpu_seconds, 6),
+                'stages': {name: {'calls': stats.calls, 'wall_seconds': round(stats.wall_seconds, 6),
+                                  'cpu_seconds': round(stats.cpu_seconds, 6)}
+                           for name, stats in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'signature_hits': dict(sorted(self.signature_hits.items())),
+            }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Report':
+        report = cls(data['name'])
+        report.wall_seconds = data['wall_seconds']
+        report.cpu_seconds = data['cpu_seconds']
+        for name, stats in data['stages'].items():
+            report.add_stage(name, stats['wall_seconds'], stats['cpu_seconds'], stats['calls'])
+        report.counters.update(data['counters'])
+        report.signature_hits.update(data['signature_hits'])
+        return report
+
+    def to_json(self) -> str:
+        """One line of JSON."""
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    def to_prometheus(self, prefix: str = METRICS_PREFIX) -> str:
+        """Prometheus text exposition format."""
+        data = self.to_dict()
+        lines = [
+            f"# TYPE {prefix}_stage_calls_total counter",
+            *(f'{prefix}_stage_calls_total{{stage="{name}"}} {stats["calls"]}'
+              for name, stats in data['stages'].items()),
+            f"# TYPE {prefix}_stage_seconds_total counter",
+            *(f'{prefix}_stage_seconds_total{{stage="{name}",clock="{clock}"}} {stats[f"{clock}_seconds"]}'
+              for name, stats in data['stages'].items() for clock in ('wall', 'cpu')),
+        ]
+        for name, value in data['counters'].items():
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        lines.append(f"# TYPE {prefix}_signature_hits_total counter")
+        lines += [f'{prefix}_signature_hits_total{{signature="{label}"}} {value}'
+                  for label, value in data['signature_hits'].items()]
+        return '\n'.join(lines) + '\n'
+
+
+class _Stage:
+    __slots__ = ('report', 'name', 'wall', 'cpu', 'span')
+
+    def __init__(self, report: Report, name: str):
+        self.report = report
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        if self.report.transaction is not None:
+            self.span = self.report.transaction.start_child(op=self.name)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.report.add_stage(self.name, time.perf_counter() - self.wall, time.thread_time() - self.cpu)
+        if self.span is not None:
+            self.span.finish()
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def current_report() -> Optional[Report]:
+    return _current_report.get()
+
+
+def stage(name: str):
+    """Context manager recording the time spent in a stage of the current report (no-op without report)."""
+    report = _current_report.get()
+    if report is None:
+        return _NO_STAGE
+    return _Stage(report, name)
+
+
+def count(name: str, value: int = 1):
+    """Add value to a counter of the current report (no-op without report)."""
+    report = _current_report.get()
+    if report is not None:
+        report.count(name, value)
+
+
+def count_hits(hits: Dict[str, int]):
+    """Add signature hits to the current report (no-op without report)."""
+    report = _current_report.get()
+    if report is not None and hits:
+        report.count_hits(hits)
+
+
+def _sentry_active(sentry_sdk) -> bool:
+    if hasattr(sentry_sdk, 'get_client'):
+        return sentry_sdk.get_client().is_active()
+    return sentry_sdk.Hub.current.client is not None  # sentry-sdk 1.x, deprecated in 2.x
+
+
+def _start_transaction(name: str):
+    sentry_sdk = sys.modules.get('sentry_sdk')  # only if the application imported (and initialized) it
+    if sentry_sdk is None or not _sentry_active(sentry_sdk):
+        return None
+    return sentry_sdk.start_transaction(op='watermark.remove', name=name)
+
+
+@contextmanager
+def instrument(name: str, export: bool = True) -> Iterator[Report]:
+    """
+    Record the stages and counters of the code run inside the block in a new report
+    :param name: name of the report (input file, batch, ...)
+    :param export: send the report to the exporters when the block ends
+    :return: report
+    """
+    report = Report(name)
+    report.transaction = _start_transaction(name)
+    token = _current_report.set(report)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield report
+    finally:
+        report.wall_seconds = time.perf_counter() - wall
+        report.cpu_seconds = time.process_time() - cpu
+        _current_report.reset(token)
+        if report.transaction is not None:
+            for counter, value in report.counters.items():
+                report.transaction.set_data(counter, value)
+            report.transaction.finish()
+            report.transaction = None
+        if export:
+            for exporter in list(_exporters):
+                try:
+                    exporter(report)
+                except Exception as e:
+                    logger.warning("Instrumentation exporter failed.", exc_info=e)
+
+
+@contextmanager
+def instrument_call(name: str) -> Iterator[Optional[Report]]:
+    """
+    Used by main / mmain: a stage of the current report, or a new report if instrumentation is enabled
+    :param name:
+    :return: report, None if nothing is recorded
+    """
+    report = _current_report.get()
+    if report is not None:
+        yield report
+    elif ENABLED:
+        with instrument(name) as report:
+            yield report
+    else:
+        yield None
+
+
+def add_exporter(exporter: Callable[[Report], None]):
+    """Call exporter with every report once it is complete."""
+    _exporters.append(exporter)
+
+
+def remove_exporter(exporter: Callable[[Report], None]):
+    _exporters.remove(exporter)
+
+
+class JsonLinesExporter:
+    """Append every report to a JSON lines file."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._lock = Lock()
+
+    def __call__(self, report: Report):
+        line = report.to_json() + '\n'
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+class PrometheusExporter:
+    """Totals of every report written to a file in the Prometheus text format (node exporter textfile collector)."""
+
+    def __init__(self, path: Union[str, Path], prefix: str = METRICS_PREFIX):
+        self.path = Path(path)
+        self.prefix = prefix
+        self.totals = Report('total')
+        self._lock = Lock()
+
+    def __call__(self, report: Report):
+        with self._lock:
+            self.totals.merge(report)
+            self.totals.count('reports')
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            tmp_path.write_text(self.totals.to_prometheus(self.prefix), encoding='utf-8')
+            os.replace(tmp_path, self.path)  # never read half written
+
+
+def enable(json_lines: Union[str, Path] = None, prometheus: Union[str, Path] = None):
+    """
+    Record a report for every call to main / mmain
+    :param json_lines: file every report is appended to as JSON
+    :param prometheus: file the totals are written to in the Prometheus text format
+    :return:
+    """
+    global ENABLED
+    ENABLED = True
+    if json_lines:
+        add_exporter(JsonLinesExporter(json_lines))
+    if prometheus:
+        add_exporter(PrometheusExporter(prometheus))
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    _exporters.clear()
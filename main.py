@@ -1,19 +1,33 @@
-from typing import Dict, List, Union, Callable
-from PIL import Image
+# heavy modules (cv2, numpy, pikepdf, PIL, fire, sentry_sdk) are imported by the functions using them:
+# a GEOS pdf never loads OpenCV, and CLI runs and batch workers start faster (see benchmark.py startup)
+from __future__ import annotations
+from typing import Dict, List, Union, Callable, Tuple, Iterable, Optional, BinaryIO, Iterator, TYPE_CHECKING
 from pathlib import Path
-import zlib
-import numpy
-from pikepdf import Pdf, PdfImage, Name, parse_content_stream, unparse_content_stream, ContentStreamInstruction
 from decimal import Decimal
-import cv2
 import zipfile
+import shutil
+import struct
+import copy
 import io
-import numpy as np
-# from quality import improve_text_in_image
-import fire
+import hashlib
+import math
+from functools import lru_cache, partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
 from logging import getLogger
-from sentry_sdk import capture_message
+from matcher import WatermarkMatcher
+import signatures
+from cache import ResultCache, open_cache, cache_key, content_hash, file_hash
+from instrumentation import stage, count, count_hits, instrument_call
+import contextvars
+
+if TYPE_CHECKING:
+    import numpy
+    from PIL import Image
+    from pikepdf import PdfImage, ContentStreamInstruction
+    from encoding import EncodePreset, SaveProfile
+    from template import WatermarkTemplate
 
 logger = getLogger(__name__)
 
@@ -91,12 +105,107 @@ def rgba_to_hex(rgba_color: tuple):
     return '#%02x%02x%02x' % (r, g, b)
 
 
-def replace_images_in_zip(in_zip: Path, out_zip: Path, replacements: Dict[str, io.BytesIO]) -> Path:
+ZIP_COPY_CHUNK_SIZE = 1024 * 1024
+# compression level of deflated entries hinted by the bits 1 and 2 of their flags: normal, maximum, fast, super fast
+ZIP_DEFLATE_LEVELS = {0: None, 1: 9, 2: 1, 3: 1}
+# pixels with a saturation up to CV_SATURATION_THRESHOLD and a value above CV_VALUE_THRESHOLD are made white (OpenCV2)
+CV_SATURATION_THRESHOLD = 92
+CV_VALUE_THRESHOLD = 128
+# colors made white by default (Replace colors)
+DEFAULT_COLOR_REPLACEMENTS = {
+    '#f0f0f0': '#FFFFFF',
+    '#c0c0c0': '#FFFFFF',
+    '#b4b4fe': '#FFFFFF',
+}
+# compiled color replacements kept by process: a lookup table with tolerance takes 32 MB (2^24 int16)
+COLOR_REPLACEMENTS_CACHE_SIZE = 2
+
+
+def copy_zip_entry(zin: zipfile.ZipFile, zout: zipfile.ZipFile, info: zipfile.ZipInfo):
+    """
+    Copy an entry from zin to zout as raw compressed bytes (without decompressing and compressing it again)
+    :param zin:
+    :param zout:
+    :param info: entry of zin
+    :return:
+    """
+    if info.flag_bits & 0x01 or max(info.file_size, info.compress_size) >= zipfile.ZIP64_LIMIT:
+        # encrypted or zip64 entries: decompress and compress again
+        new_info = copy.copy(info)
+        new_info._compresslevel = zip_entry_compresslevel(info)
+        with zin.open(info) as fin, zout.open(new_info, 'w') as fout:
+            shutil.copyfileobj(fin, fout, ZIP_COPY_CHUNK_SIZE)
+        return
+    # skip the local header of the entry
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    # write a local header with the sizes (no data descriptor) and the raw data
+    new_info = copy.copy(info)
+    new_info.flag_bits &= ~0x08
+    if zout._seekable:
+        zout.fp.seek(zout.start_dir)
+    new_info.header_offset = zout.fp.tell()
+    zout._writecheck(new_info)
+    zout._didModify = True
+    zout.fp.write(new_info.FileHeader(False))
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = zin.fp.read(min(ZIP_COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated entry {info.filename}")
+        zout.fp.write(chunk)
+        remaining -= len(chunk)
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout.start_dir = zout.fp.tell()
+
+
+def zip_entry_compresslevel(info: zipfile.ZipInfo) -> Optional[int]:
+    """Compression level of a deflated entry (None for the default level)."""
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        return ZIP_DEFLATE_LEVELS[(info.flag_bits >> 1) & 0x03]
+    return None
+
+
+def write_zip_entry(zin: zipfile.ZipFile, zout: zipfile.ZipFile, item: zipfile.ZipInfo,
+                    replacement: Union[bytes, Path, BinaryIO] = None):
     """
-    Replace images in zip
+    Write an entry of zin to zout, replacing its content if a replacement is given
+    :param zin:
+    :param zout:
+    :param item: entry of zin
+    :param replacement: new content as bytes, path of a file or file object (None to copy the entry)
+    :return:
+    """
+    if replacement is None:
+        copy_zip_entry(zin, zout, item)
+        return
+    # replace the content (same name, date, attributes and compression)
+    new_item = zipfile.ZipInfo(item.filename, item.date_time)
+    new_item.compress_type = item.compress_type
+    new_item._compresslevel = zip_entry_compresslevel(item)
+    new_item.external_attr = item.external_attr
+    new_item.comment = item.comment
+    with zout.open(new_item, 'w') as f:
+        if isinstance(replacement, (bytes, bytearray, memoryview)):
+            f.write(replacement)
+        elif isinstance(replacement, (str, Path)):
+            with open(replacement, 'rb') as r:
+                shutil.copyfileobj(r, f, ZIP_COPY_CHUNK_SIZE)
+        else:
+            replacement.seek(0)
+            shutil.copyfileobj(replacement, f, ZIP_COPY_CHUNK_SIZE)
+
+
+def replace_images_in_zip(in_zip: Union[Path, BinaryIO], out_zip: Union[Path, BinaryIO],
+                          replacements: Dict[str, Union[bytes, Path, BinaryIO]]) -> Union[Path, BinaryIO]:
+    """
+    Replace images in zip, entries keep their compression, other entries are copied without decompressing them
     :param in_zip:
     :param out_zip:
-    :param replacements:
+    :param replacements: {filename: new content as bytes, path of a file or file object}
     :return:
     """
 
@@ -105,38 +214,142 @@ def replace_images_in_zip(in_zip: Path, out_zip: Path, replacements: Dict[str, i
             zout.comment = zin.comment  # preserve the comment
             for item in zin.infolist():
                 # copy all files except the images to replace
-                if item.filename not in replacements.keys():
-                    with zout.open(item.filename, 'w') as f:
-                        f.write(zin.read(item.filename))
-                else:  # replace the image
-                    with zout.open(item.filename, 'w') as f:
-                        f.write(replacements[item.filename].getvalue())
+                write_zip_entry(zin, zout, item, replacements.get(item.filename))
     return out_zip
 
 
-def remove_watermark_from_cv_image(img: numpy.ndarray) -> numpy.ndarray:
+def remove_watermark_from_cv_image(img: numpy.ndarray, tile_height: int = None, in_place: bool = False) -> \
+        numpy.ndarray:
     """
     Remove watermark from open cv image
     :param img:
+    :param tile_height: process the image by strips of tile_height rows to bound the memory used (same result)
+    :param in_place: write the result into img instead of a copy
     :return: image without watermark
     """
+    import cv2
+    if tile_height and tile_height < img.shape[0]:
+        return remove_watermark_from_cv_image_by_strips(img, tile_height, in_place)
     # convert image to hsv colorspace
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
     h, s, v = cv2.split(hsv)
     # threshold saturation image
-    thresh1 = cv2.threshold(s, 92, 255, cv2.THRESH_BINARY)[1]
+    thresh1 = cv2.threshold(s, CV_SATURATION_THRESHOLD, 255, cv2.THRESH_BINARY)[1]
     # threshold value image and invert
-    thresh2 = cv2.threshold(v, 128, 255, cv2.THRESH_BINARY)[1]
+    thresh2 = cv2.threshold(v, CV_VALUE_THRESHOLD, 255, cv2.THRESH_BINARY)[1]
     thresh2 = 255 - thresh2
     # combine the two threshold images as a mask
     mask = cv2.add(thresh1, thresh2)
     # use mask to remove lines in background of input
-    result = img.copy()
+    result = img if in_place else img.copy()
     result[mask == 0] = (255, 255, 255)
     return result
 
 
-def replace_colors_in_image(image: Image, replacements: Dict[str, str]) -> Image:
+def remove_watermark_from_cv_image_by_strips(img: numpy.ndarray, tile_height: int, in_place: bool = False) -> \
+        numpy.ndarray:
+    """
+    Remove watermark from open cv image, strip by strip, reusing the same scratch buffers for every strip
+    :param img:
+    :param tile_height: number of rows of a strip
+    :param in_place: write the result into img instead of a copy
+    :return: image without watermark (same as remove_watermark_from_cv_image)
+    """
+    import cv2
+    import numpy as np
+    height, width = img.shape[:2]
+    hsv = np.empty((tile_height, width, 3), dtype=np.uint8)
+    s = np.empty((tile_height, width), dtype=np.uint8)
+    v = np.empty((tile_height, width), dtype=np.uint8)
+    thresh1 = np.empty((tile_height, width), dtype=np.uint8)
+    thresh2 = np.empty((tile_height, width), dtype=np.uint8)
+    mask = np.empty((tile_height, width), dtype=np.uint8)
+    result = img if in_place else img.copy()
+    for top in range(0, height, tile_height):
+        rows = min(tile_height, height - top)
+        strip = result[top:top + rows]
+        # convert strip to hsv colorspace
+        cv2.cvtColor(strip, cv2.COLOR_BGR2HSV, dst=hsv[:rows])
+        cv2.extractChannel(hsv[:rows], 1, dst=s[:rows])
+        cv2.extractChannel(hsv[:rows], 2, dst=v[:rows])
+        # threshold saturation, threshold value and invert
+        cv2.threshold(s[:rows], CV_SATURATION_THRESHOLD, 255, cv2.THRESH_BINARY, dst=thresh1[:rows])
+        cv2.threshold(v[:rows], CV_VALUE_THRESHOLD, 255, cv2.THRESH_BINARY_INV, dst=thresh2[:rows])
+        # combine the two threshold images as a mask
+        cv2.add(thresh1[:rows], thresh2[:rows], dst=mask[:rows])
+        strip[mask[:rows] == 0] = (255, 255, 255)
+    return result
+
+
+def pack_rgb(rgb: numpy.ndarray) -> numpy.ndarray:
+    """
+    Pack the rgb values of pixels into one integer per pixel
+    example: (255, 128, 0) to 0xFF8000
+    :param rgb: ... x 3 uint8 array
+    :return: ... uint32 array
+    """
+    import numpy as np
+    packed = rgb[..., 0].astype(np.uint32) << 16
+    packed |= rgb[..., 1].astype(np.uint32) << 8
+    packed |= rgb[..., 2]
+    return packed
+
+
+@lru_cache(maxsize=COLOR_REPLACEMENTS_CACHE_SIZE)
+def compile_color_replacements(replacements: Tuple[Tuple[str, str], ...], tolerance: int = 0) -> \
+        Tuple[numpy.ndarray, numpy.ndarray, Optional[numpy.ndarray]]:
+    """
+    Compile color replacements ((to_replace_hex, new_hex), ...) into lookup tables
+    :param replacements:
+    :param tolerance: max difference per channel for a color to be replaced
+    :return: sorted packed colors to replace, their new colors, and the 2^24 lookup table if tolerance is used
+    """
+    import numpy as np
+    old_colors = np.array([hex_to_rbg(old_c) for old_c, _ in replacements], dtype=np.uint8).reshape(-1, 3)
+    new_colors = np.array([hex_to_rbg(new_c) for _, new_c in replacements], dtype=np.uint8).reshape(-1, 3)
+    if tolerance:
+        # index of the new color of every possible rgb color (-1 to keep it), the first replacement wins
+        lut = np.full((256, 256, 256), -1, dtype=np.int16)
+        for i, (r, g, b) in enumerate(old_colors.astype(int)):
+            box = lut[max(r - tolerance, 0):r + tolerance + 1,
+                      max(g - tolerance, 0):g + tolerance + 1,
+                      max(b - tolerance, 0):b + tolerance + 1]
+            box[box == -1] = i
+        return pack_rgb(old_colors), new_colors, lut.reshape(-1)
+    keys = pack_rgb(old_colors)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], new_colors[order], None
+
+
+def replace_colors_in_array(rgb: numpy.ndarray, replacements: Dict[str, str], tolerance: int = 0,
+                            rows_per_block: int = 256) -> numpy.ndarray:
+    """
+    Replace colors in place in a height x width x 3 (rgb) array, in a single pass over the pixels
+    :param rgb:
+    :param replacements:
+    :param tolerance: max difference per channel for a color to be replaced
+    :param rows_per_block: rows processed at once (bounds the temporary arrays)
+    :return: rgb
+    """
+    import numpy as np
+    if not replacements:
+        return rgb
+    keys, new_colors, lut = compile_color_replacements(tuple(replacements.items()), tolerance)
+    for start in range(0, rgb.shape[0], rows_per_block):
+        block = rgb[start:start + rows_per_block]
+        packed = pack_rgb(block)
+        if lut is not None:
+            indexes = lut[packed]
+            matches = indexes >= 0
+        else:
+            indexes = np.searchsorted(keys, packed)
+            np.minimum(indexes, len(keys) - 1, out=indexes)
+            matches = keys[indexes] == packed
+        block[matches] = new_colors[indexes[matches]]
+    return rgb
+
+
+def replace_colors_in_image(image: Image, replacements: Dict[str, str], tolerance: int = 0) -> Image:
     """
     Replace colors in image with new colors from replacements {to_replace_hex: new_hex}
     example = {
@@ -145,40 +358,57 @@ def replace_colors_in_image(image: Image, replacements: Dict[str, str]) -> Image
     }
     :param image:
     :param replacements:
-    :return:
+    :param tolerance: max difference per channel for a color to be replaced (0 for exact colors)
+    :return: RGB image (RGBA if image has transparency)
     """
-    image = image.convert('RGBA')
-    data = np.array(image)  # "data" is a height x width x 4 numpy array
-    red, green, blue, alpha = data.T  # Temporarily unpack the bands for readability
-    for old_c, new_c in replacements.items():
-        old_color = hex_to_rbg(old_c)
-        new_color = hex_to_rbg(new_c)
-        white_areas = (red == old_color[0]) & (blue == old_color[1]) & (green == old_color[2])
-        data[..., :-1][white_areas.T] = new_color
+    import numpy as np
+    from PIL import Image
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = image.mode in ('LA', 'PA', 'La', 'RGBa') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    data = np.array(image)  # "data" is a height x width x 3 (or 4) numpy array
+    replace_colors_in_array(data[..., :3], replacements, tolerance)
     return Image.fromarray(data)
 
 
 def remove_watermark_from_pil_image(image: Image, method_choice: MethodChoice,
-                                    replacements: Dict[str, str] = None) -> Image:
+                                    replacements: Dict[str, str] = None, binarize: str = None,
+                                    tile_height: int = None, template: WatermarkTemplate = None) -> Image:
     """
     Remove watermark from pil image
     :param image:
     :param method_choice:
     :param replacements:
+    :param binarize: improve text with a black and white post-processing: global, otsu or adaptive (default: disabled)
+    :param tile_height: process big images by strips of tile_height rows to bound the memory used (OpenCV2 only)
+    :param template: watermark mask of the document (OpenCV2 only, see template.py)
     :return:
     """
     if method_choice == MethodChoice.openCV2:
+        import cv2
+        import numpy as np
+        from PIL import Image
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
         # noinspection PyTypeChecker
-        opencv_image = cv2.cvtColor(numpy.array(image), cv2.COLOR_RGB2BGR)
-        opencv_image = remove_watermark_from_cv_image(opencv_image)
-        image = Image.fromarray(cv2.cvtColor(opencv_image, cv2.COLOR_BGR2RGB))
-        return image
+        opencv_image = np.array(image)
+        # converted in place: the array is already a copy of the image
+        cv2.cvtColor(opencv_image, cv2.COLOR_RGB2BGR, dst=opencv_image)
+        with stage('opencv'):
+            if template is not None:
+                template.clean(opencv_image, tile_height)
+            else:
+                remove_watermark_from_cv_image(opencv_image, tile_height, in_place=True)
+        cv2.cvtColor(opencv_image, cv2.COLOR_BGR2RGB, dst=opencv_image)
+        image = Image.fromarray(opencv_image)
     else:
-        return replace_colors_in_image(image, replacements or {
-            '#f0f0f0': '#FFFFFF',
-            '#c0c0c0': '#FFFFFF',
-            '#b4b4fe': '#FFFFFF',
-        })
+        with stage('replace_colors'):
+            image = replace_colors_in_image(image, replacements or DEFAULT_COLOR_REPLACEMENTS)
+    if binarize:
+        from quality import improve_text_in_image
+        with stage('binarize'):
+            image = improve_text_in_image(image, binarize)
+    return image
 
 
 def generate_output_path(input_path: Path) -> Path:
@@ -190,6 +420,86 @@ def generate_output_path(input_path: Path) -> Path:
     return input_path.parent / (input_path.stem + f"_generated{input_path.suffix}")
 
 
+class FileType(Enum):
+    pdf = ".pdf"
+    docx = ".docx"
+    png = ".png"
+    jpeg = ".jpg"
+
+    @staticmethod
+    def from_str(label):
+        if label in ('pdf', '.pdf'):
+            return FileType.pdf
+        elif label in ('docx', '.docx'):
+            return FileType.docx
+        elif label in ('png', '.png'):
+            return FileType.png
+        elif label in ('jpg', '.jpg', 'jpeg', '.jpeg'):
+            return FileType.jpeg
+        else:
+            raise NotImplementedError
+
+
+class UnsupportedFileType(ValueError):
+    """The file is not a pdf, docx, png or jpeg document (see detect_file_type)."""
+
+
+# bytes a pdf header can be preceded by (pdf readers accept some garbage before %PDF-)
+PDF_HEADER_SEARCH_BYTES = 1024
+DOCX_MAIN_PART = 'word/document.xml'
+
+
+Source = Union[bytes, bytearray, memoryview, BinaryIO]
+# progress of a file: called with (done, total) units (pages of pdf, images of docx, 1 for images)
+Progress = Callable[[int, int], None]
+
+
+def as_seekable_stream(source: Union[Source, str, Path]) -> BinaryIO:
+    """
+    Seekable binary stream of a source
+    :param source: bytes, memoryview, file object (read into memory if it is not seekable) or path
+    :return:
+    """
+    if isinstance(source, (str, Path)):
+        return open(source, 'rb')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    if not source.seekable():
+        return io.BytesIO(source.read())
+    return source
+
+
+def detect_file_type(source: Union[Source, str, Path]) -> Optional[FileType]:
+    """
+    Type of a file from its content (magic bytes), whatever its name
+    :param source: bytes, memoryview, seekable file object (read from its current position, then restored) or path
+    :return: None if the file is not supported
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            return detect_file_type(f)
+    stream = as_seekable_stream(source)
+    position = stream.tell()
+    try:
+        head = stream.read(PDF_HEADER_SEARCH_BYTES)
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            return FileType.png
+        if head.startswith(b'\xff\xd8\xff'):
+            return FileType.jpeg
+        if head.startswith(b'PK\x03\x04'):
+            stream.seek(position)
+            try:
+                with zipfile.ZipFile(stream) as z:
+                    return FileType.docx if DOCX_MAIN_PART in z.NameToInfo else None
+            except zipfile.BadZipFile:
+                return None
+        if b'%PDF-' in head:
+            return FileType.pdf
+        return None
+    finally:
+        stream.seek(position)
+
+
 def remove_tj_maj(instructions: List[ContentStreamInstruction], tj_start_with: Union[List[bytes], str]) -> \
         List[ContentStreamInstruction]:
     """Remove all "TJ" operators if it contains tj_start_with from PDF."""
@@ -261,155 +571,664 @@ def remove_by_reversed_orders(instructions: List[ContentStreamInstruction], orde
     return [x for x in instructions if x is not None]
 
 
-def remove_watermark_from_geos_pdf(input_file: Path, output_file: Path) -> str:
+def page_content(page) -> Optional[bytes]:
+    """
+    Decoded content of a page (its content streams concatenated)
+    :param page:
+    :return: None if a content stream can not be decoded
+    """
+    from pikepdf import Array, PdfError
+    contents = page.obj.get('/Contents')
+    if contents is None:
+        return b''
+    streams = contents if isinstance(contents, Array) else [contents]
+    try:
+        return b'\n'.join(stream.read_bytes() for stream in streams)
+    except PdfError:
+        return None
+
+
+def remove_watermark_from_geos_page(page, matcher: WatermarkMatcher, prefilter: bool = True) -> \
+        Tuple[Optional[bytes], bool, Dict[str, int]]:
+    """
+    Remove watermark from a page of a pdf exported from any GEOS app.
+    :param page:
+    :param matcher: compiled signature set
+    :param prefilter: skip the page without parsing it if none of the signatures can match its content (see
+    WatermarkMatcher.may_match)
+    :return: new content stream of the page (None if the page is left as it is), True if the 'f' operator was used
+    to remove watermark, hits
+    """
+    from pikepdf import parse_content_stream, unparse_content_stream
+    if prefilter and matcher.needles is not None:
+        with stage('content_prefilter'):
+            content = page_content(page)
+            if content is not None and not matcher.may_match(content):
+                return None, False, {}
+    with stage('content_parse'):
+        instructions = parse_content_stream(page)
+    with stage('content_match'):
+        result = matcher.apply(instructions)
+    with stage('content_unparse'):
+        content = unparse_content_stream(result.instructions)
+    return content, result.used_fallback, result.hits
+
+
+_worker_pdf_data: Optional[bytes] = None  # pdf sent once to every worker process when it is not a file
+
+
+def _set_worker_pdf_data(data: bytes):
+    global _worker_pdf_data
+    _worker_pdf_data = data
+
+
+def remove_watermark_from_geos_pages(input_file: Optional[Path], page_numbers: Iterable[int],
+                                     matcher: WatermarkMatcher, prefilter: bool = True) -> \
+        List[Tuple[int, Optional[bytes], bool, Dict[str, int]]]:
+    """
+    Remove watermark from some pages of a pdf exported from any GEOS app (runs in worker processes).
+    :param input_file: None to use the pdf sent to the worker process
+    :param page_numbers:
+    :param matcher: compiled signature set
+    :param prefilter: see remove_watermark_from_geos_page
+    :return: [(page_number, new content stream or None, used 'f' operator, hits), ...]
+    """
+    from pikepdf import Pdf
+    with Pdf.open(input_file if input_file is not None else io.BytesIO(_worker_pdf_data)) as pdf:
+        return [(page_number, *remove_watermark_from_geos_page(pdf.pages[page_number], matcher, prefilter))
+                for page_number in page_numbers]
+
+
+def remove_watermark_from_geos_pdf(input_file: Union[Path, BinaryIO], output_file: Union[Path, BinaryIO],
+                                   workers: int = 1, signature_set: str = None, progress: Progress = None,
+                                   prefilter: bool = True, save_profile: Union[str, SaveProfile] = None) -> str:
     """
     Remove watermark from pdf (exported from any GEOS app) and save to output_file.
-    :param input_file:
-    :param output_file:
+    :param input_file: path or seekable file object
+    :param output_file: path or file object
+    :param workers: number of worker processes the pages are split across (1 to process in-process)
+    :param signature_set: name of the signature set of the signatures file (default: geos)
+    :param progress: called with (done, total) pages as the pdf is processed, it can raise to stop
+    :param prefilter: pages that none of the signatures can match are left untouched (their content streams are not
+    parsed), False to parse and rewrite every page (see WatermarkMatcher)
+    :param save_profile: default, fast, compact or web (see encoding.py)
     :return:
     """
-    pdf = Pdf.open(input_file)
-    for page_number, page in enumerate(pdf.pages):
-        page_instructions = parse_content_stream(page)
-        previous_len = len(page_instructions)
-        # VERSION EVALUATION
-        page_instructions = remove_tjs_min(page_instructions, "VERSION EVALUATION")
-        # alt: VERSION EVALUATION
-        new_len = len(page_instructions)
-        if new_len == previous_len:
-            page_instructions = remove_by_reversed_orders(page_instructions, {
-                'f': [0, ],
-            })
-            message = f"{input_file} at page {page_number + 1} => we used 'f' operator to remove watermark."
+    from pikepdf import Pdf
+    from encoding import save_pdf
+    matcher = signatures.REGISTRY.get(signature_set)
+    with stage('pdf_open'):
+        pdf = Pdf.open(input_file)
+    pages_count = len(pdf.pages)
+    count('pages', pages_count)
+    if workers and workers > 1 and pages_count > 1:
+        # several contiguous slices per worker to balance uneven pages
+        chunk_size = math.ceil(pages_count / (workers * 4))
+        chunks = [range(start, min(start + chunk_size, pages_count)) for start in range(0, pages_count, chunk_size)]
+        worker_input, pool_options = input_file, {}
+        if not isinstance(input_file, (str, Path)):
+            # in memory: sent once to every worker
+            input_file.seek(0)
+            worker_input, pool_options = None, {'initializer': _set_worker_pdf_data, 'initargs': (input_file.read(),)}
+        with stage('geos_workers'), \
+                ProcessPoolExecutor(max_workers=min(workers, len(chunks)), **pool_options) as executor:
+            results = [result for results in executor.map(remove_watermark_from_geos_pages,
+                                                          [worker_input] * len(chunks), chunks, [matcher] * len(chunks),
+                                                          [prefilter] * len(chunks))
+                       for result in results]
+    else:
+        results = ((page_number, *remove_watermark_from_geos_page(page, matcher, prefilter))
+                   for page_number, page in enumerate(pdf.pages))
+    for done, (page_number, new_content_stream, used_f_operator, hits) in enumerate(results, 1):
+        signatures.REGISTRY.record(signature_set, hits)
+        if new_content_stream is None:
+            # no signature: the original content stream objects are kept
+            count('pages_skipped')
+            if progress:
+                progress(done, pages_count)
+            continue
+        count('pages_rewritten')
+        count_hits(hits)
+        if used_f_operator:
+            count('fallbacks')
+            input_name = input_file if isinstance(input_file, (str, Path)) else 'pdf in memory'
+            message = f"{input_name} at page {page_number + 1} => we used 'f' operator to remove watermark."
             logger.warning(message)
+            from sentry_sdk import capture_message
             w_sentry(capture_message, message)
-
-        # Trial - XXX
-        page_instructions = remove_tj_maj(page_instructions, "Trial - ")
-        page_instructions = remove_tj_maj(page_instructions,
-                                          [b'\x007', b'\x00U', b'\x00L', b'\x00D', b'\x00O', b'\x00\x03', b'\x00\x10',
-                                           b'\x00\x03'])
-
-        # UnRegistered
-        page_instructions = remove_tj_maj(page_instructions, "UnRegistered")
-
         # save page
-        new_content_stream = unparse_content_stream(page_instructions)
-        page.Contents = pdf.make_stream(new_content_stream)  # override page contents
-    pdf.save(output_file)
+        pdf.pages[page_number].Contents = pdf.make_stream(new_content_stream)  # override page contents
+        if progress:
+            progress(done, pages_count)
+    save_pdf(pdf, output_file, save_profile)
     return str(output_file)
 
 
-def remove_watermark_from_pdf(input_file: Path, output_file: Path, method_choice: MethodChoice = None) -> str:
+def remove_watermark_from_pdf(input_file: Union[Path, BinaryIO], output_file: Union[Path, BinaryIO],
+                              method_choice: MethodChoice = None,
+                              workers: int = 1, signature_set: str = None, tile_height: int = None,
+                              binarize: str = None, preset: Union[str, EncodePreset] = None,
+                              cache: Union[str, Path, ResultCache] = None, progress: Progress = None,
+                              save_profile: Union[str, SaveProfile] = None,
+                              template: WatermarkTemplate = None) -> str:
     """
     Remove watermark from pdf and save to output_file
-    :param input_file:
-    :param output_file:
+    :param input_file: path or seekable file object
+    :param output_file: path or file object
     :param method_choice:
+    :param workers: number of worker processes used for GEOS pdf
+    :param signature_set: name of the signature set used for GEOS pdf
+    :param tile_height: process big images by strips (see remove_watermark_from_pil_image)
+    :param binarize: black and white post-processing of the images (see remove_watermark_from_pil_image)
+    :param preset: encoding preset of the images: default, fast or small (see encoding.py)
+    :param cache: cache of the cleaned images (see cache.py)
+    :param progress: called with (done, total) pages as the pdf is processed, it can raise to stop
+    :param save_profile: default, fast, compact or web (see encoding.py)
+    :param template: watermark mask of the document (see remove_watermark_from_pil_image)
     :return:
     """
     if method_choice == MethodChoice.geos:
-        return remove_watermark_from_geos_pdf(input_file, output_file)
-    pdf = Pdf.open(input_file)
-    for page in pdf.pages:
+        return remove_watermark_from_geos_pdf(input_file, output_file, workers, signature_set, progress,
+                                              save_profile=save_profile)
+    from pikepdf import Pdf, PdfImage
+    from encoding import encode_pdf_image, save_pdf
+    result_cache = open_cache(cache)
+    with stage('pdf_open'):
+        pdf = Pdf.open(input_file)
+    processed = {}  # objgen => cleaned image
+    processed_by_content = {}  # content hash => cleaned image
+    references = 0
+    pages_count = len(pdf.pages)
+    count('pages', pages_count)
+    for page_number, page in enumerate(pdf.pages):
+        if progress:
+            progress(page_number, pages_count)
         for image_key in page.images.keys():
             raw_image = page.images[image_key]
+            if raw_image.get('/ImageMask', False):  # stencil masks have no colors
+                continue
+            references += 1
+            # images shared by several pages are cleaned once
+            if raw_image.objgen != (0, 0) and raw_image.objgen in processed:
+                continue
+            content_key = pdf_image_content_key(raw_image)
+            if content_key in processed_by_content and '/XObject' in page.obj.get('/Resources', {}):
+                # same image in another object: use the cleaned one
+                page.Resources.XObject[image_key] = processed_by_content[content_key]
+                processed[raw_image.objgen] = processed_by_content[content_key]
+                continue
             pdf_image = PdfImage(raw_image)
-            pil_image = pdf_image.as_pil_image()
-            pil_image = remove_watermark_from_pil_image(pil_image, method_choice)
-            raw_image.write(zlib.compress(pil_image.tobytes()), filter=Name("/FlateDecode"))
-    pdf.save(output_file)
+            pil_image = clean_pdf_image(pdf_image, content_key, method_choice, binarize, tile_height, result_cache,
+                                        template)
+            with stage('encode'):
+                stats = encode_pdf_image(pdf, raw_image, pil_image, pdf_image, preset)
+            count('images')
+            logger.info(f"{input_file} image {image_key} encoded: {stats}")
+            processed[raw_image.objgen] = raw_image
+            processed_by_content[content_key] = raw_image
+    logger.info(f"{input_file} => {len(processed_by_content)} unique images cleaned for {references} references "
+                f"({references - len(processed_by_content)} decodes saved).")
+    count('decodes_saved', references - len(processed_by_content))
+    save_pdf(pdf, output_file, save_profile)
+    if progress:
+        progress(pages_count, pages_count)
     return str(output_file)
 
 
-def remove_watermark_from_docx(input_file: Path, output_file: Path, method_choice: MethodChoice = None) -> str:
+def clean_pdf_image(pdf_image: PdfImage, content_key: str, method_choice: MethodChoice = None, binarize: str = None,
+                    tile_height: int = None, cache: ResultCache = None, template: WatermarkTemplate = None) -> Image:
     """
-    Remove watermark from docx and save to output_file
-    :param input_file:
-    :param output_file:
+    Remove watermark from an image of a pdf, or get it from the cache
+    :param pdf_image:
+    :param content_key: see pdf_image_content_key
     :param method_choice:
+    :param binarize:
+    :param tile_height:
+    :param cache:
+    :param template:
+    :return: cleaned image
+    """
+    from PIL import Image
+    key = None
+    if cache is not None:
+        key = cache_key('pdf_image', content_key, method_choice, binarize=binarize)
+        data = cache.get_bytes('pdf_image', key)
+        if data is not None:
+            return Image.open(io.BytesIO(data))
+    with stage('decode'):
+        pil_image = pdf_image.as_pil_image()
+    pil_image = remove_watermark_from_pil_image(pil_image, method_choice, binarize=binarize, tile_height=tile_height,
+                                                template=template)
+    if cache is not None and pil_image.mode in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        # stored losslessly, the image is encoded with the preset when written in the pdf
+        image_file = io.BytesIO()
+        pil_image.save(image_file, format='PNG', compress_level=1)
+        cache.put_bytes('pdf_image', key, image_file.getvalue())
+    return pil_image
+
+
+def pdf_image_content_key(raw_image) -> str:
+    """Hash of the data and of the dictionary entries of an image XObject used to decode it."""
+    content_hash = hashlib.sha256(raw_image.read_raw_bytes())
+    for key in ('/Width', '/Height', '/ColorSpace', '/BitsPerComponent', '/Filter', '/DecodeParms', '/Decode',
+                '/SMask', '/Mask'):
+        value = raw_image.get(key)
+        if value is not None:
+            value = value.objgen if getattr(value, 'is_indirect', False) else repr(value)
+        content_hash.update(f"{key}={value};".encode())
+    return content_hash.hexdigest()
+
+
+DOCX_MEDIA_DIR = 'word/media/'
+RASTER_FORMATS = ('PNG', 'JPEG', 'GIF', 'BMP', 'TIFF', 'WEBP')
+DOCX_MAX_IN_FLIGHT_BYTES = 512 * 1024 * 1024
+
+
+def open_raster_image(data: bytes) -> Optional[Image.Image]:
+    """
+    Open an image without decoding its pixels
+    :param data:
+    :return: None if it is not a supported raster image (EMF, WMF, SVG, ...)
+    """
+    from PIL import Image, UnidentifiedImageError
+    try:
+        pil_image = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        return None
+    if pil_image.format not in RASTER_FORMATS:
+        return None
+    return pil_image
+
+
+def reduce_image(image: Image.Image, max_size: int, resample: int = None) -> Image.Image:
+    """
+    Downsampled copy of an image, JPEG images are decoded at a lower scale (1/2 to 1/8) instead of entirely
+    :param image: image opened but not loaded yet (the scale of JPEG images is chosen before decoding)
+    :param max_size: longest side of the result
+    :param resample: PIL filter (default: box), NEAREST keeps the colors of the pixels as they are
+    :return: RGB image
+    """
+    from PIL import Image
+    image.draft('RGB', (max_size, max_size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((max_size, max_size), Image.BOX if resample is None else resample)
+    return image
+
+
+def decoded_image_size(data: bytes) -> int:
+    """Estimated memory used by an image once decoded (its size if it is not a supported raster image)."""
+    pil_image = open_raster_image(data)
+    if pil_image is None:
+        return len(data)
+    return max(pil_image.width * pil_image.height * len(pil_image.getbands()), len(data))
+
+
+def remove_watermark_from_docx_media(data: bytes, method_choice: MethodChoice = None, binarize: str = None,
+                                     tile_height: int = None, preset: Union[str, EncodePreset] = None,
+                                     cache: ResultCache = None, template: WatermarkTemplate = None) -> Optional[bytes]:
+    """
+    Remove watermark from an image of a docx (decode, clean and encode in the same format)
+    :param data:
+    :param method_choice:
+    :param binarize:
+    :param tile_height:
+    :param preset: encoding preset (see encoding.py)
+    :param cache: cache of the cleaned images
+    :param template: watermark mask of the document
+    :return: new image, None if it is not a supported raster image
+    """
+    from encoding import as_preset, encode_image
+    key = None
+    if cache is not None:
+        key = cache_key('image', content_hash(data), method_choice, binarize=binarize, preset=as_preset(preset).name)
+        new_data = cache.get_bytes('image', key)
+        if new_data is not None:
+            return new_data
+    pil_image = open_raster_image(data)
+    if pil_image is None:
+        return None
+    source_format = pil_image.format
+    pil_image = remove_watermark_from_pil_image(pil_image, method_choice, binarize=binarize, tile_height=tile_height,
+                                                template=template)
+    with stage('encode'):
+        new_data, stats = encode_image(pil_image, source_format, preset, source_size=len(data))
+    count('images')
+    logger.info(f"image encoded: {stats}")
+    if cache is not None:
+        cache.put_bytes('image', key, new_data)
+    return new_data
+
+
+def iter_transformed_zip_entries(zin: zipfile.ZipFile, items: List[zipfile.ZipInfo],
+                                 transform: Callable[[bytes], Optional[bytes]], workers: int = 1,
+                                 max_in_flight_bytes: int = DOCX_MAX_IN_FLIGHT_BYTES) -> \
+        Iterator[Tuple[zipfile.ZipInfo, Optional[bytes]]]:
+    """
+    Transform entries of a zip one at a time, or in a thread pool with a bounded number of bytes in flight
+    :param zin:
+    :param items: entries of zin to transform
+    :param transform: new content from the content of an entry
+    :param workers: number of threads
+    :param max_in_flight_bytes: max estimated (decoded) size of the entries being transformed at the same time
+    :return: (entry, new content) in the order of items
+    """
+    if not workers or workers <= 1:
+        for item in items:
+            with stage('zip_read'):
+                data = zin.read(item)
+            yield item, transform(data)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        in_flight = 0
+        for item in items:
+            with stage('zip_read'):
+                data = zin.read(item)
+            size = decoded_image_size(data)
+            # wait for the oldest entries (at least one entry is always in flight)
+            while pending and (in_flight + size > max_in_flight_bytes or len(pending) >= 2 * workers):
+                done_item, done_size, future = pending.popleft()
+                in_flight -= done_size
+                yield done_item, future.result()
+            pending.append((item, size, executor.submit(contextvars.copy_context().run, transform, data)))
+            in_flight += size
+            del data
+        while pending:
+            done_item, done_size, future = pending.popleft()
+            yield done_item, future.result()
+
+
+def remove_watermark_from_docx(input_file: Union[Path, BinaryIO], output_file: Union[Path, BinaryIO],
+                               method_choice: MethodChoice = None,
+                               binarize: str = None, tile_height: int = None, workers: int = 1,
+                               max_in_flight_bytes: int = DOCX_MAX_IN_FLIGHT_BYTES,
+                               preset: Union[str, EncodePreset] = None,
+                               cache: Union[str, Path, ResultCache] = None, progress: Progress = None,
+                               template: WatermarkTemplate = None) -> str:
+    """
+    Remove watermark from docx and save to output_file, images are written as soon as they are cleaned
+    :param input_file: path or seekable file object
+    :param output_file: path or file object
+    :param method_choice:
+    :param binarize: black and white post-processing of the images (see remove_watermark_from_pil_image)
+    :param tile_height: process big images by strips (see remove_watermark_from_pil_image)
+    :param workers: number of threads cleaning images
+    :param max_in_flight_bytes: max estimated (decoded) size of the images being cleaned at the same time
+    :param preset: encoding preset of the images: default, fast or small (see encoding.py)
+    :param cache: cache of the cleaned images (see cache.py)
+    :param progress: called with (done, total) images as the docx is processed, it can raise to stop
+    :param template: watermark mask of the document, learnt from the first images cleaned (with several workers, not
+    necessarily the first images of the document)
     :return:
     """
-    z = zipfile.ZipFile(input_file)
-    all_files = z.namelist()
-    # get all files in word/media/ directory
-    images = list(filter(lambda x: x.startswith('word/media/'), all_files))
-    replacements = {}
-    for image in images:
-        with z.open(image) as f:
-            pil_image = Image.open(f)
-            # pil_image = improve_text_in_image(pil_image)
-            pil_image = remove_watermark_from_pil_image(pil_image, method_choice)
-            image_file_tmp = io.BytesIO()
-            pil_image.save(image_file_tmp, format="PNG")
-            replacements[image] = image_file_tmp
-    z.close()
-    return str(replace_images_in_zip(input_file, output_file, replacements))
-
-
-def remove_watermark_from_image(input_file: Path, output_file: Path, method_choice: MethodChoice) -> str:
+    transform = partial(remove_watermark_from_docx_media, method_choice=method_choice, binarize=binarize,
+                        tile_height=tile_height, preset=preset, cache=open_cache(cache), template=template)
+    with zipfile.ZipFile(input_file, 'r') as zin:
+        with zipfile.ZipFile(output_file, 'w') as zout:
+            zout.comment = zin.comment  # preserve the comment
+            all_items = zin.infolist()
+            # get all files in word/media/ directory
+            images = [item for item in all_items if item.filename.startswith(DOCX_MEDIA_DIR)]
+            cleaned_images = iter_transformed_zip_entries(zin, images, transform, workers, max_in_flight_bytes)
+            done = 0
+            for item in all_items:
+                replacement = None
+                if item.filename.startswith(DOCX_MEDIA_DIR):
+                    _, replacement = next(cleaned_images)
+                    if replacement is None:
+                        logger.info(f"{input_file} => {item.filename} is not a supported image, copied as is.")
+                    done += 1
+                with stage('zip_write'):
+                    write_zip_entry(zin, zout, item, replacement)
+                if progress and item.filename.startswith(DOCX_MEDIA_DIR):
+                    progress(done, len(images))
+    return str(output_file)
+
+
+def remove_watermark_from_image(input_file: Union[Path, BinaryIO], output_file: Union[Path, BinaryIO],
+                                method_choice: MethodChoice,
+                                binarize: str = None, tile_height: int = None,
+                                preset: Union[str, EncodePreset] = None,
+                                cache: Union[str, Path, ResultCache] = None, progress: Progress = None,
+                                template: WatermarkTemplate = None) -> str:
     """
     Remove watermark from image
-    :param input_file:
-    :param output_file:
+    :param input_file: path or seekable file object
+    :param output_file: path or file object
     :param method_choice:
+    :param binarize: black and white post-processing (see remove_watermark_from_pil_image)
+    :param tile_height: process big images by strips (see remove_watermark_from_pil_image)
+    :param preset: encoding preset: default, fast or small (see encoding.py)
+    :param cache: cache of the cleaned images (see cache.py)
+    :param progress: called with (1, 1) once the image is written
+    :param template: watermark mask (see remove_watermark_from_pil_image)
     :return:
     """
-    pil_image = Image.open(input_file)
-    pil_image = remove_watermark_from_pil_image(pil_image, method_choice)
-    pil_image.save(output_file)
+    result_cache = open_cache(cache)
+    if result_cache is not None:
+        if isinstance(input_file, (str, Path)):
+            input_data = Path(input_file).read_bytes()
+        else:
+            input_file.seek(0)
+            input_data = input_file.read()
+        data = remove_watermark_from_docx_media(input_data, method_choice, binarize, tile_height, preset,
+                                                result_cache, template)
+        if data is None:
+            raise Exception(f"Unsupported image: {input_file}")
+    else:
+        from PIL import Image
+        from encoding import encode_image
+        if isinstance(input_file, (str, Path)):
+            source_size = Path(input_file).stat().st_size
+        else:
+            source_size = input_file.seek(0, io.SEEK_END)
+            input_file.seek(0)
+        pil_image = Image.open(input_file)
+        source_format = pil_image.format
+        pil_image = remove_watermark_from_pil_image(pil_image, method_choice, binarize=binarize,
+                                                    tile_height=tile_height, template=template)
+        with stage('encode'):
+            data, stats = encode_image(pil_image, source_format, preset, source_size=source_size)
+        count('images')
+        logger.info(f"{input_file} encoded: {stats}")
+    if isinstance(output_file, (str, Path)):
+        with open(output_file, 'wb') as f:
+            f.write(data)
+    else:
+        output_file.write(data)
+    if progress:
+        progress(1, 1)
     return str(output_file)
 
 
-def main(input_file: Union[str, Path], output_file: Union[str, Path] = None, method_choice: MethodChoice = None) -> str:
+def file_cache_key(input_hash: str, file_type: FileType, method_choice: MethodChoice = None,
+                   signature_set: str = None, binarize: str = None,
+                   preset: Union[str, EncodePreset] = None, save_profile: Union[str, SaveProfile] = None,
+                   template: WatermarkTemplate = None) -> str:
+    """Key of the whole output of a pdf or a docx in the cache (see cache.py)."""
+    from encoding import as_preset, as_save_profile
+    geos = method_choice == MethodChoice.geos
+    # the signatures of the set, not only its name: the signatures file can change
+    return cache_key('file', input_hash, method_choice, suffix=file_type.value, binarize=binarize,
+                     preset=as_preset(preset).name,
+                     signature_set=signature_set if geos else None,
+                     signatures=signatures.REGISTRY.cache_key(signature_set) if geos else None,
+                     save_profile=as_save_profile(save_profile).name if file_type == FileType.pdf else None,
+                     template=template.key if template is not None and method_choice == MethodChoice.openCV2 else None)
+
+
+def remove_watermark_by_file_type(file_type: FileType, input_file: Union[Path, BinaryIO],
+                                  output_file: Union[Path, BinaryIO], method_choice: MethodChoice = None,
+                                  workers: int = 1, signature_set: str = None, binarize: str = None,
+                                  tile_height: int = None, preset: Union[str, EncodePreset] = None,
+                                  cache: ResultCache = None, progress: Progress = None,
+                                  save_profile: Union[str, SaveProfile] = None,
+                                  template: WatermarkTemplate = None) -> str:
+    """Remove watermark from a file of a known type (see main for the arguments)."""
+    if method_choice != MethodChoice.openCV2:
+        template = None
+    if template is not None:
+        cache = None  # the cleaned images depend on the other images of the document
+    if file_type == FileType.pdf:
+        return remove_watermark_from_pdf(input_file, output_file, method_choice, workers, signature_set,
+                                         tile_height=tile_height, binarize=binarize, preset=preset, cache=cache,
+                                         progress=progress, save_profile=save_profile, template=template)
+    elif file_type == FileType.docx:
+        return remove_watermark_from_docx(input_file, output_file, method_choice, binarize, tile_height=tile_height,
+                                          workers=workers, preset=preset, cache=cache, progress=progress,
+                                          template=template)
+    else:
+        return remove_watermark_from_image(input_file, output_file, method_choice, binarize,
+                                           tile_height=tile_height, preset=preset, cache=cache, progress=progress,
+                                           template=template)
+
+
+def remove_watermark_from_bytes(source: Source, output: BinaryIO = None, method_choice: MethodChoice = None,
+                                workers: int = 1, signature_set: str = None, binarize: str = None,
+                                tile_height: int = None, preset: Union[str, EncodePreset] = None,
+                                cache: Union[str, Path, ResultCache] = None,
+                                file_type: Union[str, FileType] = None, progress: Progress = None,
+                                save_profile: Union[str, SaveProfile] = None,
+                                template: Union[str, Path, WatermarkTemplate] = None) -> Optional[bytes]:
+    """
+    Remove watermark from a file in memory, without temporary files
+    :param source: content of the file: bytes, memoryview or file object
+    :param output: file object the cleaned file is written to (default: returned as bytes)
+    :param method_choice:
+    :param workers: see main
+    :param signature_set: see main
+    :param binarize: see main
+    :param tile_height: see main
+    :param preset: see main
+    :param cache: see main
+    :param file_type: pdf, docx, png or jpg (default: detected from the content)
+    :param progress: see main
+    :param save_profile: see main
+    :param template: see main
+    :return: cleaned file, None if it was written to output
+    """
+    input_stream = as_seekable_stream(source)
+    if isinstance(file_type, str):
+        file_type = FileType.from_str(file_type)
+    file_type = file_type or detect_file_type(input_stream)
+    if file_type is None:
+        raise UnsupportedFileType("Unsupported file type")
+    result_cache = open_cache(cache)
+    if template is not None:
+        from template import open_template
+        template = open_template(template)
+    file_key = None
+    if result_cache is not None and file_type in (FileType.pdf, FileType.docx):
+        file_key = file_cache_key(file_hash(input_stream), file_type, method_choice, signature_set, binarize, preset,
+                                  save_profile, template)
+        data = result_cache.get_bytes('file', file_key)
+        if data is not None:
+            if output is None:
+                return data
+            output.write(data)
+            return None
+    # written to memory first to be cached
+    target = io.BytesIO() if output is None or file_key is not None else output
+    remove_watermark_by_file_type(file_type, input_stream, target, method_choice, workers, signature_set, binarize,
+                                  tile_height, preset, result_cache, progress, save_profile, template)
+    if file_key is not None:
+        result_cache.put_bytes('file', file_key, target.getvalue())
+    if output is None:
+        return target.getvalue()
+    if target is not output:
+        output.write(target.getbuffer())
+    return None
+
+
+def main(input_file: Union[str, Path], output_file: Union[str, Path] = None, method_choice: MethodChoice = None,
+         workers: int = 1, signature_set: str = None, binarize: str = None, tile_height: int = None,
+         preset: Union[str, EncodePreset] = None, cache: Union[str, Path, ResultCache] = None,
+         cache_max_bytes: int = None, progress: Progress = None, save_profile: Union[str, SaveProfile] = None,
+         template: Union[str, Path, WatermarkTemplate] = None) -> str:
     """
     Entry point
     :param input_file:
     :param output_file:
     :param method_choice:
+    :param workers: number of workers used for a single file (processes for pages of GEOS pdf, threads for docx)
+    :param signature_set: name of the signature set used for GEOS pdf (see signatures.py)
+    :param binarize: black and white post-processing of images: global, otsu or adaptive
+    :param tile_height: process big images by strips of tile_height rows to bound the memory used (OpenCV2)
+    :param preset: encoding of the cleaned images: default, fast or small
+    :param cache: directory of the cache of cleaned files and images (default: disabled, see cache.py)
+    :param cache_max_bytes: size of the cache (default: 1 GB), least recently used entries are evicted
+    :param progress: called with (done, total) as the file is processed: pages of pdf, images of docx, (1, 1) for
+    images. It runs in the processing thread and can raise to stop the processing.
+    :param save_profile: how pdf are saved: default, fast (compressed streams copied as they are), compact (object
+    streams, streams recompressed) or web (linearized)
+    :param template: OpenCV2 only: 'learn' to compute the watermark mask from the first images of the document and only
+    process its bounding box in the next images of the same size, or a template file (see template.py)
+    Stages and counters are recorded in the current report, if any (see instrumentation.py).
     :return:
     """
-    input_path = Path(input_file)
-    if not input_path or not input_path.exists():
-        raise FileNotFoundError(f"File {input_path} does not exist")
-    # generate output path
-    if not output_file:
-        output_path = generate_output_path(input_path)
-    else:
-        output_path = Path(output_file)
-    # remove output file if it exists
-    if output_path.exists():
-        output_path.unlink()
-    # remove watermark
-    if str(input_path.suffix).lower() == ".pdf":
-        return remove_watermark_from_pdf(input_path, output_path, method_choice)
-    elif str(input_path.suffix).lower() == ".docx":
-        return remove_watermark_from_docx(input_path, output_path, method_choice)
-    elif str(input_path.suffix).lower() in [".png", ".jpg", ".jpeg"]:
-        return remove_watermark_from_image(input_path, output_path, method_choice)
-    else:
-        raise Exception(f"Unsupported file type: {input_path.suffix}")
+    with instrument_call(str(input_file)), stage('main'):
+        input_path = Path(input_file)
+        if not input_path or not input_path.exists():
+            raise FileNotFoundError(f"File {input_path} does not exist")
+        # generate output path
+        if not output_file:
+            output_path = generate_output_path(input_path)
+        else:
+            output_path = Path(output_file)
+        # remove output file if it exists
+        if output_path.exists():
+            output_path.unlink()
+        # type from the content: files with a wrong extension are still supported
+        file_type = detect_file_type(input_path)
+        if file_type is None:
+            raise UnsupportedFileType(f"Unsupported file type: {input_path.suffix}")
+        result_cache = open_cache(cache, cache_max_bytes)
+        if template is not None:
+            from template import open_template
+            template = open_template(template)
+        # same file already cleaned with the same parameters (images are cached by remove_watermark_from_image)
+        file_key = None
+        if result_cache is not None and file_type in (FileType.pdf, FileType.docx):
+            file_key = file_cache_key(file_hash(input_path), file_type, method_choice, signature_set, binarize, preset,
+                                      save_profile, template)
+            if result_cache.copy_to('file', file_key, output_path):
+                logger.info(f"{input_path} => {output_path} from the cache.")
+                count('files_from_cache')
+                return str(output_path)
+        # remove watermark
+        result = remove_watermark_by_file_type(file_type, input_path, output_path, method_choice, workers,
+                                               signature_set, binarize, tile_height, preset, result_cache, progress,
+                                               save_profile, template)
+        if file_key is not None:
+            result_cache.put_file('file', file_key, output_path)
+        count('files')
+        count('bytes_in', input_path.stat().st_size)
+        count('bytes_out', output_path.stat().st_size)
+        return result
 
 
 def mmain(input_files: List[Union[str, Path]], output_dir: Union[str, Path] = None,
-          method_choice: MethodChoice = None) -> List[str]:
+          method_choice: MethodChoice = None, workers: int = 1, **options) -> List[str]:
     """
     Entry point
     :param input_files:
     :param output_dir:
     :param method_choice:
-    :return:
+    :param workers: number of worker processes (use batch.run_batch to get per-file results instead of raising)
+    :param options: on_clean and min_confidence to skip or copy the files without watermark (see batch.process_file),
+    other arguments of main
+    :return: output files (None for skipped files)
     """
-    output_files = []
-    for input_file in input_files:
-        input_path = Path(input_file)
-        if not output_dir:
-            output_dir = input_path.parent
-        output_file = output_dir / (input_path.stem + f"_generated{input_path.suffix}")
-        output_file = main(input_file, output_file, method_choice)
-        output_files.append(output_file)
-    return output_files
+    from batch import run_batch
+    with instrument_call('mmain'):
+        results = run_batch(input_files, output_dir, method_choice, workers, **options)
+    for result in results:
+        if not result.ok:
+            raise result.error
+    return [result.output_file for result in results]
 
 
 if __name__ == "__main__":
+    import fire
     fire.Fire(main)
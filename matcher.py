@@ -0,0 +1,254 @@
+"""
+Compiled watermark matcher: removes every watermark signature from a content stream in a single pass.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+from collections import Counter
+from decimal import Decimal
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pikepdf import ContentStreamInstruction
+
+Signature = Union[str, List[bytes]]
+
+_NUMBER_TYPES = (int, float, Decimal)
+_END = None  # key of the trie nodes ending a signature
+# literal strings without escapes nor nested parentheses, and hex strings, in the order of the content stream
+_STRING = re.compile(rb'\(([^()\\]*)\)|<([0-9A-Fa-f\s]*)>')
+# operator delimited like in a content stream: not the start of another keyword
+_AFTER_OPERATOR = rb'(?![^\s()<>\[\]{}/%])'
+# operands (see _STRING) of the "Tj" operators, and arrays of the "TJ" operators
+_TJ_STRING = re.compile(rb'(?:\(([^()\\]*)\)|<([0-9A-Fa-f\s]*)>)\s*Tj' + _AFTER_OPERATOR)
+_TJ_ARRAY = re.compile(rb'\[((?:\s*(?:\([^()\\]*\)|<[0-9A-Fa-f\s]*>|[-+.0-9]+))*)\s*\]\s*TJ' + _AFTER_OPERATOR)
+_UNICODE_MARKERS = (b'\xfe\xff', b'\xef\xbb\xbf')
+# characters of the PDFDocEncoding decoded to themselves: signatures made of them are searched in the raw bytes
+_RAW_CHARS = frozenset(chr(c) for c in (*range(0x00, 0x18), *range(0x20, 0x7f)))
+
+
+class MatchResult(NamedTuple):
+    instructions: List[ContentStreamInstruction]
+    hits: Dict[str, int]  # number of removed instructions by signature label
+    used_fallback: bool  # True if no "Tj" signature matched and fallback_orders were used
+
+
+def signature_label(signature: Signature) -> str:
+    if isinstance(signature, str):
+        return signature
+    return b''.join(signature).hex()
+
+
+def signature_tokens(signature: Signature) -> Tuple[bytes, ...]:
+    """Tokens compared to the characters (or the strings) of a "TJ" operator, like remove_tj_maj."""
+    if isinstance(signature, str):
+        return tuple(bytes(c, 'utf-8') for c in signature)
+    return tuple(signature)
+
+
+def _string_value(match: re.Match) -> bytes:
+    literal, hexadecimal = match.groups()
+    if literal is not None:
+        return literal
+    hexadecimal = b''.join(hexadecimal.split())
+    return bytes.fromhex((hexadecimal + b'0' * (len(hexadecimal) % 2)).decode())
+
+
+def text_operands(content: bytes) -> Optional[Tuple[bytes, List[bytes]]]:
+    """
+    Operands of the "Tj" and "TJ" operators of a content stream, without parsing it
+    :param content: decoded content stream
+    :return: strings of the "Tj" operators concatenated in order, strings of each "TJ" operator concatenated, None
+    if some strings or operators are not handled (escapes, nested parentheses, unicode, inline images, ...)
+    """
+    if b'\\' in content or any(marker in content for marker in _UNICODE_MARKERS):
+        return None
+    # every string was found: no "(" nor "<" left outside of the dictionaries once they are removed
+    operators = _STRING.sub(b' ', content)
+    if b'(' in operators or b')' in operators or operators.count(b'<') != 2 * operators.count(b'<<'):
+        return None
+    tj_strings = [_string_value(match) for match in _TJ_STRING.finditer(content)]
+    tj_arrays = [b''.join(_string_value(string) for string in _STRING.finditer(match.group(1)))
+                 for match in _TJ_ARRAY.finditer(content)]
+    # every operator was found (names and other keywords containing them are not handled)
+    if len(tj_strings) != operators.count(b'Tj') or len(tj_arrays) != operators.count(b'TJ'):
+        return None
+    return b''.join(tj_strings), tj_arrays
+
+
+class _TjRun:
+    """State of the successive "Tj" operators matching a text, like remove_tjs_min."""
+    __slots__ = ('text', 'label', 'indexes', 'found')
+
+    def __init__(self, label: str, text: str):
+        self.text = text
+        self.label = label
+        self.indexes = []
+        self.found = ""
+
+    def reset(self):
+        self.indexes = []
+        self.found = ""
+
+
+class WatermarkMatcher:
+    """
+    Set of watermark signatures compiled once, matched in a single pass over the instructions of a page:
+    - tj_prefixes: "TJ" operators starting with one of them are removed (see remove_tj_maj)
+    - tj_runs: successive "Tj" operators combined equal to one of them are removed (see remove_tjs_min)
+    - fallback_orders: instructions removed by reversed orders of operators if none of tj_runs matched
+      (see remove_by_reversed_orders)
+    Pages whose content stream can not match any of them can be skipped before parsing (see may_match): the
+    tj_runs are searched in the strings of the "Tj" operators, the tj_prefixes at the start of each "TJ" operator.
+    With the prefilter, fallback_orders only apply to pages where one of the signatures is found: on a page without
+    any signature, the last fill is part of the page, not a watermark.
+    """
+
+    def __init__(self, tj_prefixes: Union[Iterable[Signature], Dict[str, Signature]] = (),
+                 tj_runs: Union[Iterable[str], Dict[str, str]] = (),
+                 fallback_orders: Optional[Dict[str, List[int]]] = None, prefilter: bool = True):
+        """
+        :param tj_prefixes: signatures, or {label: signature} to name them in the hits
+        :param tj_runs: texts, or {label: text} to name them in the hits
+        :param fallback_orders: {operator: reversed orders}, the operator is the label in the hits
+        :param prefilter: False if every page must be parsed (fallback_orders also applied to pages without
+        signatures)
+        """
+        if not isinstance(tj_prefixes, dict):
+            tj_prefixes = {signature_label(signature): signature for signature in tj_prefixes}
+        if not isinstance(tj_runs, dict):
+            tj_runs = {text: text for text in tj_runs}
+        self.trie = {}
+        for label, signature in tj_prefixes.items():
+            tokens = signature_tokens(signature)
+            if not tokens:
+                continue
+            node = self.trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[_END] = label
+        self.tj_runs = {label: text for label, text in tj_runs.items() if text}
+        self.fallback_orders = fallback_orders or {}
+        self.labels = [*tj_prefixes.keys(), *self.tj_runs.keys(), *self.fallback_orders.keys()]
+        # bytes searched in the strings of a content stream by may_match, None to parse every page
+        self.needles: Optional[Tuple[bytes, ...]] = None
+        self.prefix_needles: Tuple[bytes, ...] = ()
+        self.run_needles: Tuple[bytes, ...] = ()
+        prefixes = [text for text in (b''.join(signature_tokens(signature)).decode('utf-8', 'replace')
+                                      for signature in tj_prefixes.values()) if text]
+        texts = prefixes + list(self.tj_runs.values())
+        if prefilter and texts and all(_RAW_CHARS.issuperset(text) for text in texts):
+            self.needles = tuple(text.encode('latin-1') for text in texts)
+            self.prefix_needles, self.run_needles = self.needles[:len(prefixes)], self.needles[len(prefixes):]
+        # changes with anything changing the output of apply (part of the cache keys, see main.file_cache_key)
+        self.fingerprint = hashlib.sha256(repr((
+            sorted((label, signature_tokens(signature)) for label, signature in tj_prefixes.items()),
+            sorted(self.tj_runs.items()),
+            sorted((operator, list(orders)) for operator, orders in self.fallback_orders.items()),
+            self.needles is not None,
+        )).encode()).hexdigest()
+
+    def may_match(self, content: bytes) -> bool:
+        """
+        Fast check of a content stream before parsing it: False if none of the signatures can match it.
+        :param content: decoded content stream of a page
+        :return: True if the page must be parsed
+        """
+        if self.needles is None or any(needle in content for needle in self.needles):
+            return True
+        return self.search(content) is not False
+
+    def search(self, content: bytes) -> Optional[bool]:
+        """
+        Search the signatures in the strings of a content stream, without parsing it.
+        :param content: decoded content stream of a page
+        :return: True if one of the signatures is in the strings, False if none is, None if it can not be known
+        """
+        if self.needles is None:
+            return None
+        operands = text_operands(content)
+        if operands is None:
+            return True if any(needle in content for needle in self.needles) else None
+        tj_strings, tj_arrays = operands
+        return any(needle in tj_strings for needle in self.run_needles) or \
+            any(array.startswith(needle) for array in tj_arrays for needle in self.prefix_needles)
+
+    def match_tj(self, array) -> Optional[str]:
+        """
+        Match the operand of a "TJ" operator against tj_prefixes.
+        :param array:
+        :return: label of the matched signature or None
+        """
+        if not self.trie:
+            return None
+        char_node = operand_node = self.trie
+        for item in array:
+            if type(item) in _NUMBER_TYPES:
+                continue
+            operand_str = item.__str__()
+            # compare with the whole strings of the operator
+            if operand_node is not None:
+                operand_node = operand_node.get(bytes(operand_str, 'utf-8'))
+                if operand_node is not None and _END in operand_node:
+                    return operand_node[_END]
+            # compare with the characters of the operator
+            if char_node is not None:
+                for c in operand_str:
+                    char_node = char_node.get(bytes(c, 'utf-8'))
+                    if char_node is None:
+                        break
+                    if _END in char_node:
+                        return char_node[_END]
+            if char_node is None and operand_node is None:
+                return None
+        return None
+
+    def apply(self, instructions: List[ContentStreamInstruction]) -> MatchResult:
+        """
+        Remove all signatures from instructions in a single pass.
+        :param instructions:
+        :return: remaining instructions, hits and whether fallback_orders were used
+        """
+        hits = Counter()
+        removed = [False] * len(instructions)
+        runs = [_TjRun(label, text) for label, text in self.tj_runs.items()]
+        runs_matched = False
+        positions = {op: [] for op in self.fallback_orders}
+        for i, instruction in enumerate(instructions):
+            op = instruction.operator.__str__()
+            if op in positions:
+                positions[op].append(i)
+            if op == 'Tj':
+                text = instruction.operands[0].__str__()
+                for run in runs:
+                    run.indexes.append(i)
+                    run.found += text
+                continue
+            for run in runs:
+                if run.found:
+                    if not run.text.startswith(run.found):
+                        run.reset()
+                    elif run.text == run.found:
+                        for index in run.indexes:
+                            removed[index] = True
+                        hits[run.label] += len(run.indexes)
+                        runs_matched = True
+                        run.reset()
+                else:
+                    run.reset()
+            if op == 'TJ':
+                label = self.match_tj(instruction.operands[0])
+                if label is not None:
+                    removed[i] = True
+                    hits[label] += 1
+        used_fallback = bool(self.tj_runs) and not runs_matched
+        if used_fallback:
+            for op, orders in self.fallback_orders.items():
+                op_positions = positions[op]
+                for order in orders:
+                    if order < len(op_positions) and not removed[op_positions[-1 - order]]:
+                        removed[op_positions[-1 - order]] = True
+                        hits[op] += 1
+        return MatchResult([x for x, r in zip(instructions, removed) if not r], dict(hits), used_fallback)
@@ -0,0 +1,154 @@
+"""
+Preview: the selected method run on a downsampled copy of the first image of a file, to see whether it works before
+cleaning a whole batch. Nothing is written but the preview itself.
+
+JPEG images (image files and images of pdf and docx) are decoded at a lower scale, other images are downsampled once
+decoded. GEOS pdf have no preview: the watermark is removed from the text of the pages, not from images (see scan.py).
+
+usage:
+python preview.py scan.jpg --method_choice=openCV2 --output=preview.png
+"""
+
+from __future__ import annotations
+
+import time
+import zipfile
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Optional, Tuple, Union, TYPE_CHECKING
+
+from main import MethodChoice, FileType, detect_file_type, open_raster_image, reduce_image, \
+    remove_watermark_from_pil_image, DOCX_MEDIA_DIR
+from instrumentation import stage
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = getLogger(__name__)
+
+PREVIEW_SIZE = 1024  # longest side of the image the method is run on
+PREVIEW_MARGIN = 8  # between the images of side_by_side
+
+
+@dataclass
+class Preview:
+    """An image of a file before and after the removal, downsampled."""
+    input_file: str
+    method_choice: MethodChoice
+    before: Image.Image
+    after: Image.Image
+    source: str  # image of the file: file name, docx entry or pdf image number
+    full_size: Tuple[int, int]  # width, height of the image at full resolution
+    elapsed: float = 0.0  # seconds
+
+    @property
+    def scale(self) -> float:
+        return self.before.width / self.full_size[0]
+
+    def side_by_side(self, max_size: int = None) -> Image.Image:
+        """
+        Before and after images next to each other
+        :param max_size: longest side of each image (default: as they are)
+        :return:
+        """
+        from PIL import Image
+        before, after = self.before, self.after
+        if max_size:
+            before, after = before.copy(), after.copy()
+            before.thumbnail((max_size, max_size), Image.BOX)
+            after.thumbnail((max_size, max_size), Image.BOX)
+        image = Image.new('RGB', (before.width + PREVIEW_MARGIN + after.width, max(before.height, after.height)),
+                          (128, 128, 128))
+        image.paste(before, (0, 0))
+        image.paste(after.convert('RGB'), (before.width + PREVIEW_MARGIN, 0))
+        return image
+
+    def to_dict(self) -> dict:
+        return {
+            'input_file': self.input_file,
+            'method_choice': self.method_choice.name,
+            'source': self.source,
+            'full_size': list(self.full_size),
+            'preview_size': [self.before.width, self.before.height],
+            'elapsed': round(self.elapsed, 3),
+        }
+
+
+def first_image(input_file: Union[str, Path], file_type: FileType) -> Optional[Tuple[str, Image.Image]]:
+    """
+    First raster image of a file, opened but not decoded (when possible)
+    :param input_file:
+    :param file_type:
+    :return: (name, image), None if the file has no image
+    """
+    from PIL import Image
+    if file_type == FileType.pdf:
+        from pikepdf import Pdf
+        from scan import pdf_images
+        with Pdf.open(input_file) as pdf:
+            # JPEG images are opened from a copy of their data: they can be decoded once the pdf is closed
+            image = next(pdf_images(pdf), None)
+        return ("image 1", image) if image is not None else None
+    if file_type == FileType.docx:
+        with zipfile.ZipFile(input_file) as z:
+            for name in z.namelist():
+                if name.startswith(DOCX_MEDIA_DIR):
+                    image = open_raster_image(z.read(name))
+                    if image is not None:
+                        return name, image
+        return None
+    return Path(input_file).name, Image.open(input_file)
+
+
+def preview(input_file: Union[str, Path], method_choice: MethodChoice, size: int = PREVIEW_SIZE,
+            binarize: str = None) -> Preview:
+    """
+    Run a method on a downsampled copy of the first image of a file
+    :param input_file: pdf, docx or image
+    :param method_choice: colors_replacement or openCV2
+    :param size: longest side of the preview
+    :param binarize: see main
+    :return:
+    :raise ValueError: GEOS method, or no image in the file
+    """
+    from PIL import Image
+    if method_choice == MethodChoice.geos:
+        raise ValueError("GEOS removes the watermark from the text of pdf pages: there is no image to preview")
+    start = time.perf_counter()
+    file_type = detect_file_type(Path(input_file))
+    if file_type is None:
+        raise ValueError(f"Unsupported file type: {Path(input_file).suffix}")
+    image = first_image(input_file, file_type)
+    if image is None:
+        raise ValueError(f"No image to preview in {input_file}")
+    source, image = image
+    full_size = image.size
+    with stage('preview_decode'):
+        # nearest: exact colors for "Replace colors"
+        before = reduce_image(image, size, Image.NEAREST if method_choice == MethodChoice.colors_replacement else None)
+    after = remove_watermark_from_pil_image(before.copy(), method_choice, binarize=binarize)
+    return Preview(str(input_file), method_choice, before, after, source, full_size,
+                   time.perf_counter() - start)
+
+
+def preview_cli(input_file: str, method_choice: str = 'openCV2', output: str = None, size: int = PREVIEW_SIZE,
+                binarize: str = None) -> dict:
+    """
+    CLI entry point
+    :param input_file:
+    :param method_choice: colors_replacement or openCV2
+    :param output: image the before and after images are saved to, side by side (default: not saved)
+    :param size: longest side of the preview
+    :param binarize: see main
+    :return:
+    """
+    result = preview(input_file, MethodChoice.from_str(method_choice), size, binarize)
+    if output:
+        result.side_by_side().save(output)
+    return {**result.to_dict(), 'output': output}
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(preview_cli)
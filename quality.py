@@ -1,29 +1,46 @@
 from PIL import Image
+import cv2
+import numpy as np
 
+BINARIZATION_METHODS = ('global', 'otsu', 'adaptive')
 
-def improve_text_in_image(image: Image) -> Image:
+
+def binarize_array(gray: np.ndarray, method: str = 'global', threshold: int = 160, block_size: int = 31,
+                   c: int = 10) -> np.ndarray:
     """
-    Improve the quality of the text in the image.
-    :param image:
+    Threshold a grayscale array into black (0) and white (255) pixels.
+    :param gray: height x width uint8 array
+    :param method: global (pixels darker than threshold become black), otsu or adaptive
+    :param threshold: used by the global method
+    :param block_size: size of the neighbourhood used by the adaptive method (odd)
+    :param c: constant subtracted from the neighbourhood mean by the adaptive method
     :return:
     """
-    black = (0, 0, 0)
-    white = (255, 255, 255)
-    threshold = (160, 160, 160)
-    image = image.convert("LA")
-    pixels = image.getdata()
-    new_pixels = []
+    if method == 'global':
+        return cv2.threshold(gray, threshold - 1, 255, cv2.THRESH_BINARY)[1]
+    elif method == 'otsu':
+        return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    elif method == 'adaptive':
+        return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size, c)
+    else:
+        raise NotImplementedError
+
 
-    for pixel in pixels:
-        if pixel < threshold:
-            new_pixels.append(black)
-            # new_pixels.append(pixel)
-        else:
-            new_pixels.append(white)
-    # return Image.new(image.mode, image.size)
-    image = Image.new("RGB", image.size)
-    image.putdata(new_pixels)
-    return image
+def improve_text_in_image(image: Image, method: str = 'global', threshold: int = 160, output_mode: str = 'L') -> \
+        Image:
+    """
+    Improve the quality of the text in the image.
+    :param image:
+    :param method: global, otsu or adaptive (see binarize_array)
+    :param threshold: used by the global method
+    :param output_mode: L (8-bit grayscale) or 1 (1-bit)
+    :return: black and white image
+    """
+    gray = np.asarray(image.convert("L"))
+    binary = binarize_array(gray, method, threshold)
+    if output_mode == '1':
+        return Image.fromarray(binary > 0)
+    return Image.fromarray(binary)
 
 
 """
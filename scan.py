@@ -0,0 +1,303 @@
+"""
+Triage: find out which files have a known watermark, doing the least work possible and writing nothing.
+
+- pdf: signatures searched in the raw bytes of the content streams (see WatermarkMatcher.search), images of the pages
+  checked like image files
+- docx: images of word/media checked like image files
+- images: downsampled (JPEG decoded at a lower scale), then share of the pixels with a color of the palette of
+  "Replace colors" and share of the light pixels "OpenCV2" would make white
+
+usage:
+python scan.py file1.pdf file2.docx --method_choice=openCV2
+"""
+
+import io
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from logging import getLogger
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+import signatures
+from main import MethodChoice, FileType, detect_file_type, page_content, open_raster_image, reduce_image, \
+    UnsupportedFileType, CV_SATURATION_THRESHOLD, CV_VALUE_THRESHOLD, DEFAULT_COLOR_REPLACEMENTS, DOCX_MEDIA_DIR
+from instrumentation import stage, count
+
+logger = getLogger(__name__)
+
+SCAN_SIZE = 512  # longest side of the images once downsampled
+SCAN_WHITE_LEVEL = 245  # pixels with every channel from this level are already white
+SCAN_JPEG_TOLERANCE = 8  # max difference per channel to a color of the palette in lossy images
+# share of the pixels of an image above which it is watermarked
+SCAN_PALETTE_MIN_RATIO = 0.001
+SCAN_HSV_MIN_RATIO = 0.01
+SCAN_MIN_CONFIDENCE = 0.9  # clean files with a lower confidence are processed by batches anyway
+
+
+class Verdict(Enum):
+    watermarked = "Watermarked"
+    clean = "Clean"
+    unknown = "Unknown"
+
+    @staticmethod
+    def from_str(label):
+        if label in ('watermarked',):
+            return Verdict.watermarked
+        elif label in ('clean',):
+            return Verdict.clean
+        elif label in ('unknown',):
+            return Verdict.unknown
+        else:
+            raise NotImplementedError
+
+
+@dataclass
+class ScanResult:
+    """Verdict of the scan of a single file."""
+    input_file: str
+    verdict: Verdict = Verdict.unknown
+    confidence: float = 0.0  # 0 to 1
+    file_type: Optional[FileType] = None
+    checks: Dict[str, float] = field(default_factory=dict)  # measures the verdict is based on
+    elapsed: float = 0.0  # seconds
+    error: Optional[BaseException] = None
+
+    def is_clean(self, min_confidence: float = SCAN_MIN_CONFIDENCE) -> bool:
+        return self.verdict == Verdict.clean and self.confidence >= min_confidence
+
+    def to_dict(self) -> dict:
+        return {
+            'input_file': self.input_file,
+            'verdict': self.verdict.value,
+            'confidence': round(self.confidence, 3),
+            'file_type': self.file_type.name if self.file_type else None,
+            'checks': {name: round(value, 6) for name, value in self.checks.items()},
+            'elapsed': round(self.elapsed, 3),
+            'error': str(self.error) if self.error else None,
+        }
+
+
+def ratio_verdict(ratio: float, min_ratio: float) -> Tuple[Verdict, float]:
+    """
+    Verdict of a share of watermark pixels
+    :param ratio:
+    :param min_ratio: images with a higher ratio are watermarked
+    :return: verdict, confidence: 0.5 at min_ratio, 1 at 0 or from twice min_ratio
+    """
+    if ratio >= min_ratio:
+        return Verdict.watermarked, min(1.0, 0.5 + 0.5 * (ratio - min_ratio) / min_ratio)
+    return Verdict.clean, 1.0 - 0.5 * ratio / min_ratio
+
+
+def combine_verdicts(verdicts: List[Tuple[Verdict, float]]) -> Tuple[Verdict, float]:
+    """Watermarked if any check says so, unknown if any check could not tell, clean otherwise (nothing to clean)."""
+    watermarked = [confidence for verdict, confidence in verdicts if verdict == Verdict.watermarked]
+    if watermarked:
+        return Verdict.watermarked, max(watermarked)
+    if any(verdict == Verdict.unknown for verdict, _ in verdicts):
+        return Verdict.unknown, 0.0
+    return Verdict.clean, min((confidence for _, confidence in verdicts), default=1.0)
+
+
+def image_checks(image, method_choice: MethodChoice = None, lossy: bool = None) -> Dict[str, float]:
+    """
+    Share of the pixels of a downsampled image the cleaning would change
+    :param image: PIL image (JPEG images are decoded at a lower scale)
+    :param method_choice: openCV2 (hsv), None (both) or other methods (palette, like remove_watermark_from_pil_image)
+    :param lossy: compare the colors to the palette with a tolerance (default: JPEG images)
+    :return: {'palette': ratio, 'hsv': ratio}
+    """
+    import numpy as np
+    from PIL import Image
+    if lossy is None:
+        lossy = image.format == 'JPEG'
+    # nearest: the colors of the pixels are kept as they are
+    image = reduce_image(image, SCAN_SIZE, Image.NEAREST)
+    rgb = np.asarray(image)
+    pixels = max(rgb.shape[0] * rgb.shape[1], 1)
+    checks = {}
+    if method_choice != MethodChoice.openCV2:
+        tolerance = SCAN_JPEG_TOLERANCE if lossy else 0
+        signed = rgb.astype(np.int16)
+        matches = np.zeros(rgb.shape[:2], dtype=bool)
+        for color in DEFAULT_COLOR_REPLACEMENTS:
+            color_rgb = np.array([int(color[i:i + 2], 16) for i in (1, 3, 5)], dtype=np.int16)
+            matches |= (np.abs(signed - color_rgb) <= tolerance).all(axis=-1)
+        checks['palette'] = float(matches.sum()) / pixels
+    if method_choice in (None, MethodChoice.openCV2):
+        hsv = np.asarray(image.convert('HSV'))
+        whitened = (hsv[..., 1] <= CV_SATURATION_THRESHOLD) & (hsv[..., 2] > CV_VALUE_THRESHOLD) & \
+                   (rgb.min(axis=-1) < SCAN_WHITE_LEVEL)
+        checks['hsv'] = float(whitened.sum()) / pixels
+    return checks
+
+
+def image_verdict(checks: Dict[str, float]) -> Tuple[Verdict, float]:
+    min_ratios = {'palette': SCAN_PALETTE_MIN_RATIO, 'hsv': SCAN_HSV_MIN_RATIO}
+    return combine_verdicts([ratio_verdict(ratio, min_ratios[name]) for name, ratio in checks.items()])
+
+
+def scan_images(images, method_choice: MethodChoice = None) -> Tuple[Verdict, float, Dict[str, float]]:
+    """
+    Check images until one is watermarked
+    :param images: iterable of PIL images
+    :param method_choice:
+    :return: verdict, confidence, highest ratios
+    """
+    verdicts = []
+    highest = {}
+    for image in images:
+        checks = image_checks(image, method_choice)
+        for name, ratio in checks.items():
+            highest[name] = max(highest.get(name, 0.0), ratio)
+        verdicts.append(image_verdict(checks))
+        if verdicts[-1][0] == Verdict.watermarked:
+            break
+    return (*combine_verdicts(verdicts), highest)
+
+
+def pdf_images(pdf):
+    """Images of the pages of a pdf (each one once), JPEG images are opened without decoding them."""
+    from PIL import Image
+    from pikepdf import PdfImage
+    seen = set()
+    for page in pdf.pages:
+        for raw_image in page.images.values():
+            if raw_image.get('/ImageMask', False) or raw_image.objgen in seen:
+                continue
+            if raw_image.objgen != (0, 0):
+                seen.add(raw_image.objgen)
+            pdf_image = PdfImage(raw_image)
+            if pdf_image.filters == ['/DCTDecode']:
+                yield Image.open(io.BytesIO(raw_image.read_raw_bytes()))  # decoded at a lower scale
+            else:
+                yield pdf_image.as_pil_image()
+
+
+def scan_pdf(input_file: Union[Path, BinaryIO], method_choice: MethodChoice = None,
+             signature_set: str = None) -> Tuple[Verdict, float, Dict[str, float]]:
+    """
+    Scan a pdf: signatures of the content streams (GEOS), then images (other methods)
+    :param input_file: path or seekable file object
+    :param method_choice: None to run every check
+    :param signature_set: see main
+    :return: verdict, confidence, checks
+    """
+    from pikepdf import Pdf
+    matcher = signatures.REGISTRY.get(signature_set)
+    verdicts = []
+    checks = {}
+    with Pdf.open(input_file) as pdf:
+        checks['pages'] = len(pdf.pages)
+        if method_choice in (None, MethodChoice.geos):
+            found = undecided = 0
+            for page in pdf.pages:
+                content = page_content(page)
+                result = matcher.search(content) if content is not None else None
+                if result:
+                    found += 1
+                    break  # one page is enough
+                undecided += result is None
+            checks.update({'signature_pages': found, 'undecided_pages': undecided})
+            if found:
+                verdicts.append((Verdict.watermarked, 1.0))
+            elif undecided:
+                verdicts.append((Verdict.unknown, 0.0))
+            else:
+                verdicts.append((Verdict.clean, 1.0))
+        if method_choice != MethodChoice.geos and (not verdicts or verdicts[0][0] != Verdict.watermarked):
+            verdict, confidence, ratios = scan_images(pdf_images(pdf), method_choice)
+            verdicts.append((verdict, confidence))
+            checks.update(ratios)
+    return (*combine_verdicts(verdicts), checks)
+
+
+def scan_docx(input_file: Union[Path, BinaryIO], method_choice: MethodChoice = None) -> \
+        Tuple[Verdict, float, Dict[str, float]]:
+    """Scan the raster images of a docx (other media are not cleaned)."""
+    with zipfile.ZipFile(input_file) as z:
+        names = [name for name in z.namelist() if name.startswith(DOCX_MEDIA_DIR)]
+
+        def images():
+            for name in names:
+                image = open_raster_image(z.read(name))
+                if image is not None:
+                    yield image
+        verdict, confidence, checks = scan_images(images(), method_choice)
+    checks['media'] = len(names)
+    return verdict, confidence, checks
+
+
+def scan_file(input_file: Union[str, Path], method_choice: MethodChoice = None, signature_set: str = None) -> \
+        ScanResult:
+    """
+    Scan a single file, never raises
+    :param input_file:
+    :param method_choice: method the file would be cleaned with (None to run every check)
+    :param signature_set: see main
+    :return: verdict and confidence (unknown if the file could not be scanned)
+    """
+    from PIL import Image
+    result = ScanResult(input_file=str(input_file))
+    start = time.perf_counter()
+    try:
+        with stage('scan'):
+            result.file_type = detect_file_type(Path(input_file))
+            if result.file_type is None:
+                raise UnsupportedFileType(f"Unsupported file type: {Path(input_file).suffix}")
+            if result.file_type == FileType.pdf:
+                result.verdict, result.confidence, result.checks = scan_pdf(Path(input_file), method_choice,
+                                                                            signature_set)
+            elif result.file_type == FileType.docx:
+                result.verdict, result.confidence, result.checks = scan_docx(Path(input_file), method_choice)
+            else:
+                with Image.open(input_file) as image:
+                    result.verdict, result.confidence, result.checks = scan_images([image], method_choice)
+        count('files_scanned')
+        count(f'files_{result.verdict.name}')
+    except Exception as e:
+        logger.warning(f"{input_file} => failed to scan.", exc_info=e)
+        result.error = e
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def scan_files(input_files: List[Union[str, Path]], method_choice: MethodChoice = None, workers: int = None,
+               signature_set: str = None) -> List[ScanResult]:
+    """
+    Scan many files in parallel
+    :param input_files:
+    :param method_choice:
+    :param workers: number of worker processes, defaults to the number of CPUs (1 to scan in-process)
+    :param signature_set:
+    :return: one result per input file, in the same order as input_files
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(input_files) <= 1:
+        return [scan_file(input_file, method_choice, signature_set) for input_file in input_files]
+    with ProcessPoolExecutor(max_workers=min(workers, len(input_files))) as executor:
+        return list(executor.map(scan_file, input_files, [method_choice] * len(input_files),
+                                 [signature_set] * len(input_files)))
+
+
+def scan(*input_files: str, method_choice: str = None, workers: int = None, signature_set: str = None) -> \
+        List[dict]:
+    """
+    CLI entry point
+    :param input_files:
+    :param method_choice: geos, colors_replacement or openCV2 (default: every check)
+    :param workers:
+    :param signature_set:
+    :return:
+    """
+    p_method_choice = MethodChoice.from_str(method_choice) if method_choice else None
+    return [result.to_dict() for result in scan_files(list(input_files), p_method_choice, workers, signature_set)]
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(scan)
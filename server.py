@@ -0,0 +1,332 @@
+"""
+Long-running service: a localhost HTTP server removing watermarks with a pool of warm worker processes.
+
+usage:
+python server.py --port=8765 --workers=4 --max_queue=16 --cache=/tmp/watermark-cache
+
+endpoints:
+GET  /health   {"status": "ok"}
+GET  /metrics  counters of the requests (see WatermarkService.metrics)
+POST /clean    with a JSON body {"input_file": "...", "output_file": "...", "method_choice": "openCV2", ...}:
+               the file is cleaned in place on the disk of the server, returns {"output_file": "...", "elapsed": ...}
+POST /clean?method_choice=openCV2 with the content of a file as body: returns the cleaned file (the type of the file
+               is detected from its content), cleaned in memory by a worker without temporary files
+options: method_choice, signature_set, binarize, tile_height, preset, save_profile, template (see main.main)
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Dict, Optional, Union
+from urllib.parse import urlsplit, parse_qsl
+
+from cache import open_cache
+from main import main, MethodChoice, remove_watermark_from_bytes
+
+logger = getLogger(__name__)
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+SERVER_MAX_BODY_BYTES = 512 * 1024 * 1024
+SUPPORTED_SUFFIXES = ('.pdf', '.docx', '.png', '.jpg', '.jpeg')
+# options of main accepted by requests and their parsers
+REQUEST_OPTIONS: Dict[str, Callable[[str], object]] = {
+    'method_choice': MethodChoice.from_str,
+    'signature_set': str,
+    'binarize': str,
+    'tile_height': int,
+    'preset': str,
+    'save_profile': str,
+    'template': str,
+}
+
+
+class ServiceBusy(Exception):
+    """The queue of the service is full."""
+
+
+def warm_up():
+    """Import the modules used to clean files, in every worker process when it starts."""
+    import cv2  # noqa: F401
+    import numpy  # noqa: F401
+    import pikepdf  # noqa: F401
+    from PIL import Image  # noqa: F401
+    import encoding  # noqa: F401
+
+
+def clean_bytes(data: Union[bytes, bytearray], cache: str = None, cache_max_bytes: int = None, **options) -> bytes:
+    """
+    Runs in a worker process: remove watermark from the content of a file (see main.remove_watermark_from_bytes)
+    :param data:
+    :param cache: directory of the cache of the service
+    :param cache_max_bytes:
+    :param options: other arguments of remove_watermark_from_bytes
+    :return: content of the cleaned file
+    """
+    return remove_watermark_from_bytes(data, cache=open_cache(cache, cache_max_bytes), **options)
+
+
+def parse_options(options: Dict[str, object]) -> Dict[str, object]:
+    """
+    Options of a request as arguments of main
+    :param options: {name: value as str (or JSON value)}
+    :return:
+    """
+    unknown = set(options) - set(REQUEST_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+    try:
+        return {name: REQUEST_OPTIONS[name](value) if value is not None else None
+                for name, value in options.items()}
+    except (NotImplementedError, ValueError, TypeError):
+        raise ValueError(f"Invalid options: {options}")
+
+
+class WatermarkService:
+    """Pool of warm worker processes running main, with a bounded queue."""
+
+    def __init__(self, workers: int = None, max_queue: int = None, cache: Union[str, Path] = None,
+                 cache_max_bytes: int = None):
+        """
+        :param workers: number of worker processes (default: number of CPUs)
+        :param max_queue: max number of requests waiting for a worker, others are rejected (default: unbounded)
+        :param cache: directory of the cache used by the workers (see cache.py)
+        :param cache_max_bytes:
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.cache_options = {'cache': str(cache), 'cache_max_bytes': cache_max_bytes} if cache else {}
+        self._slots = BoundedSemaphore(self.workers + max_queue) if max_queue is not None else None
+        self._lock = Lock()
+        self._executor = self._new_executor()
+        self._started = time.time()
+        self._counters = {'requests': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'in_flight': 0,
+                          'worker_restarts': 0}
+        self._seconds = 0.0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+        # start every worker now instead of on the first requests
+        for future in [executor.submit(time.sleep, 0.01) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def clean(self, input_file: Union[str, Path], output_file: Union[str, Path] = None, **options) -> str:
+        """
+        Remove watermark from a file in a worker process
+        :param input_file:
+        :param output_file:
+        :param options: other arguments of main
+        :return: output file
+        :raise ServiceBusy: if the queue is full
+        """
+        return self._run(main, str(input_file), str(output_file) if output_file else None,
+                         **{**self.cache_options, **options})
+
+    def clean_bytes(self, data: Union[bytes, bytearray], **options) -> bytes:
+        """
+        Remove watermark from the content of a file in a worker process, without temporary files
+        :param data:
+        :param options: other arguments of main.remove_watermark_from_bytes (file_type, method_choice, ...)
+        :return: content of the cleaned file
+        :raise ServiceBusy: if the queue is full
+        """
+        return self._run(clean_bytes, data, **{**self.cache_options, **options})
+
+    def _run(self, fn: Callable, *args, **kwargs):
+        """Run fn in a worker process, counted in the metrics."""
+        self._count('requests')
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise ServiceBusy(f"{self.workers} files in progress and {self.max_queue} waiting")
+        self._count('in_flight')
+        start = time.perf_counter()
+        try:
+            executor = self._executor
+            try:
+                result = executor.submit(fn, *args, **kwargs).result()
+            except BrokenProcessPool:
+                self._restart(executor)
+                raise
+            self._count('completed')
+            return result
+        except Exception:
+            self._count('failed')
+            raise
+        finally:
+            with self._lock:
+                self._counters['in_flight'] -= 1
+                self._seconds += time.perf_counter() - start
+            if self._slots is not None:
+                self._slots.release()
+
+    def _restart(self, broken_executor: ProcessPoolExecutor):
+        """Replace the pool after a worker crashed (once, whatever the number of requests that failed)."""
+        with self._lock:
+            if self._executor is not broken_executor:
+                return
+            logger.warning("A worker process crashed, restarting the pool.")
+            self._counters['worker_restarts'] += 1
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+        broken_executor.shutdown(wait=False)
+
+    def metrics(self) -> Dict[str, object]:
+        """
+        Counters of the service
+        :return: {'requests', 'completed', 'failed', 'rejected', 'in_flight', 'queued', 'worker_restarts',
+                  'workers', 'max_queue', 'processing_seconds', 'uptime_seconds'}
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            seconds = self._seconds
+        counters.update({
+            'queued': max(counters['in_flight'] - self.workers, 0),
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'processing_seconds': round(seconds, 3),
+            'uptime_seconds': round(time.time() - self._started, 3),
+        })
+        return counters
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    server: 'WatermarkServer'
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+    def _send_json(self, status: HTTPStatus, data: dict, headers: Dict[str, str] = None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: HTTPStatus, message: str, headers: Dict[str, str] = None):
+        self._send_json(status, {'error': message}, headers)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self._send_json(HTTPStatus.OK, {'status': 'ok'})
+        elif path == '/metrics':
+            self._send_json(HTTPStatus.OK, self.server.service.metrics())
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown path: {path}")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/clean':
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown path: {url.path}")
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.server.max_body_bytes:
+            self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Body bigger than {self.server.max_body_bytes}")
+            self.close_connection = True
+            return
+        try:
+            if self.headers.get('Content-Type', '').split(';')[0].strip() == 'application/json':
+                self._clean_path(json.loads(self.rfile.read(length) or b'{}'))
+            else:
+                self._clean_bytes(dict(parse_qsl(url.query)), length)
+        except ServiceBusy as e:
+            self._send_error(HTTPStatus.SERVICE_UNAVAILABLE, str(e), {'Retry-After': '1'})
+        except (ValueError, FileNotFoundError) as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+        except Exception as e:
+            logger.warning(f"{self.path} => failed to remove watermark.", exc_info=e)
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e) or type(e).__name__)
+
+    def _clean_path(self, data: dict):
+        """The file is read and written by the workers."""
+        if not isinstance(data, dict) or not data.get('input_file'):
+            raise ValueError("input_file is required")
+        input_file = data.pop('input_file')
+        output_file = data.pop('output_file', None)
+        start = time.perf_counter()
+        output_file = self.server.service.clean(input_file, output_file, **parse_options(data))
+        self._send_json(HTTPStatus.OK, {'output_file': output_file, 'elapsed': round(time.perf_counter() - start, 3)})
+
+    def _clean_bytes(self, query: Dict[str, str], length: int):
+        """The file is sent in the body of the request, the cleaned file in the body of the response."""
+        suffix = query.pop('suffix', '').lower()  # optional: the type is detected from the content
+        if suffix and not suffix.startswith('.'):
+            suffix = '.' + suffix
+        if suffix and suffix not in SUPPORTED_SUFFIXES:
+            raise ValueError(f"suffix should be one of {', '.join(SUPPORTED_SUFFIXES)}")
+        options = parse_options(query)
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.rfile.read(min(length - len(data), 1024 * 1024))
+            if not chunk:
+                raise ValueError("Truncated body")
+            data += chunk
+        start = time.perf_counter()
+        output = self.server.service.clean_bytes(data, file_type=suffix or None, **options)
+        del data
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(output)))
+        self.send_header('X-Elapsed', f"{time.perf_counter() - start:.3f}")
+        self.end_headers()
+        self.wfile.write(output)
+
+
+class WatermarkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service: WatermarkService, host: str = SERVER_HOST, port: int = SERVER_PORT,
+                 max_body_bytes: int = SERVER_MAX_BODY_BYTES):
+        super().__init__((host, port), WatermarkRequestHandler)
+        self.service = service
+        self.max_body_bytes = max_body_bytes
+
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT, workers: int = None, max_queue: int = None,
+          cache: str = None, cache_max_bytes: int = None, max_body_bytes: int = SERVER_MAX_BODY_BYTES,
+          ready: Optional[Callable[[WatermarkServer], None]] = None):
+    """
+    Run the service until interrupted
+    :param host: only local clients by default
+    :param port:
+    :param workers: number of worker processes (default: number of CPUs)
+    :param max_queue: max number of requests waiting for a worker, others get a 503 (default: unbounded)
+    :param cache: directory of the cache of cleaned files and images (see cache.py)
+    :param cache_max_bytes:
+    :param max_body_bytes: max size of the files sent in requests
+    :param ready: called with the server once it listens
+    :return:
+    """
+    service = WatermarkService(workers, max_queue, cache, cache_max_bytes)
+    with WatermarkServer(service, host, port, max_body_bytes) as server:
+        logger.info(f"Listening on http://{host}:{server.server_address[1]} with {service.workers} workers.")
+        if ready:
+            ready(server)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(serve)
@@ -0,0 +1,153 @@
+"""
+Registry of the watermark signatures removed from pdf content streams, loaded from a versioned file.
+
+The file (resources/signatures.json by default, or the WATERMARK_SIGNATURES_FILE environment variable) looks like:
+{
+  "version": 1,
+  "signature_sets": {
+    "<name>": {
+      "tj_prefixes": {"<label>": {"text": "Trial - "}, "<label>": {"bytes": ["0037", "0055"]}},
+      "tj_runs": {"<label>": "VERSION EVALUATION"},
+      "fallback_orders": {"f": [0]},
+      "prefilter": true
+    }
+  }
+}
+prefilter (default true): pages that none of the signatures can match are not parsed nor rewritten, so the
+fallback_orders only apply to pages with a signature. False to parse every page (the fallback_orders then also apply
+to pages without signatures).
+"""
+
+import json
+import os
+from collections import Counter
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Union
+
+from matcher import WatermarkMatcher
+
+SIGNATURES_VERSION = 1
+SIGNATURES_FILE = Path(__file__).parent / 'resources' / 'signatures.json'
+DEFAULT_SIGNATURE_SET = 'geos'
+
+
+def parse_signature_set(data: dict) -> WatermarkMatcher:
+    """
+    Compile a signature set of the signatures file
+    :param data:
+    :return:
+    """
+    tj_prefixes = {}
+    for label, signature in data.get('tj_prefixes', {}).items():
+        if 'text' in signature:
+            tj_prefixes[label] = signature['text']
+        elif 'bytes' in signature:
+            tj_prefixes[label] = [bytes.fromhex(token) for token in signature['bytes']]
+        else:
+            raise ValueError(f"Signature {label} should have 'text' or 'bytes'")
+    return WatermarkMatcher(
+        tj_prefixes=tj_prefixes,
+        tj_runs=data.get('tj_runs', {}),
+        fallback_orders=data.get('fallback_orders', {}),
+        prefilter=data.get('prefilter', True),
+    )
+
+
+class SignatureRegistry:
+    """Compiled signature sets with the number of times each signature was removed."""
+
+    def __init__(self, signature_sets: Dict[str, WatermarkMatcher], version: int = SIGNATURES_VERSION):
+        self.signature_sets = signature_sets
+        self.version = version
+        self.hits = {name: Counter() for name in signature_sets}
+        self.pages = Counter()
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'SignatureRegistry':
+        """
+        Load and compile the signature sets of a signatures file
+        :param path:
+        :return:
+        """
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != SIGNATURES_VERSION:
+            raise ValueError(f"Unsupported signatures file version {data.get('version')} in {path}")
+        return cls({name: parse_signature_set(signature_set)
+                    for name, signature_set in data.get('signature_sets', {}).items()}, data['version'])
+
+    def get(self, name: str = None) -> WatermarkMatcher:
+        name = name or DEFAULT_SIGNATURE_SET
+        if name not in self.signature_sets:
+            raise ValueError(f"Unknown signature set: {name}")
+        return self.signature_sets[name]
+
+    def cache_key(self, name: str = None) -> str:
+        """Version of the registry and fingerprint of a signature set, part of the keys of the cached GEOS files."""
+        return f"{self.version}:{self.get(name).fingerprint}"
+
+    def record(self, name: str, hits: Dict[str, int], pages: int = 1):
+        """Count the signatures removed from some pages using the signature set name."""
+        name = name or DEFAULT_SIGNATURE_SET
+        with self._lock:
+            self.hits[name].update(hits)
+            self.pages[name] += pages
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Number of pages and hits by signature (including signatures that never matched)
+        :return: {name: {'pages': int, 'hits': {label: int}}}
+        """
+        with self._lock:
+            return {name: {
+                'pages': self.pages[name],
+                'hits': {label: self.hits[name][label] for label in matcher.labels},
+            } for name, matcher in self.signature_sets.items()}
+
+    def counts(self) -> Dict[str, dict]:
+        """
+        Pages and hits recorded so far, of the signature sets used (see merge)
+        :return: {name: {'pages': int, 'hits': {label: int}}}
+        """
+        with self._lock:
+            return {name: {'pages': self.pages[name], 'hits': dict(+self.hits[name])}
+                    for name in self.signature_sets if self.pages[name]}
+
+    def counts_since(self, before: Dict[str, dict]) -> Dict[str, dict]:
+        """Pages and hits recorded since counts() returned before."""
+        counts = {}
+        for name, after in self.counts().items():
+            previous = before.get(name, {'pages': 0, 'hits': {}})
+            if after['pages'] > previous['pages']:
+                hits = Counter(after['hits'])
+                hits.subtract(previous['hits'])
+                counts[name] = {'pages': after['pages'] - previous['pages'], 'hits': dict(+hits)}
+        return counts
+
+    def merge(self, counts: Dict[str, dict]):
+        """Add the pages and hits recorded by another registry (of a worker process for example)."""
+        for name, recorded in counts.items():
+            if name in self.signature_sets:
+                self.record(name, recorded['hits'], recorded['pages'])
+
+    def reset_stats(self):
+        with self._lock:
+            for counter in self.hits.values():
+                counter.clear()
+            self.pages.clear()
+
+
+REGISTRY = SignatureRegistry.load(os.environ.get('WATERMARK_SIGNATURES_FILE') or SIGNATURES_FILE)
+
+
+def load_registry(path: Union[str, Path]) -> SignatureRegistry:
+    """
+    Replace the signature sets by the ones of another signatures file
+    :param path:
+    :return:
+    """
+    global REGISTRY
+    REGISTRY = SignatureRegistry.load(path)
+    return REGISTRY
@@ -0,0 +1,283 @@
+"""
+Watermark templates for documents with the watermark at the same position on every page (OpenCV2 method).
+
+The mask of the pixels made white is learnt from the first images of a document (the pixels made white in all of
+them), or loaded from a template file. The next images of the same size are only processed in the bounding box of
+the mask: the pixels outside of it are left as they are. An image whose detection in the bounding box does not match
+the mask (intersection over union below min_iou) is processed entirely, like without template.
+
+usage:
+python template.py learn scanned.pdf template.npz
+python main.py other_scan.pdf --method_choice=openCV2 --template=template.npz
+python main.py scanned.pdf --method_choice=openCV2 --template=learn
+"""
+
+from __future__ import annotations
+
+import hashlib
+from collections import Counter
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from typing import Iterator, Optional, Tuple, Union, TYPE_CHECKING
+
+from main import FileType, detect_file_type, open_raster_image, remove_watermark_from_cv_image, \
+    UnsupportedFileType, CV_SATURATION_THRESHOLD, CV_VALUE_THRESHOLD, DOCX_MEDIA_DIR
+from instrumentation import count
+
+if TYPE_CHECKING:
+    import numpy
+
+logger = getLogger(__name__)
+
+TEMPLATE_VERSION = 1
+TEMPLATE_LEARN_IMAGES = 3  # images a template is learnt from
+TEMPLATE_MIN_PIXELS = 16  # smaller masks are not used
+TEMPLATE_MARGIN = 8  # pixels added around the bounding box of the mask
+# parts of the mask smaller than this ratio of the biggest one are ignored: light pixels at the same position in the
+# first images by chance (lines of the background, ...) would make the bounding box much bigger
+TEMPLATE_MIN_PART_RATIO = 0.1
+TEMPLATE_MIN_IOU = 0.5
+TEMPLATE_LEARN = 'learn'
+
+
+WHITE = (255, 255, 255)
+
+
+def watermark_mask(img: numpy.ndarray) -> numpy.ndarray:
+    """
+    Pixels of a BGR image made white by remove_watermark_from_cv_image
+    :param img:
+    :return: height x width mask: 255 for the pixels made white, 0 for the others
+    """
+    import cv2
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    return cv2.inRange(hsv, (0, 0, CV_VALUE_THRESHOLD + 1), (255, CV_SATURATION_THRESHOLD, 255))
+
+
+def changed_pixels(img: numpy.ndarray, mask: numpy.ndarray) -> numpy.ndarray:
+    """Pixels of mask that are not white already."""
+    import cv2
+    return cv2.subtract(mask, cv2.inRange(img, WHITE, WHITE))
+
+
+def whiten(img: numpy.ndarray, mask: numpy.ndarray):
+    """Make the pixels of mask white, in place (img can be a view of a bigger image)."""
+    import cv2
+    cv2.bitwise_or(img, (*WHITE, 0), dst=img, mask=mask)
+
+
+class WatermarkTemplate:
+    """Watermark mask of the images of a document, learnt from its first images or loaded from a file."""
+
+    def __init__(self, learn_images: int = TEMPLATE_LEARN_IMAGES, min_iou: float = TEMPLATE_MIN_IOU,
+                 margin: int = TEMPLATE_MARGIN):
+        """
+        :param learn_images: number of images of the same size the mask is learnt from
+        :param min_iou: images whose watermark matches the mask less are processed entirely
+        :param margin: pixels added around the bounding box of the mask
+        """
+        self.learn_images = learn_images
+        self.min_iou = min_iou
+        self.margin = margin
+        self.shape: Optional[Tuple[int, int]] = None  # height, width of the images
+        self.bbox: Optional[Tuple[int, int, int, int]] = None  # top, bottom, left, right
+        self.mask: Optional[numpy.ndarray] = None  # watermark pixels of the bounding box (255)
+        self.source: Optional[str] = None  # hash of the template file it was loaded from
+        self.stats = Counter()  # learnt, applied, fallbacks, other_size
+        self._learnt: Optional[numpy.ndarray] = None
+        self._learnt_images = 0
+        self._lock = Lock()
+
+    def __getstate__(self) -> dict:
+        # sent to worker processes (run_batch, GEOS pages): the lock can't be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.mask is not None
+
+    @property
+    def key(self) -> str:
+        """Part of the cache keys of the files cleaned with the template."""
+        if self.source:
+            return self.source
+        return f"{TEMPLATE_LEARN}:{self.learn_images}:{self.min_iou}:{self.margin}"
+
+    def _set_mask(self, mask: numpy.ndarray) -> bool:
+        """Keep the bounding box of a full size mask (call with the lock held), False if it is too small."""
+        import cv2
+        import numpy as np
+        if cv2.countNonZero(mask) < TEMPLATE_MIN_PIXELS:
+            return False
+        # parts: groups of pixels closer than the margin
+        close = cv2.dilate(mask, np.ones((2 * self.margin + 1, 2 * self.margin + 1), np.uint8))
+        parts, labels = cv2.connectedComponents(close)
+        sizes = np.bincount(labels[mask > 0], minlength=parts)
+        sizes[0] = 0  # not a part
+        kept = np.flatnonzero(sizes >= sizes.max() * TEMPLATE_MIN_PART_RATIO)
+        mask = np.where(np.isin(labels, kept), mask, 0).astype(np.uint8)
+        height, width = mask.shape
+        left, top, mask_width, mask_height = cv2.boundingRect(mask)
+        self.bbox = (max(top - self.margin, 0), min(top + mask_height + self.margin, height),
+                     max(left - self.margin, 0), min(left + mask_width + self.margin, width))
+        top, bottom, left, right = self.bbox
+        self.mask = mask[top:bottom, left:right].copy()
+        self.shape = (height, width)
+        return True
+
+    def _learn(self, img: numpy.ndarray) -> numpy.ndarray:
+        """Process the whole image (same result as remove_watermark_from_cv_image) and add its mask."""
+        import cv2
+        mask = watermark_mask(img)
+        changed = changed_pixels(img, mask)
+        whiten(img, mask)
+        with self._lock:
+            if self.ready or self._learnt_images >= self.learn_images:
+                return img
+            self._learnt = changed if self._learnt is None else cv2.bitwise_and(self._learnt, changed)
+            self._learnt_images += 1
+            self.stats['learnt'] += 1
+            if self._learnt_images == self.learn_images:
+                if self._set_mask(self._learnt):
+                    logger.info(f"Watermark template learnt: {cv2.countNonZero(self.mask)} pixels in {self.bbox}.")
+                else:
+                    logger.info("No watermark at the same position in the first images: template not used.")
+                self._learnt = None
+        return img
+
+    def clean(self, img: numpy.ndarray, tile_height: int = None) -> numpy.ndarray:
+        """
+        Remove watermark from a BGR image in place, with the mask of the template if it matches
+        :param img:
+        :param tile_height: see remove_watermark_from_cv_image (images processed entirely)
+        :return: img
+        """
+        import cv2
+        height, width = img.shape[:2]
+        with self._lock:
+            if self.shape is None and not self.ready:
+                self.shape = (height, width)
+            same_size = self.shape == (height, width)
+            learning = not self.ready and self._learnt_images < self.learn_images
+        if same_size and learning:
+            return self._learn(img)
+        if same_size and self.ready:
+            top, bottom, left, right = self.bbox
+            region = img[top:bottom, left:right]
+            mask = watermark_mask(region)
+            changed = changed_pixels(region, mask)
+            union = cv2.countNonZero(cv2.bitwise_or(changed, self.mask))
+            if union and cv2.countNonZero(cv2.bitwise_and(changed, self.mask)) / union >= self.min_iou:
+                whiten(region, mask)
+                self.stats['applied'] += 1
+                count('template_applied')
+                return img
+            self.stats['fallbacks'] += 1
+            count('template_fallbacks')
+        else:
+            self.stats['other_size'] += 1
+        return remove_watermark_from_cv_image(img, tile_height, in_place=True)
+
+    def save(self, path: Union[str, Path]):
+        """Save the mask to a .npz file."""
+        import numpy as np
+        if not self.ready:
+            raise ValueError("The template has no mask")
+        with open(path, 'wb') as f:  # np.savez adds .npz to paths without this suffix
+            np.savez_compressed(f, version=TEMPLATE_VERSION, shape=self.shape, bbox=self.bbox,
+                                mask=self.mask.astype(bool), min_iou=self.min_iou)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> WatermarkTemplate:
+        """
+        Template saved by save
+        :param path:
+        :return: template applied to the images of the same size as the ones it was learnt from
+        """
+        import numpy as np
+        data = Path(path).read_bytes()
+        with np.load(path) as f:
+            if int(f['version']) != TEMPLATE_VERSION:
+                raise ValueError(f"Unsupported template version {int(f['version'])} in {path}")
+            template = cls(min_iou=float(f['min_iou']))
+            template.shape = tuple(int(x) for x in f['shape'])
+            template.bbox = tuple(int(x) for x in f['bbox'])
+            template.mask = f['mask'].astype(np.uint8) * 255
+        template.source = hashlib.sha256(data).hexdigest()
+        return template
+
+
+def open_template(template: Union[str, Path, WatermarkTemplate, None]) -> Optional[WatermarkTemplate]:
+    """
+    Template of a document
+    :param template: 'learn' to learn it from the first images of the document, path of a template file,
+    a WatermarkTemplate or None (no template)
+    :return:
+    """
+    if template is None or isinstance(template, WatermarkTemplate):
+        return template
+    if str(template) == TEMPLATE_LEARN:
+        return WatermarkTemplate()
+    return WatermarkTemplate.load(template)
+
+
+def document_images(input_file: Union[str, Path]) -> Iterator[numpy.ndarray]:
+    """BGR images of a pdf, a docx or an image file, in the order of the document."""
+    import cv2
+    import numpy as np
+    from PIL import Image
+    file_type = detect_file_type(Path(input_file))
+    if file_type == FileType.pdf:
+        from pikepdf import Pdf
+        from scan import pdf_images
+        with Pdf.open(input_file) as pdf:
+            for image in pdf_images(pdf):
+                yield cv2.cvtColor(np.array(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+    elif file_type == FileType.docx:
+        import zipfile
+        with zipfile.ZipFile(input_file) as z:
+            for name in z.namelist():
+                if name.startswith(DOCX_MEDIA_DIR):
+                    image = open_raster_image(z.read(name))
+                    if image is not None:
+                        yield cv2.cvtColor(np.array(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+    elif file_type is not None:
+        with Image.open(input_file) as image:
+            yield cv2.cvtColor(np.array(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+    else:
+        raise UnsupportedFileType(f"Unsupported file type: {Path(input_file).suffix}")
+
+
+def learn_template(input_file: str, template_file: str, learn_images: int = TEMPLATE_LEARN_IMAGES,
+                   min_iou: float = TEMPLATE_MIN_IOU, margin: int = TEMPLATE_MARGIN) -> dict:
+    """
+    Learn the watermark template of a document and save it
+    :param input_file: pdf, docx or images of the same size
+    :param template_file: .npz file
+    :param learn_images: number of images of the same size the mask is learnt from
+    :param min_iou: see WatermarkTemplate
+    :param margin: see WatermarkTemplate
+    :return:
+    """
+    template = WatermarkTemplate(learn_images, min_iou, margin)
+    for img in document_images(input_file):
+        template.clean(img)
+        if template.ready:
+            break
+    if not template.ready:
+        raise ValueError(f"No watermark at the same position in the first {learn_images} images of {input_file}")
+    template.save(template_file)
+    return {'template_file': template_file, 'shape': template.shape, 'bbox': template.bbox,
+            'pixels': int(template.mask.astype(bool).sum())}
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire({'learn': learn_template})
@@ -0,0 +1,20 @@
+"""
+Fixtures shared by the tests, run with `python -m pytest tests` from the root of the repository.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import encoding  # noqa: E402
+
+
+@pytest.fixture
+def deterministic_save(monkeypatch):
+    """Pdf saved with a /ID computed from their content: outputs can be compared byte for byte."""
+    monkeypatch.setattr(encoding, 'SAVE_PROFILE_OPTIONS', {
+        profile: {**options, 'deterministic_id': True} for profile, options in encoding.SAVE_PROFILE_OPTIONS.items()
+    })
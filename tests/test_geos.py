@@ -0,0 +1,74 @@
+import io
+from typing import List
+
+import pytest
+from pikepdf import Pdf
+
+import signatures
+from benchmark import PREFILTER_CASES, geos_pdf, geos_watermarked
+from instrumentation import instrument
+from main import page_content, remove_watermark_from_geos_pdf
+
+PAGES = 40
+
+
+@pytest.fixture(scope='module')
+def input_path(tmp_path_factory):
+    return geos_pdf(tmp_path_factory.mktemp('geos') / 'input.pdf', PAGES, lines=10, clean_ratio=0.5)
+
+
+@pytest.fixture
+def serial_output(input_path, deterministic_save) -> bytes:
+    output = io.BytesIO()
+    remove_watermark_from_geos_pdf(input_path, output)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('workers', [2, 3, 4])
+def test_parallel_output_is_identical(input_path, serial_output, workers):
+    output = io.BytesIO()
+    remove_watermark_from_geos_pdf(input_path, output, workers)
+    assert output.getvalue() == serial_output
+
+
+@pytest.mark.parametrize('workers', [2, 4])
+def test_parallel_output_from_memory_is_identical(input_path, serial_output, workers):
+    output = io.BytesIO()
+    remove_watermark_from_geos_pdf(io.BytesIO(input_path.read_bytes()), output, workers)
+    assert output.getvalue() == serial_output
+
+
+@pytest.fixture(scope='module')
+def prefilter_path(tmp_path_factory):
+    """GEOS pdf with clean pages followed by PREFILTER_CASES."""
+    path = geos_pdf(tmp_path_factory.mktemp('prefilter') / 'input.pdf', PAGES, lines=10, clean_ratio=0.75)
+    with Pdf.open(path, allow_overwriting_input=True) as pdf:
+        for content, _ in PREFILTER_CASES:
+            pdf.add_blank_page(page_size=(612, 792)).Contents = pdf.make_stream(content)
+        pdf.save(path, deterministic_id=True)
+    return path
+
+
+@pytest.fixture(scope='module')
+def prefilter_skipped() -> List[bool]:
+    return [not geos_watermarked(i, 0.75) for i in range(PAGES)] + [skipped for _, skipped in PREFILTER_CASES]
+
+
+@pytest.mark.parametrize('content, skipped', PREFILTER_CASES)
+def test_may_match(content, skipped):
+    assert signatures.REGISTRY.get('geos').may_match(content) is not skipped
+
+
+def test_prefilter_skips_clean_pages(prefilter_path, prefilter_skipped, tmp_path):
+    output_path, reference_path = tmp_path / 'prefilter.pdf', tmp_path / 'reference.pdf'
+    with instrument('prefilter', export=False) as report:
+        remove_watermark_from_geos_pdf(prefilter_path, output_path)
+    remove_watermark_from_geos_pdf(prefilter_path, reference_path, prefilter=False)
+    assert report.counters['pages_skipped'] == sum(prefilter_skipped) >= PAGES // 2
+    with Pdf.open(prefilter_path) as pdf_in, Pdf.open(output_path) as pdf_out, Pdf.open(reference_path) as reference:
+        for page_in, page_out, page_reference, skipped in zip(pdf_in.pages, pdf_out.pages, reference.pages,
+                                                              prefilter_skipped):
+            if skipped:
+                assert page_out.obj.Contents.read_raw_bytes() == page_in.obj.Contents.read_raw_bytes()
+            else:
+                assert page_content(page_out) == page_content(page_reference)
@@ -0,0 +1,15 @@
+import warnings
+
+import pytest
+
+from instrumentation import instrument
+
+
+def test_instrument_without_sentry_client_is_quiet():
+    pytest.importorskip('sentry_sdk')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with instrument('quiet', export=False) as report:
+            report.count('pages', 1)
+    assert report.transaction is None
+    assert report.counters['pages'] == 1
@@ -0,0 +1,45 @@
+import pytest
+from pikepdf import Pdf, parse_content_stream, unparse_content_stream
+
+import signatures
+from benchmark import PREFILTER_CASES, geos_chain, geos_page_content
+
+CONTENTS = [
+    geos_page_content(1, lines=5),
+    geos_page_content(2, lines=5, watermark=False),
+    b"BT (VERSION ) Tj (EVAL) Tj (UATION) Tj ET\n0 0 10 10 re f\n",  # run split across 3 "Tj"
+    b"BT (VERSION ) Tj (OTHER) Tj ET BT (VERSION EVALUATION) Tj ET\n",  # run started again
+    b"BT [(Trial - ) -20 (Geos)] TJ [(Trial) ( - Geos)] TJ [(UnRegistered copy)] TJ ET\n",
+    b"BT [<0037> <0055> <004C> <0044> <004F> <0003> <0010> <0003> <0044>] TJ ET\n",
+    *[content for content, _ in PREFILTER_CASES if b'[(Trial)]' not in content],
+]
+
+
+@pytest.fixture(scope='module')
+def pdf():
+    with Pdf.new() as pdf:
+        yield pdf
+
+
+@pytest.mark.parametrize('content', CONTENTS)
+def test_matcher_removes_like_the_chain(pdf, content):
+    matcher = signatures.REGISTRY.get('geos')
+    result = matcher.apply(parse_content_stream(pdf.make_stream(content)))
+    expected = geos_chain(parse_content_stream(pdf.make_stream(content)))
+    assert unparse_content_stream(result.instructions) == unparse_content_stream(expected)
+
+
+def test_matcher_hits(pdf):
+    matcher = signatures.REGISTRY.get('geos')
+    result = matcher.apply(parse_content_stream(pdf.make_stream(geos_page_content(1, lines=5))))
+    assert result.hits == {'version_evaluation': 2, 'trial': 1, 'trial_glyphs': 1, 'unregistered': 1}
+    assert not result.used_fallback
+
+
+def test_matcher_keeps_tj_shorter_than_a_prefix(pdf):
+    # remove_tj_maj raises IndexError on them
+    matcher = signatures.REGISTRY.get('geos')
+    content = b"BT [(Trial)] TJ [(Un)] TJ ET\n"
+    result = matcher.apply(parse_content_stream(pdf.make_stream(content)))
+    assert unparse_content_stream(result.instructions) == unparse_content_stream(
+        parse_content_stream(pdf.make_stream(content)))
@@ -0,0 +1,45 @@
+import json
+import logging
+import threading
+from http.client import HTTPConnection
+
+import pytest
+
+from server import WatermarkServer, WatermarkService
+
+
+@pytest.fixture(scope='module')
+def server():
+    service = WatermarkService(workers=1)
+    with WatermarkServer(service, port=0) as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        service.close()
+
+
+def post(server, path: str, body: bytes, content_type: str = 'application/octet-stream'):
+    connection = HTTPConnection(*server.server_address)
+    try:
+        connection.request('POST', path, body, {'Content-Type': content_type})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_unsupported_body_is_a_client_error(server, caplog):
+    with caplog.at_level(logging.WARNING, logger='server'):
+        status, data = post(server, '/clean', b'not a document')
+    assert status == 400
+    assert 'Unsupported file type' in data['error']
+    assert not caplog.records
+
+
+def test_unsupported_file_is_a_client_error(server, tmp_path):
+    input_file = tmp_path / 'notes.txt'
+    input_file.write_text('not a document')
+    status, data = post(server, '/clean', json.dumps({'input_file': str(input_file)}).encode(), 'application/json')
+    assert status == 400
+    assert 'Unsupported file type' in data['error']
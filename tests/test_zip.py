@@ -0,0 +1,83 @@
+import io
+import struct
+import zipfile
+
+import pytest
+
+from main import copy_zip_entry
+
+ENTRIES = {
+    'word/document.xml': b'<w:document>' + b'<w:p>watermark</w:p>' * 500 + b'</w:document>',
+    'word/media/image1.png': bytes(range(256)) * 40,
+    '[Content_Types].xml': b'<Types/>',
+}
+
+
+class Unseekable(io.RawIOBase):
+    """Output stream without seek nor tell, like a pipe or a socket."""
+
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        return self.data.write(b)
+
+
+def make_zip(output) -> None:
+    with zipfile.ZipFile(output, 'w') as z:
+        z.writestr('word/document.xml', ENTRIES['word/document.xml'], zipfile.ZIP_DEFLATED, 9)
+        z.writestr('word/media/image1.png', ENTRIES['word/media/image1.png'], zipfile.ZIP_STORED)
+        z.writestr('[Content_Types].xml', ENTRIES['[Content_Types].xml'], zipfile.ZIP_DEFLATED)
+
+
+def copy_zip(source: bytes, output) -> None:
+    with zipfile.ZipFile(io.BytesIO(source)) as zin, zipfile.ZipFile(output, 'w') as zout:
+        for info in zin.infolist():
+            copy_zip_entry(zin, zout, info)
+        # entries written by zipfile after the raw copies
+        zout.writestr('word/settings.xml', b'<w:settings/>', zipfile.ZIP_DEFLATED)
+
+
+@pytest.fixture(params=['seekable', 'data_descriptors'])
+def source(request) -> bytes:
+    # written to a stream without seek: the sizes are in a data descriptor after the data of every entry
+    output = io.BytesIO() if request.param == 'seekable' else Unseekable()
+    make_zip(output)
+    data = output.getvalue() if request.param == 'seekable' else output.data.getvalue()
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert all(bool(info.flag_bits & 0x08) == (request.param == 'data_descriptors') for info in z.infolist())
+    return data
+
+
+def check_copy(source: bytes, copied: bytes):
+    with zipfile.ZipFile(io.BytesIO(source)) as zin, zipfile.ZipFile(io.BytesIO(copied)) as z:
+        assert z.testzip() is None
+        assert [info.filename for info in z.infolist()] == [*ENTRIES, 'word/settings.xml']
+        for name, content in ENTRIES.items():
+            info, source_info = z.getinfo(name), zin.getinfo(name)
+            assert z.read(name) == content
+            assert (info.compress_type, info.compress_size, info.CRC) == \
+                   (source_info.compress_type, source_info.compress_size, source_info.CRC)
+        assert z.read('word/settings.xml') == b'<w:settings/>'
+        for name in ENTRIES:
+            # local header of the copy: no data descriptor, the sizes and crc are in the header
+            info = z.getinfo(name)
+            flag_bits, crc, compress_size, file_size = struct.unpack(
+                '<H6xIII', copied[info.header_offset + 6:info.header_offset + 26])
+            assert not flag_bits & 0x08
+            assert (crc, compress_size, file_size) == (info.CRC, info.compress_size, info.file_size)
+
+
+def test_copy_to_seekable_output(source):
+    output = io.BytesIO()
+    copy_zip(source, output)
+    check_copy(source, output.getvalue())
+
+
+def test_copy_to_unseekable_output(source):
+    output = Unseekable()
+    copy_zip(source, output)
+    check_copy(source, output.data.getvalue())